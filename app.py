@@ -1,7 +1,7 @@
 import os
 import sqlite3
 import re
-from flask import Flask, render_template, jsonify, send_from_directory, request, abort, redirect, url_for, flash, send_file, Response
+from flask import Flask, render_template, jsonify, send_from_directory, request, abort, redirect, url_for, flash, send_file, Response, g, make_response
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 import uuid
@@ -14,6 +14,17 @@ import subprocess
 import shutil
 import time
 import math
+import heapq
+import threading
+import queue
+import select
+import struct
+from array import array
+import ctypes
+import ctypes.util
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from operator import attrgetter
 from reportlab.lib.pagesizes import landscape, A4
 from reportlab.pdfgen import canvas
 from reportlab.lib import colors
@@ -25,6 +36,10 @@ import yt_dlp
 from gtts import gTTS
 import genanki
 import tempfile
+import atexit
+import hashlib
+from werkzeug.security import safe_join
+from markupsafe import Markup, escape
 
 # AI Import
 try:
@@ -32,13 +47,64 @@ try:
 except ImportError:
     genai = None
 
+# Image derivatives (resized covers/snapshots); originals are served as-is without Pillow
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Vectorised semantic search; falls back to pure-Python scoring without NumPy
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 app = Flask(__name__)
 app.secret_key = 'skillforge_secret_key_change_this_in_production'  # Required for sessions
 
 # --- Configuration ---
 basedir = os.path.abspath(os.path.dirname(__file__))
-DB_FILE = os.path.join(basedir, "courses.db")
+DB_FILE = os.environ.get('SKILLFORGE_DB_FILE', os.path.join(basedir, "courses.db"))
 COURSES_DIR = "courses"
+LIBRARY_SCAN_INTERVAL = 30  # Minimum seconds between background library scans
+LIBRARY_POLL_INTERVAL = int(os.environ.get('SKILLFORGE_POLL_INTERVAL', 60))  # Polling watcher fallback
+LIBRARY_WATCH_DEBOUNCE = 2  # Seconds of quiet after filesystem events before rescanning
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.webm', '.mov')
+NON_RESOURCE_EXTENSIONS = VIDEO_EXTENSIONS + ('.ds_store', '.vtt', '.srt')
+# Course artwork, in order of preference
+THUMBNAIL_NAMES = [f"{name}.{ext}" for ext in ('jpg', 'png', 'jpeg', 'webp') for name in ('cover', 'banner')]
+PROBE_WORKERS = int(os.environ.get('SKILLFORGE_PROBE_WORKERS', 4))  # Concurrent duration probes
+DB_POOL_SIZE = int(os.environ.get('SKILLFORGE_DB_POOL_SIZE', 8))  # Idle connections kept for reuse
+DB_CONNECTION_MAX_USES = int(os.environ.get('SKILLFORGE_DB_MAX_USES', 500))  # Requests served before a connection is recycled
+SNAPSHOTS_DIR = os.path.join(basedir, "static", "snapshots")
+IMAGE_CACHE_DIR = os.path.join(basedir, "cache", "images")  # Resized variants, named by source content hash
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp')
+IMAGE_WIDTH_BUCKETS = (96, 240, 480, 960, 1920)  # Requested widths are rounded up to one of these
+IMAGE_QUALITY = 80
+COURSE_IMAGE_MAX_AGE = 86400  # Course artwork can be replaced in place, so it is revalidated via ETag
+SNAPSHOT_IMAGE_MAX_AGE = 31536000  # Snapshot/profile files get unique names and never change
+DASHBOARD_CACHE_SIZE = int(os.environ.get('SKILLFORGE_DASHBOARD_CACHE_SIZE', 64))  # Rendered dashboards kept in memory
+COURSE_CACHE_MAX_ITEMS = int(os.environ.get('SKILLFORGE_COURSE_CACHE_ITEMS', 20000))  # Modules + videos + resources across cached course trees
+PROGRESS_SEGMENT_MAX_SECONDS = 3600  # Sanity cap on the length of a single watched segment
+COMPLETION_COVERAGE = 0.9  # Share of a video's duration that must have been watched to complete it
+INTERVAL_MERGE_GAP = 0.5  # Watched ranges closer than this (seconds) are merged into one
+PROGRESS_FLUSH_INTERVAL = int(os.environ.get('SKILLFORGE_PROGRESS_FLUSH_INTERVAL', 10))  # Seconds heartbeats stay in memory before a bulk write
+SUBTITLE_EXTENSIONS = ('.vtt', '.srt')  # Transcript files looked up next to each video, in this order
+TRANSCRIPT_PAGE_SIZE = 30  # Transcript search hits per page
+TRANSCRIPT_CACHE_MAX_CUES = int(os.environ.get('SKILLFORGE_TRANSCRIPT_CACHE_CUES', 200000))  # Parsed cues kept in memory across transcripts
+
+# SQLite profile applied to every new connection; override any entry with SKILLFORGE_SQLITE_<NAME>
+SQLITE_PROFILE = {
+    'journal_mode': 'WAL',         # Readers don't block the progress writer (and vice versa)
+    'synchronous': 'NORMAL',       # Safe with WAL, avoids an fsync per commit
+    'busy_timeout': 5000,          # ms to wait on a locked DB instead of failing
+    'cache_size': -32000,          # Negative = KiB, i.e. 32 MB page cache
+    'mmap_size': 268435456,        # 256 MB memory-mapped I/O
+    'temp_store': 'MEMORY',
+    'foreign_keys': 'ON',          # Makes the ON DELETE CASCADE clauses fire
+}
+for _name in SQLITE_PROFILE:
+    SQLITE_PROFILE[_name] = os.environ.get(f'SKILLFORGE_SQLITE_{_name.upper()}', SQLITE_PROFILE[_name])
 
 # --- Login Manager Setup ---
 login_manager = LoginManager()
@@ -58,9 +124,8 @@ class User(UserMixin):
 
 @login_manager.user_loader
 def load_user(user_id):
-    conn = get_db_connection()
+    conn = get_db()
     user_row = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-    conn.close()
     if user_row:
         # Check for profile_pic column in Row
         pic = user_row['profile_pic'] if 'profile_pic' in user_row.keys() else None
@@ -87,98 +152,156 @@ def format_duration_human(seconds):
         return f"{h}h {m}m"
     return f"{m}m"
 
+@app.template_filter('resized')
+def resized(url, width):
+    """Points an image URL at its resized variant, e.g. {{ course.thumbnail|resized(480) }}."""
+    if not url:
+        return url
+    if url.startswith('/static/snapshots/'):
+        return f"/snapshots/{url[len('/static/snapshots/'):]}?w={width}"
+    if url.startswith('/course_file/'):
+        return f"{url}?w={width}"
+    return url
+
 # --- Subtitle Helper ---
-def srt_to_vtt(content):
-    """Simple regex-based SRT to VTT converter"""
-    vtt = ["WEBVTT\n\n"]
-    # Normalize line endings
-    content = content.replace('\r\n', '\n').replace('\r', '\n')
-    
-    # Split by double newlines to get blocks
-    blocks = content.strip().split('\n\n')
-    
-    for block in blocks:
-        lines = block.split('\n')
-        if len(lines) >= 2:
-            # Check if first line looks like an index
-            if lines[0].isdigit():
-                timestamp_line_idx = 1
-            else:
-                timestamp_line_idx = 0
-            
-            if timestamp_line_idx < len(lines):
-                ts = lines[timestamp_line_idx]
-                ts = ts.replace(',', '.') # SRT uses comma, VTT uses dot
-                
-                payload = lines[timestamp_line_idx+1:]
-                
-                vtt.append(f"{ts}\n")
-                vtt.extend([l + '\n' for l in payload])
-                vtt.append('\n')
-                
-    return "".join(vtt)
+def format_vtt_timestamp(seconds):
+    """Formats seconds as a WebVTT "HH:MM:SS.mmm" timestamp."""
+    millis = int(round(max(seconds, 0) * 1000))
+    secs, millis = divmod(millis, 1000)
+    mins, secs = divmod(secs, 60)
+    hrs, mins = divmod(mins, 60)
+    return f"{hrs:02d}:{mins:02d}:{secs:02d}.{millis:03d}"
+
+def parse_timestamp(value):
+    """Converts "HH:MM:SS.mmm" or "MM:SS.mmm" (SRT commas allowed) to seconds."""
+    parts = value.strip().replace(',', '.').split(':')
+    if len(parts) == 3: # HH:MM:SS.mmm
+        return int(parts[0]) * 3600 + int(parts[1]) * 60 + float(parts[2])
+    elif len(parts) == 2: # MM:SS.mmm
+        return int(parts[0]) * 60 + float(parts[1])
+    return 0
+
+_JSON_SEPARATORS = re.compile(r'[\s,]*')
+
+def _json_cue(item):
+    """(start, end or None, text) of one JSON transcript entry, or None if it has no usable start."""
+    try:
+        start = float(item.get('start', item.get('start_time', 0)))
+        text = item.get('text', '')
+    except (AttributeError, TypeError, ValueError):
+        return None
+    try:
+        return (start, float(item.get('end', item.get('end_time'))), text)
+    except (TypeError, ValueError):
+        return (start, None, text)
 
-def parse_subtitle_to_json(content):
-    """Parses SRT, VTT or JSON content into a list of subtitle objects."""
-    content = content.replace('\r\n', '\n').replace('\r', '\n').strip()
-    
-    # Check if content is actually JSON (or contains JSON after WEBVTT)
-    json_str = ""
-    if content.startswith('[') or content.startswith('{'):
-        json_str = content
-    elif 'WEBVTT' in content and '[' in content:
-        json_str = content.split('[', 1)[1]
-        json_str = '[' + json_str.rsplit(']', 1)[0] + ']'
-    
-    if json_str:
+def _iter_json_cues(buf, lines):
+    """Yields the entries of a JSON list one object at a time, reading `lines` only as far as needed.
+
+    A truncated list (common in AI output) yields its complete entries; a
+    lone object or a malformed entry ends the list.
+    """
+    decoder = json.JSONDecoder()
+    if not buf.startswith('['):
+        return
+    pos = 1
+    while True:
+        pos = _JSON_SEPARATORS.match(buf, pos).end()
+        if buf.startswith(']', pos):
+            return
         try:
-            # Try to load as-is first
-            data = json.loads(json_str)
-        except:
-            # If it fails, maybe it's truncated. Try to fix a truncated list.
-            try:
-                # Find last valid closing brace for an object
-                last_brace = json_str.rfind('}')
-                if last_brace != -1:
-                    fixed_json = json_str[:last_brace+1] + ']'
-                    data = json.loads(fixed_json)
-                else:
-                    data = []
-            except:
-                data = []
-        
-        if data:
-            transcript = []
-            for item in data:
-                try:
-                    start = item.get('start', item.get('start_time', 0))
-                    text = item.get('text', '')
-                    transcript.append({'start': float(start), 'text': text})
-                except:
+            item, pos = decoder.raw_decode(buf, pos)
+        except ValueError:
+            # Give up rather than buffer the rest of a file whose entry never parses
+            if len(buf) - pos > 65536:
+                return
+            # Read on in chunks of lines so pretty-printed entries aren't re-decoded line by line
+            chunk = [buf[pos:]]
+            size = 0
+            for line in lines:
+                chunk.append(line)
+                size += len(line)
+                if size >= 8192:
+                    break
+            if not size:
+                return
+            buf = ''.join(chunk)
+            pos = 0
+            continue
+        cue = _json_cue(item)
+        if cue is not None:
+            yield cue
+
+def _iter_raw_cues(lines):
+    lines = iter(lines)
+    at_start = True  # Before the first cue a block may be the WEBVTT header or a JSON list
+    header = False   # Inside the WEBVTT header block, which AI output may follow directly with JSON
+    skip = False     # Inside a header, NOTE/STYLE/REGION or unparsable block
+    head = 0         # Lines of the current block seen before its timing line
+    cue = None       # (start, end, payload lines) once the timing line is read
+    for line in lines:
+        if not line or line.isspace():
+            if cue is not None and cue[2]:
+                yield (cue[0], cue[1], ' '.join(cue[2]))
+            cue, header, skip, head = None, False, False, 0
+            continue
+        if header and line.lstrip().startswith(('[', '{')):
+            yield from _iter_json_cues(line.lstrip(), lines)
+            return
+        if skip:
+            continue
+        line = line.rstrip('\r\n')
+        if cue is not None:
+            cue[2].append(line)
+            continue
+        if head == 0:
+            if at_start:
+                stripped = line.lstrip('\ufeff \t')
+                if stripped.startswith(('[', '{')):
+                    yield from _iter_json_cues(stripped, lines)
+                    return
+                if stripped.startswith('WEBVTT'):
+                    header = skip = True
                     continue
-            return transcript
-
-    blocks = content.split('\n\n')
-    transcript = []
-    
-    for block in blocks:
-        lines = block.split('\n')
-        if len(lines) >= 2:
-            timestamp_line = lines[1] if lines[0].isdigit() else lines[0]
-            if '-->' in timestamp_line:
-                start_time_str = timestamp_line.split('-->')[0].strip().replace(',', '.')
-                
-                # Convert "HH:MM:SS.mmm" or "MM:SS.mmm" to seconds
-                parts = start_time_str.split(':')
-                seconds = 0
-                if len(parts) == 3: # HH:MM:SS.mmm
-                    seconds = int(parts[0]) * 3600 + int(parts[1]) * 60 + float(parts[2])
-                elif len(parts) == 2: # MM:SS.mmm
-                    seconds = int(parts[0]) * 60 + float(parts[1])
-                
-                text = " ".join(lines[lines.index(timestamp_line)+1:])
-                transcript.append({'start': seconds, 'text': text})
-    return transcript
+            if line.startswith(('NOTE', 'STYLE', 'REGION')) and '-->' not in line:
+                skip = True
+                continue
+        if '-->' not in line:
+            # An SRT index or VTT cue identifier; anything longer isn't a cue
+            head += 1
+            skip = head > 1
+            continue
+        at_start = False
+        start_str, end_str = line.split('-->', 1)
+        try:
+            start = parse_timestamp(start_str)
+        except ValueError:
+            skip = True
+            continue
+        try:
+            # VTT may put cue settings after the end time
+            end = parse_timestamp(end_str.split()[0])
+        except (ValueError, IndexError):
+            end = None
+        cue = (start, end, [])
+    if cue is not None and cue[2]:
+        yield (cue[0], cue[1], ' '.join(cue[2]))
+
+def iter_subtitle_cues(lines):
+    """Lazily parses SRT, VTT or JSON subtitles into (start, end, text) cues.
+
+    `lines` is any iterable of lines, typically an open file, read in a single
+    pass while holding one cue at a time. VTT headers and NOTE/STYLE/REGION
+    blocks are skipped, CRLF endings are stripped as lines arrive, and a cue
+    without a usable end time ends where the next one starts.
+    """
+    pending = None
+    for cue in _iter_raw_cues(lines):
+        if pending is not None:
+            yield pending if pending[1] is not None else (pending[0], cue[0], pending[2])
+        pending = cue
+    if pending is not None:
+        yield pending if pending[1] is not None else (pending[0], pending[0], pending[2])
 
 # --- Achievements Configuration ---
 ACHIEVEMENTS = {
@@ -224,76 +347,114 @@ ACHIEVEMENTS = {
     }
 }
 
-def check_new_achievements(conn, user_id):
-    """Checks for new achievements for the user and returns a list of newly unlocked ones."""
-    new_unlocks = []
-    
-    # Get existing achievements
-    existing = {row['achievement_id'] for row in conn.execute('SELECT achievement_id FROM user_achievements WHERE user_id = ?', (user_id,)).fetchall()}
-    
-    # 1. Check Totals
-    total_stats = conn.execute('SELECT SUM(seconds_watched) as t FROM daily_activity WHERE user_id=?', (user_id,)).fetchone()
-    total_time = total_stats['t'] or 0
-    
-    if 'first_steps' not in existing and total_time > 10:
-        new_unlocks.append('first_steps')
-        
-    if 'dedicated_learner' not in existing and total_time >= 3600:
-        new_unlocks.append('dedicated_learner')
-        
-    if 'knowledge_sponge' not in existing and total_time >= 36000:
-        new_unlocks.append('knowledge_sponge')
+# Achievements are evaluated against a per-user activity state (user_activity_state)
+# that record_activity() keeps current as watch time is written, instead of
+# re-reading the whole daily_activity history on every heartbeat.
+WEEKEND_MASK = (1 << 5) | (1 << 6)  # Saturday and Sunday bits of weekday_mask
+
+def current_streak(state, today):
+    """The run of consecutive active days, if it reaches today or yesterday (today may not have activity yet)."""
+    if not state['last_active_date']:
+        return 0
+    last = datetime.date.fromisoformat(state['last_active_date'])
+    return state['streak'] if (today - last).days <= 1 else 0
+
+# achievement_id -> rule(state, now); `now` is when the triggering activity happened
+ACHIEVEMENT_RULES = {
+    'first_steps': lambda state, now: state['total_seconds'] > 10,
+    'dedicated_learner': lambda state, now: state['total_seconds'] >= 3600,
+    'knowledge_sponge': lambda state, now: state['total_seconds'] >= 36000,
+    'night_owl': lambda state, now: 0 <= now.hour < 4,
+    'early_bird': lambda state, now: 5 <= now.hour < 8,
+    'on_fire': lambda state, now: current_streak(state, now.date()) >= 3,
+    'unstoppable': lambda state, now: current_streak(state, now.date()) >= 7,
+    'weekend_warrior': lambda state, now: state['weekday_mask'] & WEEKEND_MASK == WEEKEND_MASK,
+}
+# These depend on the moment of the event, which a rebuild can't reconstruct
+EVENT_ONLY_ACHIEVEMENTS = {'night_owl', 'early_bird'}
 
-    # 2. Check Time of Day (using current server time as proxy)
-    now = datetime.datetime.now()
-    hour = now.hour
-    if 'night_owl' not in existing and 0 <= hour < 4:
-        new_unlocks.append('night_owl')
-    if 'early_bird' not in existing and 5 <= hour < 8:
-        new_unlocks.append('early_bird')
-
-    # 3. Check Streaks
-    activity_rows = conn.execute('SELECT date, seconds_watched FROM daily_activity WHERE user_id=? ORDER BY date DESC', (user_id,)).fetchall()
-    streak = 0
-    check_date = datetime.date.today()
-    activity_map = {row['date']: row['seconds_watched'] for row in activity_rows}
-    
-    while True:
-        date_str = check_date.strftime("%Y-%m-%d")
-        if date_str in activity_map and activity_map[date_str] > 0:
-            streak += 1
-            check_date -= datetime.timedelta(days=1)
-        else:
-            # If today has no activity yet, don't break streak from yesterday
-            if date_str == datetime.date.today().strftime("%Y-%m-%d") and streak == 0:
-                 check_date -= datetime.timedelta(days=1)
-                 continue
-            break
-            
-    if 'on_fire' not in existing and streak >= 3:
-        new_unlocks.append('on_fire')
-    if 'unstoppable' not in existing and streak >= 7:
-        new_unlocks.append('unstoppable')
-
-    # 4. Check Weekend Warrior
-    # Need to check if they have activity on a Sat and Sun in the same week? 
-    # Or just "Ever watched on Sat AND Ever watched on Sun"? Let's do the latter for simplicity, or check recent history.
-    # Let's do "Watched on a Sat and a Sun" (anytime).
-    if 'weekend_warrior' not in existing:
-        has_sat = False
-        has_sun = False
-        # Limit to last 30 days to save perf? Or just iterate all.
-        for row in activity_rows:
-            d = datetime.datetime.strptime(row['date'], "%Y-%m-%d")
-            if d.weekday() == 5: has_sat = True
-            if d.weekday() == 6: has_sun = True
-            if has_sat and has_sun:
-                new_unlocks.append('weekend_warrior')
-                break
+EMPTY_ACTIVITY_STATE = {'total_seconds': 0, 'last_active_date': None, 'streak': 0, 'weekday_mask': 0}
+
+def record_activity(conn, user_id, date, seconds):
+    """Folds `seconds` watched on `date` (YYYY-MM-DD) into the user's activity state.
+
+    Call after the matching daily_activity write. A day older than the last
+    active one (a buffered flush straddling midnight) rebuilds the user's state.
+    """
+    if seconds <= 0:
+        return
+    day = datetime.date.fromisoformat(date)
+    row = conn.execute('SELECT last_active_date, streak FROM user_activity_state WHERE user_id = ?', (user_id or 0,)).fetchone()
+    if row and row['last_active_date'] and row['last_active_date'] > date:
+        rebuild_activity_state(conn, [user_id])
+        return
+    if row is None or not row['last_active_date']:
+        streak = 1
+    elif row['last_active_date'] == date:
+        streak = row['streak']
+    elif row['last_active_date'] == (day - datetime.timedelta(days=1)).isoformat():
+        streak = row['streak'] + 1
+    else:
+        streak = 1
+    conn.execute('''
+        INSERT INTO user_activity_state (user_id, total_seconds, last_active_date, streak, weekday_mask)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            total_seconds = total_seconds + excluded.total_seconds,
+            last_active_date = excluded.last_active_date,
+            streak = excluded.streak,
+            weekday_mask = weekday_mask | excluded.weekday_mask
+    ''', (user_id or 0, seconds, date, streak, 1 << day.weekday()))
+
+def rebuild_activity_state(conn, user_ids=None):
+    """Recomputes user_activity_state from daily_activity; `user_ids` limits which users."""
+    where, params = '', []
+    if user_ids is not None:
+        keys = list({uid or 0 for uid in user_ids})
+        where, params = f'WHERE COALESCE(user_id, 0) IN ({",".join("?" * len(keys))})', keys
+        conn.executemany('DELETE FROM user_activity_state WHERE user_id = ?', [(uid,) for uid in keys])
+    else:
+        conn.execute('DELETE FROM user_activity_state')
+
+    states = {}
+    for row in conn.execute(f'''
+        SELECT COALESCE(user_id, 0) as uid, date, SUM(seconds_watched) as seconds
+        FROM daily_activity {where}
+        GROUP BY uid, date ORDER BY uid, date
+    ''', params).fetchall():
+        state = states.setdefault(row['uid'], dict(EMPTY_ACTIVITY_STATE))
+        seconds = row['seconds'] or 0
+        state['total_seconds'] += seconds
+        if seconds <= 0:
+            continue
+        day = datetime.date.fromisoformat(row['date'])
+        last = state['last_active_date']
+        consecutive = last and (day - datetime.date.fromisoformat(last)).days == 1
+        state['streak'] = state['streak'] + 1 if consecutive else 1
+        state['last_active_date'] = row['date']
+        state['weekday_mask'] |= 1 << day.weekday()
+    conn.executemany('INSERT INTO user_activity_state (user_id, total_seconds, last_active_date, streak, weekday_mask) VALUES (?, ?, ?, ?, ?)',
+                     [(uid, st['total_seconds'], st['last_active_date'], st['streak'], st['weekday_mask']) for uid, st in states.items()])
+
+def check_new_achievements(conn, user_id, backfill=False, now=None):
+    """Checks for new achievements for the user and returns a list of newly unlocked ones.
+
+    Only rules for achievements the user doesn't have yet are evaluated, against
+    the activity state. `now` is when the activity happened (default: now);
+    `backfill` skips the event-only rules.
+    """
+    existing = {row['achievement_id'] for row in conn.execute('SELECT achievement_id FROM user_achievements WHERE user_id IS ?', (user_id,)).fetchall()}
+    pending = [aid for aid in ACHIEVEMENT_RULES if aid not in existing and not (backfill and aid in EVENT_ONLY_ACHIEVEMENTS)]
+    if not pending:
+        return []
+
+    row = conn.execute('SELECT total_seconds, last_active_date, streak, weekday_mask FROM user_activity_state WHERE user_id = ?', (user_id or 0,)).fetchone()
+    state = dict(row) if row else EMPTY_ACTIVITY_STATE
+    now = now or datetime.datetime.now()
+    new_unlocks = [aid for aid in pending if ACHIEVEMENT_RULES[aid](state, now)]
 
     # Persist new unlocks
-    for ach_id in new_unlocks:
-        conn.execute('INSERT INTO user_achievements (user_id, achievement_id) VALUES (?, ?)', (user_id, ach_id))
+    conn.executemany('INSERT INTO user_achievements (user_id, achievement_id) VALUES (?, ?)', [(user_id, aid) for aid in new_unlocks])
         
     # Return enriched objects
     result = []
@@ -307,15 +468,83 @@ def check_new_achievements(conn, user_id):
 # --- Helper Functions ---
 
 def get_db_connection():
-    conn = sqlite3.connect(DB_FILE)
+    """Opens a new connection. Request handlers should use get_db() instead."""
+    # Pooled connections are handed from one request thread to the next
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    for name, value in SQLITE_PROFILE.items():
+        conn.execute(f'PRAGMA {name} = {value}')
     return conn
 
+def report_sqlite_profile():
+    """Prints the effective value of each profile PRAGMA (SQLite may refuse some, e.g. WAL on network shares)."""
+    conn = get_db_connection()
+    effective = {name: conn.execute(f'PRAGMA {name}').fetchone()[0] for name in SQLITE_PROFILE}
+    conn.close()
+    print("SQLite profile: " + ", ".join(f"{name}={value}" for name, value in effective.items()))
+    return effective
+
+_db_pool = queue.LifoQueue()
+
+# Bumped whenever the database changes; cached pages rendered at an older version are stale
+_data_version = 0
+_data_version_lock = threading.Lock()
+
+def bump_data_version():
+    global _data_version
+    with _data_version_lock:
+        _data_version += 1
+
+def get_data_version():
+    return _data_version
+
+def get_db():
+    """Returns the connection of the current request, taking one from the pool on first use.
+
+    Every helper called during a request shares it, so a request uses at most
+    one connection. It goes back to the pool when the app context tears down.
+    """
+    if 'db' not in g:
+        try:
+            g.db, uses = _db_pool.get_nowait()
+        except queue.Empty:
+            g.db, uses = get_db_connection(), 0
+        g.db_uses = uses + 1
+        g.db_changes = g.db.total_changes
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop('db', None)
+    if conn is None:
+        return
+    uses = g.pop('db_uses', 1)
+    if conn.total_changes != g.pop('db_changes', 0):
+        # Any request that wrote (progress, favorites, tags, ...) invalidates cached pages
+        bump_data_version()
+    try:
+        if conn.in_transaction:
+            # Uncommitted work (e.g. a handler that raised) is discarded, as closing used to do
+            conn.rollback()
+    except sqlite3.Error:
+        conn.close()
+        return
+    if uses >= DB_CONNECTION_MAX_USES or _db_pool.qsize() >= DB_POOL_SIZE:
+        conn.close()
+    else:
+        _db_pool.put((conn, uses))
+
 def init_db():
+    """Brings the schema up to date; a single user_version check once the DB is current."""
     conn = get_db_connection()
-    
-    # 1. Basic Tables
-    conn.executescript('''
+    run_migrations(conn)
+    conn.close()
+
+# --- Schema Migrations ---
+# Applied in order, once each, in a transaction; PRAGMA user_version records how many have run.
+# Append new steps to MIGRATIONS, never reorder or edit applied ones.
+
+BASE_SCHEMA = '''
         CREATE TABLE IF NOT EXISTS courses (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             title TEXT NOT NULL,
@@ -323,7 +552,9 @@ def init_db():
             is_favorite BOOLEAN DEFAULT 0,
             description TEXT,
             alternate_title TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            source_type TEXT DEFAULT 'local',
+            source_url TEXT
         );
         
         CREATE TABLE IF NOT EXISTS modules (
@@ -342,6 +573,8 @@ def init_db():
             path TEXT NOT NULL,
             order_index INTEGER,
             duration REAL DEFAULT 0,
+            item_type TEXT DEFAULT 'video',
+            source_id TEXT,
             FOREIGN KEY (module_id) REFERENCES modules (id) ON DELETE CASCADE
         );
         
@@ -353,7 +586,8 @@ def init_db():
             address TEXT,
             profile_pic TEXT,
             rss_token TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_admin BOOLEAN DEFAULT 0
         );
         
         CREATE TABLE IF NOT EXISTS video_notes (
@@ -578,162 +812,687 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
         );
-    ''')
 
-    # Migrations
-    try:
-        conn.execute('SELECT item_type FROM videos LIMIT 1')
-    except sqlite3.OperationalError:
-        print("Migrating: Adding item_type to videos...")
-        conn.execute("ALTER TABLE videos ADD COLUMN item_type TEXT DEFAULT 'video'")
+        CREATE TABLE IF NOT EXISTS library_dirs (
+            path TEXT PRIMARY KEY, -- relative to COURSES_DIR
+            course_id INTEGER,
+            mtime_ns INTEGER,
+            inode INTEGER,
+            scanned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (course_id) REFERENCES courses (id) ON DELETE CASCADE
+        );
 
-    try:
-        conn.execute('SELECT profile_pic FROM users LIMIT 1')
-    except sqlite3.OperationalError:
-        print("Migrating: Adding profile_pic to users...")
-        conn.execute("ALTER TABLE users ADD COLUMN profile_pic TEXT")
+        CREATE TABLE IF NOT EXISTS course_resources (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            course_id INTEGER NOT NULL,
+            folder TEXT NOT NULL, -- directory relative to the course folder ('' for root)
+            name TEXT NOT NULL,
+            path TEXT NOT NULL, -- relative to the course folder
+            size INTEGER DEFAULT 0,
+            FOREIGN KEY (course_id) REFERENCES courses (id) ON DELETE CASCADE,
+            UNIQUE(course_id, path)
+        );
 
-    try:
-        conn.execute('SELECT rss_token FROM users LIMIT 1')
-    except sqlite3.OperationalError:
-        print("Migrating: Adding rss_token to users...")
-        conn.execute("ALTER TABLE users ADD COLUMN rss_token TEXT")
+        CREATE TABLE IF NOT EXISTS media_probes (
+            path TEXT PRIMARY KEY, -- relative to COURSES_DIR
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            duration REAL DEFAULT 0,
+            probed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+'''
 
-    try:
-        conn.execute('SELECT is_admin FROM users LIMIT 1')
-    except sqlite3.OperationalError:
-        print("Migrating: Adding is_admin to users...")
-        conn.execute("ALTER TABLE users ADD COLUMN is_admin BOOLEAN DEFAULT 0")
+def add_column_if_missing(conn, table, column, definition):
+    columns = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})').fetchall()}
+    if column in columns:
+        return False
+    print(f"Migrating: Adding {column} to {table}...")
+    conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return True
+
+def sql_statements(script):
+    """Splits a SQL script into statements; a ';' in a string, comment or trigger body doesn't end one.
+
+    Unlike executescript(), running these one by one keeps them inside the
+    migration's transaction.
+    """
+    statements, current = [], ''
+    for part in script.split(';'):
+        current += part + ';'
+        if sqlite3.complete_statement(current):
+            if current.strip(' \t\r\n;'):
+                statements.append(current.strip())
+            current = ''
+    return statements
+
+def migrate_base_schema(conn):
+    """Base tables."""
+    for statement in sql_statements(BASE_SCHEMA):
+        conn.execute(statement)
+
+def migrate_legacy_columns(conn):
+    """Columns added to existing tables before versioned migrations."""
+    add_column_if_missing(conn, 'videos', 'item_type', "TEXT DEFAULT 'video'")
+    add_column_if_missing(conn, 'users', 'profile_pic', 'TEXT')
+    add_column_if_missing(conn, 'users', 'rss_token', 'TEXT')
+    if add_column_if_missing(conn, 'users', 'is_admin', 'BOOLEAN DEFAULT 0'):
         # Make first user admin
         conn.execute("UPDATE users SET is_admin = 1 WHERE id = 1")
+    add_column_if_missing(conn, 'courses', 'source_type', "TEXT DEFAULT 'local'")
+    add_column_if_missing(conn, 'courses', 'source_url', 'TEXT')
+    add_column_if_missing(conn, 'videos', 'source_id', 'TEXT')
+
+
+def migrate_hot_indexes(conn):
+    """Indexes for the join/filter columns used by nearly every page."""
+    for sql in [
+        'CREATE INDEX IF NOT EXISTS idx_videos_path ON videos (path)',
+        'CREATE INDEX IF NOT EXISTS idx_videos_module ON videos (module_id, order_index)',
+        'CREATE INDEX IF NOT EXISTS idx_modules_course ON modules (course_id)',
+        'CREATE INDEX IF NOT EXISTS idx_video_progress_path ON video_progress (video_path)',
+        'CREATE INDEX IF NOT EXISTS idx_bookmarks_user_course ON bookmarks (user_id, course_id)',
+        'CREATE INDEX IF NOT EXISTS idx_flashcards_user_review ON flashcards (user_id, next_review_date)',
+        'CREATE INDEX IF NOT EXISTS idx_ai_logs_user_time ON ai_logs (user_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_comments_path ON comments (video_path, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_ai_content_user_path ON ai_generated_content (user_id, video_path)',
+    ]:
+        conn.execute(sql)
+
+def migrate_course_rollups(conn):
+    """Per-user course progress rollup (user_course_stats) and course totals."""
+    add_column_if_missing(conn, 'courses', 'total_videos', 'INTEGER DEFAULT 0')
+    add_column_if_missing(conn, 'courses', 'total_duration', 'REAL DEFAULT 0')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_course_stats (
+            user_id INTEGER NOT NULL, -- 0 for anonymous progress
+            course_id INTEGER NOT NULL,
+            watched_count INTEGER DEFAULT 0, -- videos with a video_progress row
+            watched_time REAL DEFAULT 0,
+            completed_count INTEGER DEFAULT 0, -- rows in watched_videos
+            PRIMARY KEY (user_id, course_id),
+            FOREIGN KEY (course_id) REFERENCES courses (id) ON DELETE CASCADE
+        )
+    ''')
+    for row in conn.execute('SELECT id FROM courses').fetchall():
+        refresh_course_rollups(conn, row['id'])
+
+def migrate_course_thumbnails(conn):
+    """Resolved cover/banner file stored on courses.thumbnail."""
+    add_column_if_missing(conn, 'courses', 'thumbnail', 'TEXT')
+    for row in conn.execute('SELECT id, folder_name FROM courses').fetchall():
+        conn.execute('UPDATE courses SET thumbnail = ? WHERE id = ?',
+                     (resolve_course_thumbnail(os.path.join(COURSES_DIR, row['folder_name'])), row['id']))
+
+def migrate_watch_intervals(conn):
+    """Per-video watched interval sets (video_watch_intervals), seeded from video_progress."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS video_watch_intervals (
+            user_id INTEGER NOT NULL, -- 0 for anonymous progress
+            video_path TEXT NOT NULL,
+            intervals BLOB, -- packed float32 (start, end) pairs, sorted and disjoint
+            covered REAL DEFAULT 0, -- total length of the intervals
+            PRIMARY KEY (user_id, video_path)
+        )
+    ''')
+    seed_watch_intervals(conn)
 
-    try:
-        conn.execute('SELECT source_type FROM courses LIMIT 1')
-    except sqlite3.OperationalError:
-        print("Migrating: Adding source_type to courses...")
-        conn.execute("ALTER TABLE courses ADD COLUMN source_type TEXT DEFAULT 'local'")
-        conn.execute("ALTER TABLE courses ADD COLUMN source_url TEXT")
-        
-    try:
-        conn.execute('SELECT source_id FROM videos LIMIT 1')
-    except sqlite3.OperationalError:
-        print("Migrating: Adding source_id to videos...")
-        conn.execute("ALTER TABLE videos ADD COLUMN source_id TEXT")
+def migrate_activity_state(conn):
+    """Per-user achievement counters (user_activity_state), rebuilt from daily_activity."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_activity_state (
+            user_id INTEGER PRIMARY KEY, -- 0 for anonymous progress
+            total_seconds REAL DEFAULT 0,
+            last_active_date TEXT, -- latest day with watch time
+            streak INTEGER DEFAULT 0, -- consecutive active days ending on last_active_date
+            weekday_mask INTEGER DEFAULT 0 -- bit n set once there was activity on weekday n (Monday = 0)
+        )
+    ''')
+    rebuild_activity_state(conn)
 
-    conn.commit()
-    conn.close()
+def migrate_transcript_index(conn):
+    """Full-text index of transcript cues (transcript_cues + transcript_fts), filled by the next scan."""
+    for sql in [
+        '''CREATE TABLE IF NOT EXISTS transcript_cues (
+            id INTEGER PRIMARY KEY,
+            video_path TEXT NOT NULL,
+            start_time REAL,
+            end_time REAL,
+            text TEXT
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_transcript_cues_path ON transcript_cues (video_path)',
+        # External-content FTS5 table over transcript_cues.text, kept in step by the triggers below
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS transcript_fts USING fts5(
+            text, content='transcript_cues', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )''',
+        '''CREATE TRIGGER IF NOT EXISTS transcript_cues_ai AFTER INSERT ON transcript_cues BEGIN
+            INSERT INTO transcript_fts (rowid, text) VALUES (new.id, new.text);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS transcript_cues_ad AFTER DELETE ON transcript_cues BEGIN
+            INSERT INTO transcript_fts (transcript_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END''',
+        # The subtitle file each video's cues were read from, to re-index only changed files
+        '''CREATE TABLE IF NOT EXISTS transcript_files (
+            video_path TEXT PRIMARY KEY,
+            file TEXT,
+            size INTEGER,
+            mtime_ns INTEGER
+        )''',
+    ]:
+        conn.execute(sql)
+    # Forget the directory fingerprints so the next scan walks every course and indexes its transcripts
+    conn.execute('DELETE FROM library_dirs')
+
+def migrate_search_index(conn):
+    """Full-text index of titles, descriptions, notes, bookmarks and AI summaries (search_index)."""
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+            title, body,
+            kind UNINDEXED, owner UNINDEXED, course_id UNINDEXED, video_path UNINDEXED,
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    ''')
+    for kind in SEARCH_SOURCES:
+        for sql in search_trigger_sql(kind):
+            conn.execute(sql)
+        # Backfill: the same expressions, evaluated over the existing rows
+        conn.execute(search_insert_sql(kind, 'src'))
+
+def migrate_embedding_vectors(conn):
+    """Embeddings as packed unit float32 vectors (video_embeddings.vector), converted from the JSON column."""
+    add_column_if_missing(conn, 'video_embeddings', 'vector', 'BLOB')
+    for row in conn.execute('SELECT video_path, embedding FROM video_embeddings WHERE embedding IS NOT NULL').fetchall():
+        try:
+            vector = pack_embedding(json.loads(row['embedding']))
+        except (TypeError, ValueError):
+            vector = None
+        conn.execute('UPDATE video_embeddings SET vector = ?, embedding = NULL WHERE video_path = ?', (vector, row['video_path']))
+
+MIGRATIONS = [
+    migrate_base_schema,
+    migrate_legacy_columns,
+    migrate_hot_indexes,
+    migrate_course_rollups,
+    migrate_course_thumbnails,
+    migrate_watch_intervals,
+    migrate_activity_state,
+    migrate_transcript_index,
+    migrate_search_index,
+    migrate_embedding_vectors,
+]
+
+def run_migrations(conn):
+    # Databases created before versioning start at 0; the first steps are idempotent for them
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        print(f"Migrating (v{number}): {step.__doc__.strip()}")
+        # Explicit BEGIN: sqlite3 doesn't open a transaction before DDL on its own
+        conn.execute('BEGIN')
+        try:
+            step(conn)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    if version < len(MIGRATIONS):
+        conn.execute('ANALYZE')
 
 def natural_sort_key(s):
     return [int(text) if text.isdigit() else text.lower()
             for text in re.split('([0-9]+)', s)]
 
-def scan_courses():
+def dir_fingerprint(path):
+    """Returns the (mtime_ns, inode) pair used to detect changes in a directory."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_ino)
+
+def course_dir_changed(cursor, course_id):
+    """True if any directory of the course was added, removed or modified since the last scan.
+
+    Only stats the directories recorded by the previous scan; adding, removing or
+    renaming an entry bumps the mtime of its parent, so new subfolders are caught too.
+    """
+    rows = cursor.execute('SELECT path, mtime_ns, inode FROM library_dirs WHERE course_id = ?', (course_id,)).fetchall()
+    if not rows:
+        return True
+    for row in rows:
+        if dir_fingerprint(os.path.join(COURSES_DIR, row['path'])) != (row['mtime_ns'], row['inode']):
+            return True
+    return False
+
+def save_course_fingerprints(cursor, course_id, course_path):
+    cursor.execute('DELETE FROM library_dirs WHERE course_id = ?', (course_id,))
+    rows = []
+    for root, dirs, files in os.walk(course_path):
+        fp = dir_fingerprint(root)
+        if fp:
+            rows.append((os.path.relpath(root, COURSES_DIR), course_id, fp[0], fp[1]))
+    cursor.executemany('INSERT OR REPLACE INTO library_dirs (path, course_id, mtime_ns, inode) VALUES (?, ?, ?, ?)', rows)
+
+def resolve_course_thumbnail(course_path):
+    """Returns the file name of the course's cover/banner image, or None.
+
+    One directory listing instead of a stat per candidate name. Adding or removing
+    artwork bumps the course folder's mtime, so the next scan re-resolves it.
+    """
+    try:
+        entries = set(os.listdir(course_path))
+    except OSError:
+        return None
+    return next((name for name in THUMBNAIL_NAMES if name in entries), None)
+
+def course_thumbnail_url(course_id, thumbnail, base_url=''):
+    return f"{base_url}/course_file/{course_id}/{thumbnail}" if thumbnail else None
+
+def remove_course(cursor, course_id):
+    """Deletes a course whose folder is gone; its modules, videos, resources and fingerprints cascade."""
+    for row in cursor.execute('SELECT v.path FROM videos v JOIN modules m ON v.module_id = m.id WHERE m.course_id = ?', (course_id,)).fetchall():
+        remove_transcript(cursor, row['path'])
+    cursor.execute('DELETE FROM courses WHERE id = ?', (course_id,))
+
+def scan_courses(folders=None):
+    """Incrementally syncs the courses/ folder with the database.
+
+    New top-level folders become courses; existing courses are only re-walked
+    when one of their directories changed since the last scan, and local
+    courses whose folder is gone are removed. When `folders` is given (e.g.
+    from the filesystem watcher) only those course folders are rescanned,
+    unconditionally.
+    """
     if not os.path.exists(COURSES_DIR):
         os.makedirs(COURSES_DIR)
     conn = get_db_connection()
     cursor = conn.cursor()
-    for folder_name in os.listdir(COURSES_DIR):
+    known = {}
+    local = {}  # Courses backed by a folder (not e.g. YouTube imports)
+    for row in cursor.execute('SELECT id, folder_name, source_type FROM courses').fetchall():
+        known[row['folder_name']] = row['id']
+        if (row['source_type'] or 'local') == 'local':
+            local[row['folder_name']] = row['id']
+    listing = os.listdir(COURSES_DIR) if folders is None else folders
+    present = {name for name in listing if os.path.isdir(os.path.join(COURSES_DIR, name))}
+    if folders is not None:
+        gone = [name for name in folders if name in local and name not in present]
+    elif present:
+        gone = [name for name in local if name not in present]
+    else:
+        gone = []  # An empty library is more likely an unmounted drive than every course deleted
+    for folder_name in gone:
+        remove_course(cursor, local[folder_name])
+        conn.commit()
+        invalidate_course_structure(local[folder_name])
+        bump_data_version()
+    for folder_name in listing:
+        if folder_name not in present:
+            continue
         course_path = os.path.join(COURSES_DIR, folder_name)
-        if os.path.isdir(course_path):
-            cursor.execute('SELECT id FROM courses WHERE folder_name = ?', (folder_name,))
-            course = cursor.fetchone()
-            if not course:
-                cursor.execute('INSERT INTO courses (title, folder_name) VALUES (?, ?)', (folder_name, folder_name))
-                course_id = cursor.lastrowid
-                scan_course_content(cursor, course_id, course_path)
+        course_id = known.get(folder_name)
+        if course_id is None:
+            cursor.execute('INSERT INTO courses (title, folder_name) VALUES (?, ?)', (folder_name, folder_name))
+            course_id = cursor.lastrowid
+        elif folders is None and not course_dir_changed(cursor, course_id):
+            continue
+        to_probe = scan_course_content(cursor, course_id, course_path)
+        sync_course_transcripts(cursor, course_id)
+        cursor.execute('UPDATE courses SET thumbnail = ? WHERE id = ?', (resolve_course_thumbnail(course_path), course_id))
+        save_course_fingerprints(cursor, course_id, course_path)
+        refresh_course_rollups(conn, course_id)
+        conn.commit()
+        invalidate_course_structure(course_id)
+        bump_data_version()
+        # Durations are filled in asynchronously once the rows are committed
+        queue_duration_probes(to_probe)
     conn.commit()
     conn.close()
 
+_scan_lock = threading.Lock()
+_last_scan_started = 0
+
+def request_library_scan(force=False):
+    """Starts scan_courses() in a background thread unless one is running or ran recently.
+
+    Never blocks the caller, so request handlers can use it freely. Does nothing
+    while the library watcher is running, since it already keeps the DB current.
+    """
+    global _last_scan_started
+    if _watcher_thread is not None and _watcher_thread.is_alive():
+        return False
+    if not force and time.time() - _last_scan_started < LIBRARY_SCAN_INTERVAL:
+        return False
+    if not _scan_lock.acquire(blocking=False):
+        return False
+    _last_scan_started = time.time()
+
+    def run():
+        try:
+            scan_courses()
+        except Exception as e:
+            print(f"Library scan failed: {e}")
+        finally:
+            _scan_lock.release()
+
+    threading.Thread(target=run, name="library-scan", daemon=True).start()
+    return True
+
+# --- Library Watcher ---
+# inotify event masks (see <sys/inotify.h>)
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+INOTIFY_EVENT = struct.Struct('iIII')
+
+_watcher_thread = None
+
+def _locked_scan(folders=None):
+    with _scan_lock:
+        try:
+            scan_courses(folders)
+        except Exception as e:
+            print(f"Library scan failed: {e}")
+
+def _inotify_watch():
+    """Watches COURSES_DIR with inotify and rescans the course folders that change.
+
+    Raises OSError if inotify is unavailable or the watch limit is hit, so the
+    caller can fall back to polling.
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    watches = {}
+
+    def add_watches(top):
+        for root, dirs, files in os.walk(top):
+            wd = libc.inotify_add_watch(fd, os.fsencode(root), IN_WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {root}")
+            watches[wd] = root
+
+    try:
+        add_watches(COURSES_DIR)
+        print(f"Library watcher: inotify on {len(watches)} directories")
+        _locked_scan()
+
+        dirty = set()
+        full_rescan = False
+        while True:
+            ready, _, _ = select.select([fd], [], [], LIBRARY_WATCH_DEBOUNCE if (dirty or full_rescan) else None)
+            if not ready:
+                # Quiet period after a burst of events: apply them
+                _locked_scan(None if full_rescan else sorted(dirty))
+                dirty.clear()
+                full_rescan = False
+                continue
+
+            buf = os.read(fd, 64 * 1024)
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buf, offset)
+                name = buf[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b'\0')
+                offset += INOTIFY_EVENT.size + length
+
+                if mask & IN_Q_OVERFLOW:
+                    full_rescan = True
+                    continue
+                if mask & IN_IGNORED:
+                    watches.pop(wd, None)
+                    continue
+                parent = watches.get(wd)
+                if parent is None:
+                    continue
+                path = os.path.join(parent, os.fsdecode(name)) if name else parent
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    add_watches(path)
+
+                rel = os.path.relpath(path, COURSES_DIR)
+                if rel == '.' or rel.startswith('..'):
+                    full_rescan = True
+                else:
+                    dirty.add(rel.split(os.sep)[0])
+    finally:
+        os.close(fd)
+
+def _poll_watch():
+    """Fallback watcher: periodically re-stats the recorded directory fingerprints."""
+    print(f"Library watcher: polling every {LIBRARY_POLL_INTERVAL}s")
+    while True:
+        _locked_scan()
+        time.sleep(LIBRARY_POLL_INTERVAL)
+
+def _library_watcher():
+    if not os.path.exists(COURSES_DIR):
+        os.makedirs(COURSES_DIR)
+    if os.environ.get('SKILLFORGE_WATCHER') != 'poll':
+        # Platforms without inotify fail to load or find it in libc and poll instead
+        try:
+            _inotify_watch()
+        except (OSError, AttributeError) as e:
+            print(f"Library watcher: inotify unavailable ({e}), falling back to polling")
+    _poll_watch()
+
+def start_library_watcher():
+    """Starts the background thread that keeps courses/modules/videos/resources in sync with disk."""
+    global _watcher_thread
+    if _watcher_thread is not None and _watcher_thread.is_alive():
+        return _watcher_thread
+    _watcher_thread = threading.Thread(target=_library_watcher, name="library-watcher", daemon=True)
+    _watcher_thread.start()
+    return _watcher_thread
+
+# --- Media Probing ---
+_probe_pool = None
+_probe_pending = set()
+_probe_lock = threading.Lock()
+
+def probe_media_duration(full_path):
+    """Reads a media file's duration with TinyTag, falling back to ffprobe for other containers."""
+    duration = 0
+    try:
+        duration = TinyTag.get(full_path).duration or 0
+    except Exception as e:
+        print(f"TinyTag could not read {full_path}: {e}")
+    if not duration and shutil.which('ffprobe'):
+        try:
+            result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+                                     '-of', 'default=noprint_wrappers=1:nokey=1', full_path],
+                                    capture_output=True, text=True, timeout=120)
+            duration = float(result.stdout.strip() or 0)
+        except (subprocess.SubprocessError, ValueError) as e:
+            print(f"ffprobe could not read {full_path}: {e}")
+    return duration
+
+def cached_probe_duration(cursor, rel_path, size, mtime_ns):
+    """Returns the stored duration for this exact file version, or None if it was never probed."""
+    row = cursor.execute('SELECT size, mtime_ns, duration FROM media_probes WHERE path = ?', (rel_path,)).fetchone()
+    if row and row['size'] == size and row['mtime_ns'] == mtime_ns:
+        return row['duration']
+    return None
+
+def _probe_job(rel_path, size, mtime_ns):
+    try:
+        duration = probe_media_duration(os.path.join(COURSES_DIR, rel_path))
+        conn = get_db_connection()
+        # Failed probes are stored too (duration 0) so the same file version is never probed twice
+        conn.execute('INSERT OR REPLACE INTO media_probes (path, size, mtime_ns, duration) VALUES (?, ?, ?, ?)',
+                     (rel_path, size, mtime_ns, duration))
+        if duration:
+            conn.execute('UPDATE videos SET duration = ? WHERE path = ? AND duration = 0', (duration, rel_path))
+            row = conn.execute('SELECT m.course_id FROM videos v JOIN modules m ON v.module_id = m.id WHERE v.path = ?', (rel_path,)).fetchone()
+            if row:
+                refresh_course_rollups(conn, row['course_id'])
+        conn.commit()
+        conn.close()
+        if duration:
+            if row:
+                invalidate_course_structure(row['course_id'])
+            bump_data_version()
+    except Exception as e:
+        print(f"Error probing duration for {rel_path}: {e}")
+    finally:
+        with _probe_lock:
+            _probe_pending.discard(rel_path)
+
+def queue_duration_probes(items):
+    """Submits (rel_path, size, mtime_ns) items to the bounded probe pool, skipping ones already queued."""
+    global _probe_pool
+    if not items:
+        return
+    with _probe_lock:
+        if _probe_pool is None:
+            _probe_pool = ThreadPoolExecutor(max_workers=PROBE_WORKERS, thread_name_prefix="media-probe")
+        for rel_path, size, mtime_ns in items:
+            if rel_path in _probe_pending:
+                continue
+            _probe_pending.add(rel_path)
+            _probe_pool.submit(_probe_job, rel_path, size, mtime_ns)
+
 def scan_course_content(cursor, course_id, course_path):
-    cursor.execute('SELECT path, duration FROM videos JOIN modules ON videos.module_id = modules.id WHERE modules.course_id = ?', (course_id,))
-    existing_durations = {row['path']: row['duration'] for row in cursor.fetchall()}
+    """Reconciles the modules/videos/resources of a course with what is on disk.
 
-    cursor.execute('DELETE FROM modules WHERE course_id = ?', (course_id,))
+    Rows are diffed by path so unchanged videos keep their IDs (and RSS guids);
+    only added, moved or removed entries are written, in batches.
+    Returns the (rel_path, size, mtime_ns) of videos whose duration is still unknown;
+    queue them with queue_duration_probes() after committing.
+    """
+    to_probe = []
+
+    # 1. What is on disk: [(module_title, [item, ...]), ...] in folder order, plus resources
+    disk_modules = []
+    disk_resources = {}
     for root, dirs, files in os.walk(course_path):
+        dirs.sort(key=natural_sort_key)
         if root == course_path:
             module_name = "General"
         else:
             module_name = os.path.basename(root)
-            
-        video_files = [f for f in files if f.lower().endswith(('.mp4', '.mkv', '.webm', '.mov'))]
+
+        folder = os.path.relpath(root, course_path)
+        if folder == '.':
+            folder = ''
+        for f in files:
+            if f.lower().endswith(NON_RESOURCE_EXTENSIONS):
+                continue
+            try:
+                size = os.path.getsize(os.path.join(root, f))
+            except OSError:
+                continue
+            disk_resources[os.path.join(folder, f)] = (folder, f, size)
+
+        video_files = [f for f in files if f.lower().endswith(VIDEO_EXTENSIONS)]
         video_files.sort(key=natural_sort_key)
         
-        # Check for Quiz
-        quiz_file = None
+        items = []
+        for idx, vf in enumerate(video_files):
+            rel_file_path = os.path.relpath(os.path.join(root, vf), COURSES_DIR)
+            items.append({'title': vf, 'filename': vf, 'path': rel_file_path, 'order_index': idx, 'item_type': 'video'})
+        
+        # Quiz goes at the end of the module
         if 'quiz.json' in files:
-            quiz_file = 'quiz.json'
+            rel_file_path = os.path.relpath(os.path.join(root, 'quiz.json'), COURSES_DIR)
+            items.append({'title': "📝 Quiz: " + module_name, 'filename': 'quiz.json', 'path': rel_file_path,
+                          'order_index': len(video_files), 'item_type': 'quiz'})
             
-        if video_files or quiz_file:
-            cursor.execute('INSERT INTO modules (course_id, title, order_index) VALUES (?, ?, ?)', (course_id, module_name, 0))
+        if items:
+            disk_modules.append((module_name, items))
+    # Same order as the course page; the sort is stable, so duplicate names keep their walk order
+    disk_modules.sort(key=lambda m: natural_sort_key(m[0]))
+
+    # 2. What is in the DB
+    db_modules = {}
+    db_module_order = {}
+    for row in cursor.execute('SELECT id, title, order_index FROM modules WHERE course_id = ? ORDER BY id', (course_id,)).fetchall():
+        db_modules.setdefault(row['title'], []).append(row['id'])
+        db_module_order[row['id']] = row['order_index']
+    db_videos = {}
+    stale_video_ids = []
+    for row in cursor.execute('''
+        SELECT v.id, v.module_id, v.title, v.filename, v.path, v.order_index, v.duration, v.item_type
+        FROM videos v JOIN modules m ON v.module_id = m.id
+        WHERE m.course_id = ?
+    ''', (course_id,)).fetchall():
+        if row['path'] in db_videos:
+            stale_video_ids.append((row['id'],))  # Duplicate left behind by older scans
+        else:
+            db_videos[row['path']] = row
+
+    # 3. Modules: match by title (in folder order for duplicate names), create the missing ones
+    kept_module_ids = set()
+    seen_titles = {}
+    video_inserts = []
+    video_updates = []
+    module_updates = []
+    for module_index, (module_name, items) in enumerate(disk_modules):
+        n = seen_titles.get(module_name, 0)
+        seen_titles[module_name] = n + 1
+        candidates = db_modules.get(module_name, [])
+        if n < len(candidates):
+            module_id = candidates[n]
+            if db_module_order[module_id] != module_index:
+                module_updates.append((module_index, module_id))
+        else:
+            cursor.execute('INSERT INTO modules (course_id, title, order_index) VALUES (?, ?, ?)', (course_id, module_name, module_index))
             module_id = cursor.lastrowid
-            
-            # Insert Videos
-            for idx, vf in enumerate(video_files):
-                full_path = os.path.join(root, vf)
-                rel_file_path = os.path.relpath(full_path, COURSES_DIR)
-                
-                duration = existing_durations.get(rel_file_path, 0)
-                if duration == 0:
-                    try:
-                        tag = TinyTag.get(full_path)
-                        duration = tag.duration or 0
-                    except Exception as e:
-                        print(f"Error reading duration for {full_path}: {e}")
-                        duration = 0
-
-                cursor.execute('INSERT INTO videos (module_id, title, filename, path, order_index, duration, item_type) VALUES (?, ?, ?, ?, ?, ?, ?)', 
-                               (module_id, vf, vf, rel_file_path, idx, duration, 'video'))
-            
-            # Insert Quiz (at end of module)
-            if quiz_file:
-                full_path = os.path.join(root, quiz_file)
-                rel_file_path = os.path.relpath(full_path, COURSES_DIR)
-                # Order index = len(video_files)
-                cursor.execute('INSERT INTO videos (module_id, title, filename, path, order_index, duration, item_type) VALUES (?, ?, ?, ?, ?, ?, ?)', 
-                               (module_id, "📝 Quiz: " + module_name, quiz_file, rel_file_path, len(video_files), 0, 'quiz'))
+        kept_module_ids.add(module_id)
+
+        for item in items:
+            existing = db_videos.pop(item['path'], None)
+            duration = existing['duration'] if existing else 0
+            if item['item_type'] == 'video' and not duration:
+                try:
+                    st = os.stat(os.path.join(COURSES_DIR, item['path']))
+                    cached = cached_probe_duration(cursor, item['path'], st.st_size, st.st_mtime_ns)
+                    if cached is None:
+                        to_probe.append((item['path'], st.st_size, st.st_mtime_ns))
+                    else:
+                        duration = cached
+                except OSError as e:
+                    print(f"Error reading {item['path']}: {e}")
+
+            row = (module_id, item['title'], item['filename'], item['order_index'], duration, item['item_type'])
+            if existing is None:
+                video_inserts.append(row + (item['path'],))
+            elif (existing['module_id'], existing['title'], existing['filename'], existing['order_index'],
+                  existing['duration'], existing['item_type']) != row:
+                video_updates.append(row + (existing['id'],))
+
+    # Whatever is left in db_videos no longer exists on disk
+    stale_video_ids.extend((row['id'],) for row in db_videos.values())
+    stale_module_ids = [(mid,) for ids in db_modules.values() for mid in ids if mid not in kept_module_ids]
+
+    cursor.executemany('DELETE FROM videos WHERE id = ?', stale_video_ids)
+    cursor.executemany('UPDATE videos SET module_id = ?, title = ?, filename = ?, order_index = ?, duration = ?, item_type = ? WHERE id = ?', video_updates)
+    cursor.executemany('INSERT INTO videos (module_id, title, filename, order_index, duration, item_type, path) VALUES (?, ?, ?, ?, ?, ?, ?)', video_inserts)
+    cursor.executemany('DELETE FROM videos WHERE module_id = ?', stale_module_ids)
+    cursor.executemany('DELETE FROM modules WHERE id = ?', stale_module_ids)
+    cursor.executemany('UPDATE modules SET order_index = ? WHERE id = ?', module_updates)
+
+    # 4. Resources
+    db_resources = {row['path']: (row['folder'], row['name'], row['size'])
+                    for row in cursor.execute('SELECT folder, name, path, size FROM course_resources WHERE course_id = ?', (course_id,)).fetchall()}
+    cursor.executemany('DELETE FROM course_resources WHERE course_id = ? AND path = ?',
+                       [(course_id, path) for path in db_resources if path not in disk_resources])
+    cursor.executemany('INSERT OR REPLACE INTO course_resources (course_id, folder, name, size, path) VALUES (?, ?, ?, ?, ?)',
+                       [(course_id,) + info + (path,) for path, info in disk_resources.items() if db_resources.get(path) != info])
+
+    return to_probe
 
 def get_current_user_id():
     return current_user.id if current_user.is_authenticated else None
 
-def get_course_stats(conn, course_id, user_id):
-    stats = conn.execute('''
-        SELECT 
-            COUNT(v.id) as total_videos,
-            SUM(v.duration) as total_duration
-        FROM videos v 
-        JOIN modules m ON v.module_id = m.id 
-        WHERE m.course_id = ?
-    ''', (course_id,)).fetchone()
-    
-    total_videos = stats['total_videos']
-    total_duration = stats['total_duration'] or 0
-    
-    watched_count = 0
-    watched_time = 0
-    
-    if user_id:
-        w_stats = conn.execute('''
-            SELECT 
-                COUNT(DISTINCT vp.video_path) as count,
-                SUM(CASE WHEN vp.is_completed THEN v.duration ELSE vp.watched_time END) as time
-            FROM video_progress vp
-            JOIN videos v ON vp.video_path = v.path
-            JOIN modules m ON v.module_id = m.id
-            WHERE m.course_id = ? AND vp.user_id = ?
-        ''', (course_id, user_id)).fetchone()
-        
-        if w_stats and w_stats['count']:
-            watched_count = w_stats['count']
-            watched_time = w_stats['time'] or 0
-        
-        if watched_count == 0:
-             legacy = conn.execute('SELECT COUNT(*) as count FROM watched_videos WHERE course_id = ? AND user_id = ?', (course_id, user_id)).fetchone()
-             if legacy and legacy['count'] > 0:
-                 watched_count = legacy['count']
-    else:
-        legacy = conn.execute('SELECT COUNT(*) as count FROM watched_videos WHERE course_id = ? AND user_id IS NULL', (course_id,)).fetchone()
-        watched_count = legacy['count']
-        
+def course_percentage(total_videos, total_duration, watched_count, watched_time):
     if total_duration > 0:
         percentage = int((watched_time / total_duration) * 100)
         if percentage == 0 and watched_count > 0:
@@ -742,28 +1501,1015 @@ def get_course_stats(conn, course_id, user_id):
         percentage = int((watched_count / total_videos) * 100)
     else:
         percentage = 0
-        
-    return {
-        'total_videos': total_videos,
-        'watched_count': watched_count,
-        'percentage': min(percentage, 100),
-        'total_duration': total_duration,
-        'watched_time': watched_time
+    return min(percentage, 100)
+
+def refresh_course_rollups(conn, course_id, user_ids=None):
+    """Recomputes a course's totals and its user_course_stats rows from the source tables.
+
+    Used by the scanner, probes and backfills; progress writes apply deltas with
+    bump_user_course_stats() instead. `user_ids` limits which user rows are rebuilt.
+    """
+    totals = conn.execute('''
+        SELECT COUNT(v.id) as total_videos, SUM(v.duration) as total_duration
+        FROM videos v JOIN modules m ON v.module_id = m.id
+        WHERE m.course_id = ?
+    ''', (course_id,)).fetchone()
+    conn.execute('UPDATE courses SET total_videos = ?, total_duration = ? WHERE id = ?',
+                 (totals['total_videos'], totals['total_duration'] or 0, course_id))
+
+    rollups = {}
+    for row in conn.execute('''
+        SELECT 
+            COALESCE(vp.user_id, 0) as uid,
+            COUNT(DISTINCT vp.video_path) as count,
+            SUM(CASE WHEN vp.is_completed THEN v.duration ELSE vp.watched_time END) as time
+        FROM video_progress vp
+        JOIN videos v ON vp.video_path = v.path
+        JOIN modules m ON v.module_id = m.id
+        WHERE m.course_id = ?
+        GROUP BY uid
+    ''', (course_id,)).fetchall():
+        rollups[row['uid']] = [row['count'], row['time'] or 0, 0]
+    for row in conn.execute('SELECT COALESCE(user_id, 0) as uid, COUNT(*) as count FROM watched_videos WHERE course_id = ? GROUP BY uid', (course_id,)).fetchall():
+        rollups.setdefault(row['uid'], [0, 0, 0])[2] = row['count']
+
+    if user_ids is None:
+        conn.execute('DELETE FROM user_course_stats WHERE course_id = ?', (course_id,))
+    else:
+        keys = {uid or 0 for uid in user_ids}
+        rollups = {uid: values for uid, values in rollups.items() if uid in keys}
+        conn.executemany('DELETE FROM user_course_stats WHERE user_id = ? AND course_id = ?', [(uid, course_id) for uid in keys])
+    conn.executemany('INSERT INTO user_course_stats (user_id, course_id, watched_count, watched_time, completed_count) VALUES (?, ?, ?, ?, ?)',
+                     [(uid, course_id, *values) for uid, values in rollups.items()])
+
+def bump_user_course_stats(conn, user_id, course_id, count_delta, time_delta, completed_delta):
+    """Applies a progress delta to the rollup row, building the row on first progress in a course."""
+    cur = conn.execute('''
+        UPDATE user_course_stats
+        SET watched_count = watched_count + ?, watched_time = watched_time + ?, completed_count = completed_count + ?
+        WHERE user_id = ? AND course_id = ?
+    ''', (count_delta, time_delta, completed_delta, user_id or 0, course_id))
+    if cur.rowcount == 0:
+        refresh_course_rollups(conn, course_id, [user_id])
+
+def get_all_course_stats(conn, user_id, course_id=None):
+    """Progress stats for every course (or just `course_id`) from the user_course_stats rollup
+    and the user's unflushed heartbeats.
+
+    Returns {course_id: {'total_videos', 'watched_count', 'percentage', 'total_duration', 'watched_time'}}.
+    """
+    course_filter = '' if course_id is None else 'WHERE c.id = ?'
+    params = (user_id or 0,) + (() if course_id is None else (course_id,))
+    rows = conn.execute(f'''
+        SELECT c.id, c.total_videos, c.total_duration, s.watched_count, s.watched_time, s.completed_count
+        FROM courses c
+        LEFT JOIN user_course_stats s ON s.course_id = c.id AND s.user_id = ?
+        {course_filter}
+    ''', params).fetchall()
+
+    # Unflushed heartbeats: a first row for the video and/or a later playhead
+    pending = {}
+    if user_id:
+        for row in buffered_progress_rows(conn, user_id)[0].values():
+            if not row['is_completed']:
+                delta = pending.setdefault(row['course_id'], [0, 0])
+                delta[0] += row['stored_time'] is None
+                delta[1] += row['watched_time'] - (row['stored_time'] or 0)
+
+    stats = {}
+    for row in rows:
+        total_videos = row['total_videos'] or 0
+        if not total_videos:
+            continue
+        total_duration = row['total_duration'] or 0
+        if user_id:
+            delta = pending.get(row['id'], (0, 0))
+            watched_count = (row['watched_count'] or 0) + delta[0]
+            watched_time = (row['watched_time'] or 0) + delta[1]
+        else:
+            # Anonymous progress only ever counted watched_videos
+            watched_count, watched_time = 0, 0
+        if watched_count == 0:
+            # Fall back to the legacy watched_videos table
+            watched_count = row['completed_count'] or 0
+        stats[row['id']] = {
+            'total_videos': total_videos,
+            'watched_count': watched_count,
+            'percentage': course_percentage(total_videos, total_duration, watched_count, watched_time),
+            'total_duration': total_duration,
+            'watched_time': watched_time
+        }
+    return stats
+
+EMPTY_COURSE_STATS = {'total_videos': 0, 'watched_count': 0, 'percentage': 0, 'total_duration': 0, 'watched_time': 0}
+
+# --- Watch Intervals ---
+# Each (user, video) keeps the ranges of the video actually played, merged into a
+# sorted, disjoint set. Watch time and completion come from how much of the video
+# the set covers, so seeks, rewatches and repeated pings never count twice.
+
+def interval_coverage(intervals):
+    return sum(end - start for start, end in intervals)
+
+def merge_intervals(intervals, segments, duration=0):
+    """Merges [(start, end)] segments into a sorted, disjoint interval list.
+
+    Segments are clamped to the video when its duration is known.
+    Returns (merged, added) where `added` is the newly covered length.
+    """
+    ranges = list(intervals)
+    for start, end in segments:
+        start = max(0.0, start)
+        if duration > 0:
+            end = min(end, duration)
+        if end > start:
+            ranges.append((start, end))
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + INTERVAL_MERGE_GAP:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged, max(0.0, interval_coverage(merged) - interval_coverage(intervals))
+
+def pack_intervals(intervals):
+    return struct.pack(f'<{2 * len(intervals)}f', *(point for interval in intervals for point in interval))
+
+def unpack_intervals(blob):
+    return list(struct.iter_unpack('<2f', blob)) if blob else []
+
+def is_covered(intervals, duration):
+    return duration > 0 and interval_coverage(intervals) >= COMPLETION_COVERAGE * duration
+
+def load_watch_intervals(conn, user_id, video_path):
+    row = conn.execute('SELECT intervals FROM video_watch_intervals WHERE user_id = ? AND video_path = ?', (user_id or 0, video_path)).fetchone()
+    return unpack_intervals(row['intervals']) if row else []
+
+def save_watch_intervals(conn, rows):
+    """Upserts [(user_id, video_path, intervals)]."""
+    conn.executemany('''
+        INSERT INTO video_watch_intervals (user_id, video_path, intervals, covered)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id, video_path) DO UPDATE SET
+            intervals = excluded.intervals,
+            covered = excluded.covered
+    ''', [(user_id or 0, video_path, pack_intervals(intervals), interval_coverage(intervals)) for user_id, video_path, intervals in rows])
+
+def seed_watch_intervals(conn):
+    """Gives video_progress rows without an interval set one assuming linear viewing.
+
+    A completed video counts as watched in full, otherwise [0, watched_time].
+    """
+    rows = conn.execute('''
+        SELECT vp.user_id, vp.video_path, MAX(vp.watched_time) as watched_time, MAX(vp.is_completed) as is_completed, MAX(v.duration) as duration
+        FROM video_progress vp
+        LEFT JOIN videos v ON v.path = vp.video_path
+        WHERE NOT EXISTS (
+            SELECT 1 FROM video_watch_intervals wi
+            WHERE wi.user_id = COALESCE(vp.user_id, 0) AND wi.video_path = vp.video_path
+        )
+        GROUP BY vp.user_id, vp.video_path
+    ''').fetchall()
+    seeded = []
+    for row in rows:
+        end = row['duration'] if row['is_completed'] and row['duration'] else row['watched_time'] or 0
+        seeded.append((row['user_id'], row['video_path'], [(0.0, end)] if end > 0 else []))
+    save_watch_intervals(conn, seeded)
+
+# --- Library Records ---
+
+class Course:
+    """A dashboard course card: the courses row plus the user's stats, tags and last video."""
+    __slots__ = ('id', 'title', 'folder_name', 'is_favorite', 'description', 'alternate_title', 'created_at',
+                 'source_type', 'source_url', 'thumbnail', 'total_videos', 'total_duration', 'watched_count',
+                 'watched_time', 'percentage', 'tags', 'last_video_title', 'last_video_path')
+
+    def __init__(self, row, stats, tags):
+        self.id = row['id']
+        self.title = row['title']
+        self.folder_name = row['folder_name']
+        self.is_favorite = row['is_favorite']
+        self.description = row['description']
+        self.alternate_title = row['alternate_title']
+        self.created_at = row['created_at']
+        self.source_type = row['source_type']
+        self.source_url = row['source_url']
+        self.thumbnail = course_thumbnail_url(row['id'], row['thumbnail'])
+        self.total_videos = stats['total_videos']
+        self.total_duration = stats['total_duration']
+        self.watched_count = stats['watched_count']
+        self.watched_time = stats['watched_time']
+        self.percentage = stats['percentage']
+        self.tags = tags
+        self.last_video_title = row['last_video_title']
+        self.last_video_path = row['last_video_path']
+
+class Video:
+    """A videos row. Shared through the course structure cache, so never mutated."""
+    __slots__ = ('id', 'module_id', 'title', 'filename', 'path', 'order_index', 'duration', 'item_type', 'source_id')
+
+    def __init__(self, row):
+        self.id = row['id']
+        self.module_id = row['module_id']
+        self.title = row['title']
+        self.filename = row['filename']
+        self.path = row['path']
+        self.order_index = row['order_index']
+        self.duration = row['duration']
+        self.item_type = row['item_type']
+        self.source_id = row['source_id']
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+class UserVideo:
+    """A cached Video seen by one user; video fields are read through from the shared record."""
+    __slots__ = ('video', 'watched_time', 'is_completed', 'mastery_score')
+
+    def __init__(self, video, watched_time=0, is_completed=False, mastery_score=0):
+        self.video = video
+        self.watched_time = watched_time
+        self.is_completed = is_completed
+        self.mastery_score = mastery_score
+
+    def to_dict(self):
+        d = self.video.to_dict()
+        d['watched_time'] = self.watched_time
+        d['is_completed'] = self.is_completed
+        d['mastery_score'] = self.mastery_score
+        return d
+
+# Read-through properties (rather than __getattr__, which templates would hit via AttributeError)
+for _name in Video.__slots__:
+    setattr(UserVideo, _name, property(attrgetter('video.' + _name)))
+
+class Resource:
+    __slots__ = ('name', 'path')
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+
+    def to_dict(self):
+        return {'name': self.name, 'path': self.path}
+
+class Module:
+    """A modules row with its videos and resources (tuples in the shared cache, lists per request)."""
+    __slots__ = ('id', 'course_id', 'title', 'order_index', 'videos', 'resources')
+
+    def __init__(self, id, course_id, title, order_index, videos=(), resources=()):
+        self.id = id
+        self.course_id = course_id
+        self.title = title
+        self.order_index = order_index
+        self.videos = videos
+        self.resources = resources
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row['id'], row['course_id'], row['title'], row['order_index'])
+
+    def replace(self, videos, resources):
+        return Module(self.id, self.course_id, self.title, self.order_index, videos, resources)
+
+    def to_dict(self):
+        return {
+            'id': self.id, 'course_id': self.course_id, 'title': self.title, 'order_index': self.order_index,
+            'videos': [v.to_dict() for v in self.videos],
+            'resources': [r.to_dict() for r in self.resources]
+        }
+
+# --- Course Structure Cache ---
+
+_course_cache = OrderedDict()  # course_id -> (weight, structure), least recently used first
+_course_cache_weight = 0
+_course_cache_generations = {}  # course_id -> times invalidated; guards against caching a tree read mid-scan
+_course_cache_lock = threading.Lock()
+
+def _load_course_structure(conn, course_id):
+    modules = [Module.from_row(row) for row in conn.execute('SELECT * FROM modules WHERE course_id = ? ORDER BY order_index', (course_id,)).fetchall()]
+    videos_by_module = {module.id: [] for module in modules}
+    for row in conn.execute('''
+        SELECT v.* FROM videos v JOIN modules m ON v.module_id = m.id
+        WHERE m.course_id = ? ORDER BY v.order_index
+    ''', (course_id,)).fetchall():
+        videos_by_module[row['module_id']].append(Video(row))
+
+    resources_by_folder = {}
+    for r in conn.execute('SELECT folder, name, path FROM course_resources WHERE course_id = ? ORDER BY name', (course_id,)).fetchall():
+        resources_by_folder.setdefault(r['folder'], []).append(Resource(r['name'], r['path']))
+
+    for module in modules:
+        module.videos = tuple(videos_by_module[module.id])
+        # Resources live directly in the module folder (course root for "General")
+        folder = '' if module.title == "General" else module.title
+        module.resources = tuple(resources_by_folder.get(folder, []))
+    return tuple(modules)
+
+def get_course_structure(conn, course_id):
+    """Shared Module records of a course (by order_index) holding tuples of Video and Resource records.
+
+    Shared by every request until the scanner changes the course; callers that
+    need per-user fields should go through load_course_tree().
+    """
+    global _course_cache_weight
+    with _course_cache_lock:
+        entry = _course_cache.get(course_id)
+        if entry:
+            _course_cache.move_to_end(course_id)
+            return entry[1]
+        generation = _course_cache_generations.get(course_id, 0)
+
+    structure = _load_course_structure(conn, course_id)
+    weight = len(structure) + sum(len(m.videos) + len(m.resources) for m in structure)
+    with _course_cache_lock:
+        if _course_cache_generations.get(course_id, 0) == generation and course_id not in _course_cache:
+            _course_cache[course_id] = (weight, structure)
+            _course_cache_weight += weight
+            while _course_cache_weight > COURSE_CACHE_MAX_ITEMS and _course_cache:
+                _course_cache_weight -= _course_cache.popitem(last=False)[1][0]
+    return structure
+
+def invalidate_course_structure(course_id):
+    global _course_cache_weight
+    with _course_cache_lock:
+        _course_cache_generations[course_id] = _course_cache_generations.get(course_id, 0) + 1
+        entry = _course_cache.pop(course_id, None)
+        if entry:
+            _course_cache_weight -= entry[0]
+
+def load_course_tree(conn, course_id, user_id=None, with_resources=False):
+    """Per-request Module records whose videos are UserVideo overlays on the cached structure.
+
+    Every video carries the user's watched_time (including unflushed
+    heartbeats), is_completed and mastery_score (zeros without a user_id); with_resources fills each module's resources as
+    plain dicts, ready for the template's tojson.
+    """
+    vp_map = {}
+    mastery_map = {}
+    if user_id:
+        for r in conn.execute('''
+            SELECT vp.video_path, vp.watched_time, vp.is_completed 
+            FROM video_progress vp 
+            JOIN videos v ON vp.video_path = v.path 
+            JOIN modules m ON v.module_id = m.id 
+            WHERE m.course_id = ? AND vp.user_id = ?
+        ''', (course_id, user_id)).fetchall():
+            vp_map[r['video_path']] = r
+        for r in conn.execute('''
+            SELECT vm.video_path, vm.score
+            FROM video_mastery vm
+            JOIN videos v ON vm.video_path = v.path
+            JOIN modules m ON v.module_id = m.id
+            WHERE m.course_id = ? AND vm.user_id = ?
+        ''', (course_id, user_id)).fetchall():
+            mastery_map[r['video_path']] = r['score']
+        for path, row in buffered_progress_rows(conn, user_id)[0].items():
+            if row['course_id'] == course_id:
+                vp_map[path] = row
+
+    modules = []
+    for cached in get_course_structure(conn, course_id):
+        videos = []
+        for v in cached.videos:
+            prog = vp_map.get(v.path)
+            if prog:
+                videos.append(UserVideo(v, prog['watched_time'], prog['is_completed'], mastery_map.get(v.path, 0)))
+            else:
+                videos.append(UserVideo(v, mastery_score=mastery_map.get(v.path, 0)))
+        resources = [r.to_dict() for r in cached.resources] if with_resources else []
+        modules.append(cached.replace(videos, resources))
+    return modules
+
+# --- Image Derivatives ---
+
+_image_digests = {}  # abs path -> (size, mtime_ns, content digest)
+
+def image_digest(path, st):
+    """Content hash of an image, re-read only when its size or mtime changes."""
+    cached = _image_digests.get(path)
+    if cached and cached[:2] == (st.st_size, st.st_mtime_ns):
+        return cached[2]
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    digest = h.hexdigest()[:24]
+    _image_digests[path] = (st.st_size, st.st_mtime_ns, digest)
+    return digest
+
+def image_bucket(width):
+    for bucket in IMAGE_WIDTH_BUCKETS:
+        if width <= bucket:
+            return bucket
+    return IMAGE_WIDTH_BUCKETS[-1]
+
+def image_variant(path, width, fmt):
+    """Returns (cache path, etag) of `path` resized to `width` as `fmt` ('webp' or 'jpeg').
+
+    Variants are generated once and named after the source's content hash, so
+    identical files share them and a replaced file never hits a stale variant.
+    Returns None if the source can't be decoded.
+    """
+    st = os.stat(path)
+    name = f"{image_digest(path, st)}-{width}.{fmt}"
+    etag = name.replace('.', '-')
+    cache_path = os.path.join(IMAGE_CACHE_DIR, name)
+    if os.path.exists(cache_path):
+        return cache_path, etag
+    try:
+        with Image.open(path) as img:
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((width, width * 4))
+            if img.mode not in ('RGB', 'RGBA') or fmt == 'jpeg':
+                img = img.convert('RGBA' if fmt == 'webp' and 'A' in img.getbands() else 'RGB')
+            os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+            tmp_path = f"{cache_path}.{uuid.uuid4().hex[:8]}.tmp"
+            if fmt == 'webp':
+                img.save(tmp_path, 'WEBP', quality=IMAGE_QUALITY, method=4)
+            else:
+                img.save(tmp_path, 'JPEG', quality=IMAGE_QUALITY, optimize=True, progressive=True)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        print(f"Image resize failed for {path}: {e}")
+        return None
+    return cache_path, etag
+
+def serve_image(directory, filename, max_age, public=False):
+    """Serves an image, or its resized variant when a ?w= width is given.
+
+    Only `public` images (course artwork) may be kept by shared caches; user
+    uploads such as snapshots and profile pictures are private to the browser.
+    """
+    path = safe_join(os.path.join(app.root_path, directory), filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    width = request.args.get('w', type=int)
+    variant = None
+    if width and Image is not None and filename.lower().endswith(IMAGE_EXTENSIONS):
+        fmt = 'webp' if 'image/webp' in request.accept_mimetypes.values() else 'jpeg'
+        variant = image_variant(path, image_bucket(width), fmt)
+    if variant:
+        response = send_file(variant[0], mimetype=f'image/{fmt}', etag=variant[1], max_age=max_age, conditional=True)
+        response.vary.add('Accept')
+    else:
+        response = send_file(path, max_age=max_age, conditional=True)
+    # send_file marks every response with a max_age public
+    response.cache_control.public = public
+    response.cache_control.private = not public
+    if max_age >= SNAPSHOT_IMAGE_MAX_AGE:
+        response.cache_control.immutable = True
+    return response
+
+# --- Dashboard Cache ---
+
+_dashboard_cache = OrderedDict()  # user_id -> ((data version, buffer seq, date), etag, html), least recently used first
+_dashboard_cache_lock = threading.Lock()
+
+def get_cached_dashboard(user_id, version):
+    with _dashboard_cache_lock:
+        entry = _dashboard_cache.get(user_id)
+        if entry is None or entry[0] != version:
+            return None
+        _dashboard_cache.move_to_end(user_id)
+        return entry
+
+def cache_dashboard(user_id, version, html):
+    entry = (version, hashlib.sha1(html.encode('utf-8')).hexdigest(), html)
+    with _dashboard_cache_lock:
+        _dashboard_cache[user_id] = entry
+        _dashboard_cache.move_to_end(user_id)
+        while len(_dashboard_cache) > DASHBOARD_CACHE_SIZE:
+            _dashboard_cache.popitem(last=False)
+    return entry
+
+def dashboard_response(entry):
+    response = make_response(entry[2])
+    response.set_etag(entry[1])
+    # Browsers may keep the page but must revalidate; unchanged dashboards get a 304
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
+
+# --- Transcript Index ---
+# The cues of every video's subtitle file live in transcript_cues, full-text
+# indexed by transcript_fts. The scanner re-reads a subtitle file only when its
+# name, size or mtime changed; transcript generation indexes the file it writes.
+
+def subtitle_file_for(video_path, entries=None):
+    """Full path of the video's .vtt/.srt file, or None. `entries` is an optional listing of its folder."""
+    base = os.path.splitext(os.path.join(COURSES_DIR, video_path))[0]
+    for ext in SUBTITLE_EXTENSIONS:
+        if (os.path.exists(base + ext) if entries is None else os.path.basename(base) + ext in entries):
+            return base + ext
+    return None
+
+def subtitle_fingerprint(subtitle_path):
+    st = os.stat(subtitle_path)
+    return (os.path.basename(subtitle_path), st.st_size, st.st_mtime_ns)
+
+def _index_cues(cursor, video_path, subtitle_path, fingerprint):
+    cursor.execute('DELETE FROM transcript_cues WHERE video_path = ?', (video_path,))
+    try:
+        with open(subtitle_path, 'r', encoding='utf-8', errors='ignore') as f:
+            cursor.executemany('INSERT INTO transcript_cues (video_path, start_time, end_time, text) VALUES (?, ?, ?, ?)',
+                               ((video_path, start, end, text.strip()) for start, end, text in iter_subtitle_cues(f) if text.strip()))
+    except Exception as e:
+        # Still record the fingerprint so an unparsable file isn't retried on every scan
+        print(f"Could not index transcript {subtitle_path}: {e}")
+        cursor.execute('DELETE FROM transcript_cues WHERE video_path = ?', (video_path,))
+    cursor.execute('INSERT OR REPLACE INTO transcript_files (video_path, file, size, mtime_ns) VALUES (?, ?, ?, ?)', (video_path,) + fingerprint)
+
+def remove_transcript(cursor, video_path):
+    cursor.execute('DELETE FROM transcript_cues WHERE video_path = ?', (video_path,))
+    cursor.execute('DELETE FROM transcript_files WHERE video_path = ?', (video_path,))
+
+def index_transcript(conn, video_path):
+    """(Re)indexes one video's transcript, e.g. right after generating it. The caller commits."""
+    subtitle_path = subtitle_file_for(video_path)
+    if subtitle_path is None:
+        remove_transcript(conn, video_path)
+    else:
+        _index_cues(conn, video_path, subtitle_path, subtitle_fingerprint(subtitle_path))
+
+def write_transcript(video_path, content):
+    """Saves a generated WebVTT transcript next to the video and indexes its cues."""
+    with open(os.path.splitext(os.path.join(COURSES_DIR, video_path))[0] + ".vtt", 'w', encoding='utf-8') as f:
+        f.write(content)
+    invalidate_transcript(video_path)
+    conn = get_db()
+    index_transcript(conn, video_path)
+    conn.commit()
+
+def sync_course_transcripts(cursor, course_id):
+    """Brings a course's cues in line with the subtitle files on disk; one listing per folder."""
+    indexed = {row['video_path']: (row['file'], row['size'], row['mtime_ns']) for row in cursor.execute('''
+        SELECT tf.video_path, tf.file, tf.size, tf.mtime_ns FROM transcript_files tf
+        JOIN videos v ON v.path = tf.video_path
+        JOIN modules m ON v.module_id = m.id
+        WHERE m.course_id = ?
+    ''', (course_id,)).fetchall()}
+    listings = {}
+    for path in {row['path'] for row in cursor.execute('SELECT v.path FROM videos v JOIN modules m ON v.module_id = m.id WHERE m.course_id = ?', (course_id,)).fetchall()}:
+        folder = os.path.dirname(os.path.join(COURSES_DIR, path))
+        if folder not in listings:
+            try:
+                listings[folder] = set(os.listdir(folder))
+            except OSError:
+                listings[folder] = set()
+        subtitle_path = subtitle_file_for(path, listings[folder])
+        if subtitle_path is None:
+            if path in indexed:
+                remove_transcript(cursor, path)
+            continue
+        try:
+            fingerprint = subtitle_fingerprint(subtitle_path)
+        except OSError:
+            continue
+        if indexed.get(path) != fingerprint:
+            _index_cues(cursor, path, subtitle_path, fingerprint)
+    # Videos removed from the library (from any course) take their cues with them
+    for row in cursor.execute('SELECT video_path FROM transcript_files WHERE video_path NOT IN (SELECT path FROM videos)').fetchall():
+        remove_transcript(cursor, row['video_path'])
+
+def fts_query(text):
+    """Turns search box input into an FTS5 query.
+
+    Words are AND-ed, "quoted phrases" stay phrases and a trailing * makes a
+    prefix query. Everything else is dropped, so user input can't produce an
+    FTS5 syntax error.
+    """
+    terms = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', text):
+        tokens = re.findall(r'\w+', phrase or word)
+        if tokens:
+            terms.append('"' + ' '.join(tokens) + '"' + ('*' if word.endswith('*') else ''))
+    return ' '.join(terms)
+
+def highlight_snippet(snippet):
+    """Escapes an FTS5 snippet and turns its match markers (chr(2)/chr(3)) into <mark> tags."""
+    return escape(snippet).replace('\x02', Markup('<mark>')).replace('\x03', Markup('</mark>'))
+
+def search_transcripts(conn, query, page=1, per_page=TRANSCRIPT_PAGE_SIZE):
+    """Returns (hits, has_more): one page of transcript cues matching `query`, best first."""
+    match = fts_query(query)
+    if not match:
+        return [], False
+    try:
+        rows = conn.execute('''
+            SELECT c.video_path, c.start_time, c.end_time, hit.snippet
+            FROM (
+                SELECT rowid, rank, snippet(transcript_fts, 0, char(2), char(3), '…', 16) as snippet
+                FROM transcript_fts WHERE transcript_fts MATCH ?
+                ORDER BY rank LIMIT ? OFFSET ?
+            ) hit
+            JOIN transcript_cues c ON c.id = hit.rowid
+            ORDER BY hit.rank
+        ''', (match, per_page + 1, (page - 1) * per_page)).fetchall()
+    except sqlite3.OperationalError as e:
+        print(f"Transcript search failed for {match!r}: {e}")
+        return [], False
+
+    paths = list({row['video_path'] for row in rows})
+    videos = {}
+    if paths:
+        for row in conn.execute(f'''
+            SELECT v.path, v.title as video_title, c.title as course_title, c.id as course_id
+            FROM videos v
+            JOIN modules m ON v.module_id = m.id
+            JOIN courses c ON m.course_id = c.id
+            WHERE v.path IN ({','.join('?' * len(paths))})
+        ''', paths).fetchall():
+            videos[row['path']] = row
+    hits = []
+    for row in rows[:per_page]:
+        video = videos.get(row['video_path'])
+        if video is None:
+            continue
+        hits.append({
+            'course_id': video['course_id'],
+            'course_title': video['course_title'],
+            'video_title': video['video_title'],
+            'video_path': row['video_path'],
+            'timestamp': row['start_time'],
+            'end': row['end_time'],
+            'timestamp_str': format_time(row['start_time']),
+            'snippet': highlight_snippet(row['snippet'])
+        })
+    return hits, len(rows) > per_page
+
+# --- Transcript Store ---
+# Parsed subtitle files, kept in memory as parallel start/end arrays plus one
+# text blob, so the player, the subtitle track and the AI prompts never re-read
+# or re-parse a file that hasn't changed on disk.
+
+class Transcript:
+    """The cues of one subtitle file in columnar form; shared between requests, so never mutated."""
+    __slots__ = ('starts', 'ends', 'offsets', 'text', 'etag')
+
+    def __init__(self, cues, fingerprint):
+        """`cues` is any iterable of (start, end, text), consumed once."""
+        self.starts = array('d')
+        self.ends = array('d')
+        self.offsets = array('I', [0])  # Cue i's text is text[offsets[i]:offsets[i + 1]]
+        parts = []
+        for start, end, text in cues:
+            self.starts.append(start)
+            self.ends.append(end)
+            parts.append(text)
+            self.offsets.append(self.offsets[-1] + len(text))
+        self.text = ''.join(parts)
+        self.etag = hashlib.sha1(repr(fingerprint).encode('utf-8')).hexdigest()[:20]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def cue_text(self, i):
+        return self.text[self.offsets[i]:self.offsets[i + 1]]
+
+    def to_json(self):
+        return [{'start': self.starts[i], 'text': self.cue_text(i)} for i in range(len(self))]
+
+    def to_vtt(self):
+        out = ["WEBVTT\n\n"]
+        for i in range(len(self)):
+            out.append(f"{format_vtt_timestamp(self.starts[i])} --> {format_vtt_timestamp(self.ends[i])}\n{self.cue_text(i)}\n\n")
+        return ''.join(out)
+
+    def to_text(self, timestamps=True):
+        """One line per cue, prefixed with its [MM:SS] start unless timestamps is False."""
+        if not timestamps:
+            return '\n'.join(self.cue_text(i).strip() for i in range(len(self)))
+        return '\n'.join(f"[{format_time(self.starts[i])}] {self.cue_text(i).strip()}" for i in range(len(self)))
+
+_transcripts = OrderedDict()  # video_path -> (fingerprint, Transcript), least recently used first
+_transcripts_cues = 0
+_transcripts_lock = threading.Lock()
+
+def get_transcript_cues(video_path):
+    """The video's parsed Transcript, or None without a subtitle file.
+
+    A file is parsed once and served from memory until its name, size or mtime
+    changes; the least recently used transcripts are dropped past
+    TRANSCRIPT_CACHE_MAX_CUES.
+    """
+    global _transcripts_cues
+    subtitle_path = subtitle_file_for(video_path)
+    if subtitle_path is None:
+        return None
+    try:
+        fingerprint = subtitle_fingerprint(subtitle_path)
+    except OSError:
+        return None
+    with _transcripts_lock:
+        entry = _transcripts.get(video_path)
+        if entry and entry[0] == fingerprint:
+            _transcripts.move_to_end(video_path)
+            return entry[1]
+
+    try:
+        with open(subtitle_path, 'r', encoding='utf-8', errors='ignore') as f:
+            transcript = Transcript(iter_subtitle_cues(f), fingerprint)
+    except OSError:
+        return None
+    with _transcripts_lock:
+        old = _transcripts.pop(video_path, None)
+        if old:
+            _transcripts_cues -= len(old[1])
+        _transcripts[video_path] = (fingerprint, transcript)
+        _transcripts_cues += len(transcript)
+        while _transcripts_cues > TRANSCRIPT_CACHE_MAX_CUES and len(_transcripts) > 1:
+            _transcripts_cues -= len(_transcripts.popitem(last=False)[1][1])
+    return transcript
+
+def invalidate_transcript(video_path):
+    global _transcripts_cues
+    with _transcripts_lock:
+        entry = _transcripts.pop(video_path, None)
+        if entry:
+            _transcripts_cues -= len(entry[1])
+
+def transcript_response(transcript, render, mimetype):
+    """Serves render() of `transcript`; clients revalidate and get a 304, without rendering, while the file is unchanged."""
+    etag = f"{transcript.etag}-{mimetype.split('/')[-1]}"
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(render())
+        response.mimetype = mimetype
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# --- Library Search ---
+# search_index holds one FTS5 row per searchable record, kept in sync by triggers
+# on the source tables. Its rowid is the source id * 8 + the kind's code, so a
+# trigger can replace or drop a record's entry without scanning the index.
+# `owner` is NULL for library entries and the user id (0 = anonymous) for
+# personal ones, which only their owner can find. The SQL expressions of each
+# source refer to the record as {row}.
+
+SEARCH_SOURCES = {
+    'course': {'table': 'courses', 'code': 1, 'columns': 'title, alternate_title, description',
+               'title': "{row}.title || COALESCE(' ' || {row}.alternate_title, '')", 'body': '{row}.description',
+               'owner': 'NULL', 'course_id': '{row}.id', 'video_path': 'NULL', 'when': '1'},
+    'module': {'table': 'modules', 'code': 2, 'columns': 'title, course_id',
+               'title': '{row}.title', 'body': 'NULL',
+               'owner': 'NULL', 'course_id': '{row}.course_id', 'video_path': 'NULL', 'when': '1'},
+    'video': {'table': 'videos', 'code': 3, 'columns': 'title, module_id, path',
+              'title': '{row}.title', 'body': 'NULL', 'owner': 'NULL',
+              'course_id': '(SELECT course_id FROM modules WHERE id = {row}.module_id)', 'video_path': '{row}.path', 'when': '1'},
+    'note': {'table': 'video_notes', 'code': 4, 'columns': 'content, video_path',
+             'title': 'NULL', 'body': '{row}.content', 'owner': 'COALESCE({row}.user_id, 0)',
+             'course_id': '(SELECT m.course_id FROM videos v JOIN modules m ON v.module_id = m.id WHERE v.path = {row}.video_path LIMIT 1)',
+             'video_path': '{row}.video_path', 'when': '1'},
+    'bookmark': {'table': 'bookmarks', 'code': 5, 'columns': 'note, course_id, video_path',
+                 'title': 'NULL', 'body': '{row}.note', 'owner': 'COALESCE({row}.user_id, 0)',
+                 'course_id': '{row}.course_id', 'video_path': '{row}.video_path', 'when': '1'},
+    # Only the prose outputs; quizzes and flashcards are JSON
+    'ai': {'table': 'ai_generated_content', 'code': 6, 'columns': 'content, content_type, video_path',
+           'title': 'NULL', 'body': '{row}.content', 'owner': 'COALESCE({row}.user_id, 0)',
+           'course_id': '(SELECT m.course_id FROM videos v JOIN modules m ON v.module_id = m.id WHERE v.path = {row}.video_path LIMIT 1)',
+           'video_path': '{row}.video_path', 'when': "{row}.content_type IN ('summarize', 'glossary')"},
+}
+
+def search_insert_sql(kind, row='NEW'):
+    """INSERT ... SELECT of index entries for `row`: a trigger's NEW row, or any other alias to read the whole source table."""
+    source = SEARCH_SOURCES[kind]
+    expr = {key: source[key].format(row=row) for key in ('title', 'body', 'owner', 'course_id', 'video_path', 'when')}
+    select_from = '' if row == 'NEW' else f" FROM {source['table']} {row}"
+    return (f"INSERT INTO search_index (rowid, title, body, kind, owner, course_id, video_path) "
+            f"SELECT {row}.id * 8 + {source['code']}, {expr['title']}, {expr['body']}, "
+            f"'{kind}', {expr['owner']}, {expr['course_id']}, {expr['video_path']}{select_from} WHERE {expr['when']}")
+
+def search_trigger_sql(kind):
+    source = SEARCH_SOURCES[kind]
+    table, code = source['table'], source['code']
+    insert = search_insert_sql(kind)
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {table}_search_ai AFTER INSERT ON {table} BEGIN {insert}; END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_search_au AFTER UPDATE OF {source['columns']} ON {table} BEGIN "
+        f"DELETE FROM search_index WHERE rowid = OLD.id * 8 + {code}; {insert}; END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_search_ad AFTER DELETE ON {table} BEGIN "
+        f"DELETE FROM search_index WHERE rowid = OLD.id * 8 + {code}; END",
+    ]
+
+SEARCH_TYPES = tuple(SEARCH_SOURCES) + ('transcript',)
+
+def _search_hits_sql(match, user_id, types, course_id):
+    """UNION of matching index entries and transcript cues as (type, ref, course_id, video_path, snippet, score).
+
+    Returns (sql, params), or (None, None) if no requested type is searchable.
+    """
+    course_filter = ' AND course_id = ?' if course_id is not None else ''
+    kinds = [kind for kind in types if kind in SEARCH_SOURCES]
+    parts, params = [], []
+    if kinds:
+        # Titles weigh ten times as much as bodies
+        parts.append(f'''
+            SELECT kind as type, rowid >> 3 as ref, course_id, video_path,
+                   snippet(search_index, -1, char(2), char(3), '…', 16) as snippet,
+                   bm25(search_index, 10.0, 1.0) as score
+            FROM search_index
+            WHERE search_index MATCH ? AND (owner IS NULL OR owner = ?)
+              AND kind IN ({','.join('?' * len(kinds))}){course_filter}
+        ''')
+        # Anonymous records are indexed with owner 0
+        params += [match, user_id or 0] + kinds + ([course_id] if course_id is not None else [])
+    if 'transcript' in types:
+        parts.append(f'''
+            SELECT 'transcript' as type, c.id as ref, m.course_id, c.video_path,
+                   snippet(transcript_fts, 0, char(2), char(3), '…', 16) as snippet,
+                   bm25(transcript_fts) as score
+            FROM transcript_fts
+            JOIN transcript_cues c ON c.id = transcript_fts.rowid
+            JOIN videos v ON v.path = c.video_path
+            JOIN modules m ON v.module_id = m.id
+            WHERE transcript_fts MATCH ?{course_filter.replace('course_id', 'm.course_id')}
+        ''')
+        params += [match] + ([course_id] if course_id is not None else [])
+    if not parts:
+        return None, None
+    return ' UNION ALL '.join(parts), params
+
+def search_library(conn, query, user_id, types=SEARCH_TYPES, course_id=None, page=1, per_page=20):
+    """One page of BM25-ranked hits across the library, the user's own records and transcripts.
+
+    Returns (hits, facets, has_more). Each hit is a dict with type, id, title,
+    snippet (escaped HTML with <mark> around matches), course_id, course_title,
+    video_path and, for bookmarks and transcript cues, timestamp. facets counts
+    all matches per type and per course.
+    """
+    match = fts_query(query)
+    union, params = _search_hits_sql(match, user_id, types, course_id) if match else (None, None)
+    if union is None:
+        return [], {'types': {}, 'courses': []}, False
+    try:
+        rows = conn.execute(f'SELECT * FROM ({union}) ORDER BY score LIMIT ? OFFSET ?',
+                            params + [per_page + 1, (page - 1) * per_page]).fetchall()
+        type_counts = {row['type']: row['n'] for row in conn.execute(f'SELECT type, COUNT(*) as n FROM ({union}) GROUP BY type', params).fetchall()}
+        course_counts = conn.execute(f'''
+            SELECT hits.course_id, c.title, COUNT(*) as n FROM ({union}) hits
+            JOIN courses c ON c.id = hits.course_id
+            GROUP BY hits.course_id ORDER BY n DESC
+        ''', params).fetchall()
+    except sqlite3.OperationalError as e:
+        print(f"Search failed for {match!r}: {e}")
+        return [], {'types': {}, 'courses': []}, False
+    facets = {'types': type_counts,
+              'courses': [{'course_id': row['course_id'], 'title': row['title'], 'count': row['n']} for row in course_counts]}
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    # Resolve display fields with one query per kind present on the page
+    refs = {}
+    for row in rows:
+        refs.setdefault(row['type'], []).append(row['ref'])
+    def fetch(sql, ids):
+        return {r['id']: r for r in conn.execute(sql.format(','.join('?' * len(ids))), ids).fetchall()} if ids else {}
+    details = {
+        'course': fetch('SELECT id, title FROM courses WHERE id IN ({})', refs.get('course')),
+        'module': fetch('SELECT id, title FROM modules WHERE id IN ({})', refs.get('module')),
+        'video': fetch('SELECT id, title FROM videos WHERE id IN ({})', refs.get('video')),
+        'note': fetch('SELECT id, content as title FROM video_notes WHERE id IN ({})', refs.get('note')),
+        'bookmark': fetch('SELECT id, note as title, timestamp FROM bookmarks WHERE id IN ({})', refs.get('bookmark')),
+        'ai': fetch('SELECT id, content_type as title FROM ai_generated_content WHERE id IN ({})', refs.get('ai')),
+        'transcript': fetch('SELECT id, start_time as timestamp FROM transcript_cues WHERE id IN ({})', refs.get('transcript')),
     }
+    course_ids = list({row['course_id'] for row in rows if row['course_id'] is not None})
+    course_titles = {r['id']: r['title'] for r in fetch('SELECT id, title FROM courses WHERE id IN ({})', course_ids).values()}
+    paths = list({row['video_path'] for row in rows if row['video_path']})
+    video_titles = {}
+    if paths:
+        video_titles = {r['path']: r['title'] for r in conn.execute(f'SELECT path, title FROM videos WHERE path IN ({",".join("?" * len(paths))})', paths).fetchall()}
+
+    hits = []
+    for row in rows:
+        detail = details[row['type']].get(row['ref'])
+        if detail is None:
+            continue
+        hit = {
+            'type': row['type'],
+            'id': row['ref'],
+            'title': video_titles.get(row['video_path']) if row['type'] in ('note', 'bookmark', 'ai', 'transcript') else detail['title'],
+            'snippet': highlight_snippet(row['snippet']),
+            'course_id': row['course_id'],
+            'course_title': course_titles.get(row['course_id']),
+            'video_path': row['video_path'],
+            'score': row['score'],
+        }
+        if row['type'] == 'ai':
+            hit['content_type'] = detail['title']
+        if 'timestamp' in detail.keys():
+            hit['timestamp'] = detail['timestamp']
+        hits.append(hit)
+    return hits, facets, has_more
+
+# --- Embedding Store ---
+# Video embeddings are stored as packed, L2-normalised float32 vectors, so a
+# dot product is their cosine similarity. Semantic search scores a query
+# against all of them at once from an in-memory matrix (a NumPy array, or a
+# list of tuples without NumPy) that only reads rows added since its last load.
+
+def pack_embedding(values):
+    """Little-endian float32 blob of `values` scaled to unit length, or None for an empty/zero vector."""
+    norm = math.sqrt(sum(v * v for v in values))
+    if not norm:
+        return None
+    return struct.pack(f'<{len(values)}f', *(v / norm for v in values))
+
+def unpack_embedding(blob):
+    return struct.unpack(f'<{len(blob) // 4}f', blob)
+
+EMPTY_EMBEDDINGS = {'rowid': 0, 'paths': (), 'matrix': None}
+_embeddings = EMPTY_EMBEDDINGS  # Replaced wholesale, never mutated
+_embeddings_lock = threading.Lock()
+
+def _embedding_rows(blobs):
+    if np is not None:
+        return np.frombuffer(b''.join(blobs), dtype='<f4').reshape(len(blobs), -1)
+    return [unpack_embedding(blob) for blob in blobs]
+
+def get_embedding_matrix(conn):
+    """(paths, matrix) of every stored embedding, row i of the matrix belonging to paths[i].
+
+    Rows inserted since the last call (by rowid) are appended; code that
+    deletes or replaces embeddings calls invalidate_embeddings(). Vectors
+    whose dimension differs from the first one's are left out.
+    """
+    global _embeddings
+    with _embeddings_lock:
+        state = _embeddings
+        max_rowid = conn.execute('SELECT max(rowid) FROM video_embeddings').fetchone()[0] or 0
+        if max_rowid == state['rowid']:
+            return state['paths'], state['matrix']
+
+        paths, blobs = [], []
+        dim = len(state['matrix'][0]) if state['paths'] else None
+        for row in conn.execute('SELECT video_path, vector FROM video_embeddings WHERE rowid > ? AND rowid <= ? ORDER BY rowid',
+                                (state['rowid'], max_rowid)):
+            if not row['vector']:
+                continue
+            dim = dim or len(row['vector']) // 4
+            if len(row['vector']) == dim * 4:
+                paths.append(row['video_path'])
+                blobs.append(row['vector'])
+        matrix = state['matrix']
+        if blobs:
+            rows = _embedding_rows(blobs)
+            if matrix is None:
+                matrix = rows
+            elif np is not None:
+                matrix = np.vstack((matrix, rows))
+            else:
+                matrix = matrix + rows
+        _embeddings = {'rowid': max_rowid, 'paths': state['paths'] + tuple(paths), 'matrix': matrix}
+        return _embeddings['paths'], _embeddings['matrix']
+
+def invalidate_embeddings():
+    global _embeddings
+    with _embeddings_lock:
+        _embeddings = EMPTY_EMBEDDINGS
+
+def nearest_embeddings(conn, values, k=10):
+    """[(score, video_path)] of the k stored embeddings most similar to `values`, best first."""
+    query = pack_embedding(values) if values else None
+    paths, matrix = get_embedding_matrix(conn)
+    if query is None or not paths or len(query) != len(matrix[0]) * 4:
+        return []
+    k = min(k, len(paths))
+    if np is None:
+        query = unpack_embedding(query)
+        scored = ((sum(a * b for a, b in zip(query, row)), path) for path, row in zip(paths, matrix))
+        return heapq.nlargest(k, scored)
+    scores = matrix @ np.frombuffer(query, dtype='<f4')
+    top = np.argpartition(scores, len(scores) - k)[-k:]
+    top = top[np.argsort(scores[top])[::-1]]
+    return [(float(scores[i]), paths[i]) for i in top]
 
 # --- Routes ---
 
 @app.route('/')
 def index():
-    scan_courses()
-    conn = get_db_connection()
+    request_library_scan()
     user_id = get_current_user_id()
+    conn = get_db()
+    buffered, _, buffered_seq = buffered_progress_rows(conn, user_id)
+    # Read before querying so a write that lands mid-render leaves this entry stale;
+    # unflushed heartbeats and a new day (daily review, streaks) change the page
+    # without changing the data version
+    version = (get_data_version(), buffered_seq, datetime.date.today())
+    cached = get_cached_dashboard(user_id, version)
+    if cached:
+        return dashboard_response(cached)
     
     continue_watching = []
     if user_id:
         cw_rows = conn.execute('''
             SELECT v.title as video_title, v.path as video_path, v.duration, v.order_index,
-                   c.title as course_title, c.id as course_id,
+                   c.title as course_title, c.id as course_id, c.thumbnail as course_thumbnail,
                    vp.watched_time, vp.updated_at
             FROM video_progress vp
             JOIN videos v ON vp.video_path = v.path
@@ -771,26 +2517,18 @@ def index():
             JOIN courses c ON m.course_id = c.id
             WHERE vp.user_id = ? AND vp.is_completed = 0 AND vp.watched_time > 0
             ORDER BY vp.updated_at DESC
-            LIMIT 4
-        ''', (user_id,)).fetchall()
+            LIMIT ?
+        ''', (user_id, 4 + len(buffered))).fetchall()
+        # Buffered videos were played after anything stored, most recent heartbeat first
+        recent = [dict(row, video_path=row['path'], updated_at=None)
+                  for row in sorted(buffered.values(), key=lambda row: row['seq'], reverse=True)
+                  if not row['is_completed'] and row['watched_time'] > 0]
+        recent += [dict(row) for row in cw_rows if row['video_path'] not in buffered]
         
-        for row in cw_rows:
-            item = dict(row)
+        for item in recent[:4]:
             pct = int((item['watched_time'] / item['duration'] * 100)) if item['duration'] > 0 else 0
             item['percentage'] = pct
-            
-            course_folder_row = conn.execute('SELECT folder_name FROM courses WHERE id=?', (item['course_id'],)).fetchone()
-            if course_folder_row:
-                course_folder = os.path.join(COURSES_DIR, course_folder_row['folder_name'])
-                thumb_url = None
-                for ext in ['jpg', 'png', 'jpeg', 'webp']:
-                    if os.path.exists(os.path.join(course_folder, f"cover.{ext}")):
-                         thumb_url = f"/course_file/{item['course_id']}/cover.{ext}"
-                         break
-                    if os.path.exists(os.path.join(course_folder, f"banner.{ext}")):
-                         thumb_url = f"/course_file/{item['course_id']}/banner.{ext}"
-                         break
-                item['thumbnail'] = thumb_url
+            item['thumbnail'] = course_thumbnail_url(item['course_id'], item['course_thumbnail'])
             continue_watching.append(item)
 
     if user_id:
@@ -846,54 +2584,37 @@ def index():
     except:
         pass # Table might not exist yet if migration hasn't run on fresh start
 
+    all_stats = get_all_course_stats(conn, user_id)
+    last_videos = buffered_last_videos(buffered)
     courses_data = []
     for row in courses_rows:
-        course = dict(row)
-        stats = get_course_stats(conn, course['id'], user_id)
-        course.update(stats)
-        course['tags'] = course_tags_map.get(course['id'], [])
-        
-        course_folder = os.path.join(COURSES_DIR, course['folder_name'])
-        thumb_url = None
-        for ext in ['jpg', 'png', 'jpeg', 'webp']:
-            if os.path.exists(os.path.join(course_folder, f"cover.{ext}")):
-                 thumb_url = f"/course_file/{course['id']}/cover.{ext}"
-                 break
-            if os.path.exists(os.path.join(course_folder, f"banner.{ext}")):
-                 thumb_url = f"/course_file/{course['id']}/banner.{ext}"
-                 break
-        
-        course['thumbnail'] = thumb_url
-        courses_data.append(course)
+        if row['id'] in last_videos:
+            row = dict(row, last_video_title=last_videos[row['id']]['title'], last_video_path=last_videos[row['id']]['path'])
+        courses_data.append(Course(row, all_stats.get(row['id'], EMPTY_COURSE_STATS), course_tags_map.get(row['id'], [])))
         
     all_tags = []
     try:
         all_tags = [dict(r) for r in conn.execute('SELECT * FROM tags ORDER BY name').fetchall()]
     except: pass
 
-    conn.close()
-    return render_template('index.html', courses=courses_data, continue_watching=continue_watching, daily_review=daily_review, all_tags=all_tags)
+    html = render_template('index.html', courses=courses_data, continue_watching=continue_watching, daily_review=daily_review, all_tags=all_tags)
+    return dashboard_response(cache_dashboard(user_id, version, html))
 
 @app.route('/search')
 def search_page():
     q = request.args.get('q', '').strip()
     semantic = request.args.get('semantic') == 'true'
-    results = {'videos': [], 'notes': [], 'transcripts': []}
+    transcript_page = max(1, request.args.get('tpage', 1, type=int))
+    results = {'videos': [], 'notes': [], 'transcripts': [], 'transcripts_more': False}
     
     if q:
-        conn = get_db_connection()
+        conn = get_db()
         user_id = get_current_user_id()
         
         # Standard keyword search
-        v_rows = conn.execute('''
-            SELECT v.title, v.path, c.title as course_title, c.id as course_id 
-            FROM videos v
-            JOIN modules m ON v.module_id = m.id
-            JOIN courses c ON m.course_id = c.id
-            WHERE v.title LIKE ?
-            LIMIT 20
-        ''', (f'%{q}%',)).fetchall()
-        results['videos'] = [dict(r) for r in v_rows]
+        v_hits, _, _ = search_library(conn, q, user_id, types=('video',))
+        results['videos'] = [{'title': h['title'], 'path': h['video_path'], 'course_title': h['course_title'], 'course_id': h['course_id']}
+                             for h in v_hits]
         
         # Semantic Search Logic
         if semantic and user_id:
@@ -903,17 +2624,7 @@ def search_page():
             if api_key:
                 q_emb = get_embedding(q, api_key)
                 if q_emb:
-                    emb_rows = conn.execute('SELECT video_path, embedding FROM video_embeddings').fetchall()
-                    scores = []
-                    for row in emb_rows:
-                        try:
-                            v_emb = json.loads(row['embedding'])
-                            score = cosine_similarity(q_emb, v_emb)
-                            scores.append((score, row['video_path']))
-                        except: pass
-                    
-                    scores.sort(key=lambda x: x[0], reverse=True)
-                    top_paths = [x[1] for x in scores[:10]] # Top 10
+                    top_paths = [path for score, path in nearest_embeddings(conn, q_emb, 10)]
                     
                     if top_paths:
                         placeholders = ','.join(['?'] * len(top_paths))
@@ -939,126 +2650,54 @@ def search_page():
                         results['videos'] = ordered_results + [r for r in results['videos'] if r['path'] not in top_paths]
 
         if user_id:
-            n_rows = conn.execute('''
-                SELECT vn.content, vn.video_path, v.title as video_title, c.title as course_title, c.id as course_id
-                FROM video_notes vn
-                JOIN videos v ON vn.video_path = v.path
-                JOIN modules m ON v.module_id = m.id
-                JOIN courses c ON m.course_id = c.id
-                WHERE vn.user_id = ? AND vn.content LIKE ?
-                LIMIT 20
-            ''', (user_id, f'%{q}%')).fetchall()
-            results['notes'] = [dict(r) for r in n_rows]
+            n_hits, _, _ = search_library(conn, q, user_id, types=('note',))
+            results['notes'] = [{'snippet': h['snippet'], 'video_path': h['video_path'], 'video_title': h['title'],
+                                 'course_title': h['course_title'], 'course_id': h['course_id']} for h in n_hits]
             
         # Global Transcript Search
-        results['transcripts'] = search_all_transcripts(q, conn)
-        conn.close()
+        results['transcripts'], results['transcripts_more'] = search_transcripts(conn, q, transcript_page)
         
-    return render_template('search.html', query=q, results=results)
+    return render_template('search.html', query=q, results=results, transcript_page=transcript_page)
 
-def search_all_transcripts(query, conn):
-    matches = []
-    query_lower = query.lower()
-    
-    # We'll use the DB to find all videos, then check their subtitle files
-    videos = conn.execute('''
-        SELECT v.path, v.title as video_title, c.title as course_title, c.id as course_id 
-        FROM videos v
-        JOIN modules m ON v.module_id = m.id
-        JOIN courses c ON m.course_id = c.id
-    ''').fetchall()
-    
-    for v in videos:
-        full_path = os.path.join(COURSES_DIR, v['path'])
-        base_path = os.path.splitext(full_path)[0]
-        
-        sub_file = None
-        for ext in ['.vtt', '.srt']:
-            if os.path.exists(base_path + ext):
-                sub_file = base_path + ext
-                break
-        
-        if sub_file:
-            try:
-                with open(sub_file, 'r', encoding='utf-8', errors='ignore') as f:
-                    content = f.read()
-                    if query_lower in content.lower():
-                        # Find specific timestamps
-                        # This is a bit heavy, but works for personal collections
-                        blocks = content.strip().split('\n\n')
-                        for block in blocks:
-                            if query_lower in block.lower():
-                                lines = block.split('\n')
-                                if len(lines) >= 2:
-                                    ts_line = lines[1] if lines[0].isdigit() else lines[0]
-                                    if '-->' in ts_line:
-                                        time_str = ts_line.split('-->')[0].strip().replace(',', '.')
-                                        # Convert to seconds for jumping
-                                        parts = time_str.split(':')
-                                        seconds = 0
-                                        if len(parts) == 3: # HH:MM:SS.mmm
-                                            seconds = int(parts[0]) * 3600 + int(parts[1]) * 60 + float(parts[2])
-                                        elif len(parts) == 2: # MM:SS.mmm
-                                            seconds = int(parts[0]) * 60 + float(parts[1])
-                                        
-                                        text = " ".join(lines[lines.index(ts_line)+1:])
-                                        matches.append({
-                                            'course_id': v['course_id'],
-                                            'course_title': v['course_title'],
-                                            'video_title': v['video_title'],
-                                            'video_path': v['path'],
-                                            'timestamp': seconds,
-                                            'timestamp_str': time_str.split('.')[0],
-                                            'snippet': text
-                                        })
-                                        if len(matches) >= 30: return matches # Cap results
-            except:
-                pass
-    return matches
+@app.route('/api/search')
+def api_search():
+    """Unified search: /api/search?q=...&types=video,note&course_id=3&page=2&per_page=20
 
+    Returns BM25-ranked hits of every type (courses, modules, videos, the user's
+    notes, bookmarks and AI summaries, transcript cues) with per-type and
+    per-course counts. `types` and `course_id` narrow the hits; the facets
+    always describe the narrowed set.
+    """
+    q = request.args.get('q', '').strip()
+    types = tuple(t for t in request.args.get('types', '').split(',') if t in SEARCH_TYPES) or SEARCH_TYPES
+    course_id = request.args.get('course_id', type=int)
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = min(max(1, request.args.get('per_page', 20, type=int)), 100)
+    conn = get_db()
+    hits, facets, has_more = search_library(conn, q, get_current_user_id(), types, course_id, page, per_page)
+    return jsonify({"query": q, "page": page, "per_page": per_page, "has_more": has_more, "results": hits, "facets": facets})
 
 @app.route('/subtitle/<path:video_path>')
 def serve_subtitle(video_path):
-    full_path = os.path.join(COURSES_DIR, video_path)
-    base_path = os.path.splitext(full_path)[0]
-    
-    vtt_path = base_path + ".vtt"
-    srt_path = base_path + ".srt"
-    
-    if os.path.exists(vtt_path):
-        return send_file(vtt_path, mimetype='text/vtt')
-    elif os.path.exists(srt_path):
-        with open(srt_path, 'r', encoding='utf-8', errors='ignore') as f:
-            content = f.read()
-            vtt_content = srt_to_vtt(content)
-            return vtt_content, 200, {'Content-Type': 'text/vtt'}
-            
-    return "", 404
+    transcript = get_transcript_cues(video_path)
+    if transcript is None:
+        return "", 404
+    return transcript_response(transcript, transcript.to_vtt, 'text/vtt')
 
 @app.route('/api/transcript/<path:video_path>')
 def get_transcript(video_path):
-    full_path = os.path.join(COURSES_DIR, video_path)
-    base_path = os.path.splitext(full_path)[0]
-    
-    vtt_path = base_path + ".vtt"
-    srt_path = base_path + ".srt"
-    
-    content = ""
-    if os.path.exists(vtt_path):
-        with open(vtt_path, 'r', encoding='utf-8', errors='ignore') as f:
-            content = f.read()
-    elif os.path.exists(srt_path):
-        with open(srt_path, 'r', encoding='utf-8', errors='ignore') as f:
-            content = f.read()
-    
-    if content:
-        return jsonify(parse_subtitle_to_json(content))
-    return jsonify([])
+    """The video's cues as JSON ([{start, text}]), or as plain text with ?format=text."""
+    transcript = get_transcript_cues(video_path)
+    if transcript is None:
+        return jsonify([])
+    if request.args.get('format') == 'text':
+        return transcript_response(transcript, transcript.to_text, 'text/plain')
+    return transcript_response(transcript, lambda: json.dumps(transcript.to_json()), 'application/json')
 
 @app.route('/settings')
 @login_required
 def settings():
-    conn = get_db_connection()
+    conn = get_db()
     user_id = get_current_user_id()
     
     # Get API Key & Model & AI Enabled Status
@@ -1093,9 +2732,10 @@ def settings():
 
     courses_query = conn.execute('SELECT id, title, description, alternate_title FROM courses ORDER BY title').fetchall()
     
+    all_stats = get_all_course_stats(conn, user_id)
     courses_data = []
     for c in courses_query:
-        stats = get_course_stats(conn, c['id'], user_id)
+        stats = all_stats.get(c['id'], EMPTY_COURSE_STATS)
         courses_data.append({
             'id': c['id'],
             'title': c['title'],
@@ -1105,69 +2745,18 @@ def settings():
             'watched_count': stats['watched_count'],
             'percentage': stats['percentage']
         })
-    conn.close()
     return render_template('settings.html', courses=courses_data, api_key=api_key, gemini_model=gemini_model, local_model=local_model, ai_enabled=ai_enabled, ai_provider=ai_provider, local_ai_url=local_ai_url, local_whisper_url=local_whisper_url, quiz_correct=quiz_correct, quiz_total=quiz_total, daily_goal=daily_goal, rss_token=rss_token)
 
 @app.route('/course/<int:course_id>')
 def player(course_id):
-    conn = get_db_connection()
+    conn = get_db()
     user_id = get_current_user_id()
     
     course = conn.execute('SELECT * FROM courses WHERE id = ?', (course_id,)).fetchone()
     if not course:
         abort(404)
-    modules = conn.execute('SELECT * FROM modules WHERE course_id = ? ORDER BY title', (course_id,)).fetchall()
-    structure = []
-    
-    course_root = os.path.join(COURSES_DIR, course['folder_name'])
-    
-    vp_map = {}
-    mastery_map = {}
-    if user_id:
-        vp_rows = conn.execute('''
-            SELECT vp.video_path, vp.watched_time, vp.is_completed 
-            FROM video_progress vp 
-            JOIN videos v ON vp.video_path = v.path 
-            JOIN modules m ON v.module_id = m.id 
-            WHERE m.course_id = ? AND vp.user_id = ?
-        ''', (course_id, user_id)).fetchall()
-        for r in vp_rows:
-            vp_map[r['video_path']] = {'watched_time': r['watched_time'], 'is_completed': r['is_completed']}
-
-        # Fetch mastery scores
-        m_rows = conn.execute('SELECT video_path, score FROM video_mastery WHERE user_id = ?', (user_id,)).fetchall()
-        for r in m_rows:
-            mastery_map[r['video_path']] = r['score']
-
-    for module in modules:
-        videos = conn.execute('SELECT * FROM videos WHERE module_id = ? ORDER BY order_index', (module['id'],)).fetchall()
-        mod_dict = dict(module)
-        mod_dict['videos'] = []
-        for v in videos:
-            v_dict = dict(v)
-            prog = vp_map.get(v['path'], {'watched_time': 0, 'is_completed': False})
-            v_dict['watched_time'] = prog['watched_time']
-            v_dict['is_completed'] = prog['is_completed']
-            v_dict['mastery_score'] = mastery_map.get(v['path'], 0)
-            mod_dict['videos'].append(v_dict)
-        
-        res_files = []
-        if module['title'] == "General":
-             mod_path = course_root
-        else:
-             mod_path = os.path.join(course_root, module['title'])
-             
-        if os.path.exists(mod_path):
-             for f in os.listdir(mod_path):
-                 if os.path.isfile(os.path.join(mod_path, f)):
-                     if not f.lower().endswith(('.mp4', '.mkv', '.webm', '.mov', '.ds_store', '.vtt', '.srt')):
-                         rel = os.path.relpath(os.path.join(mod_path, f), course_root)
-                         res_files.append({'name': f, 'path': rel})
-        
-        mod_dict['resources'] = res_files
-        structure.append(mod_dict)
-        
-    structure.sort(key=lambda x: natural_sort_key(x['title']))
+    structure = load_course_tree(conn, course_id, user_id, with_resources=True)
+    structure.sort(key=lambda x: natural_sort_key(x.title))
     
     if user_id:
         progress = conn.execute('SELECT * FROM course_progress WHERE course_id = ? AND user_id = ?', (course_id, user_id)).fetchone()
@@ -1178,9 +2767,12 @@ def player(course_id):
 
     last_played_path = progress['last_video_path'] if progress else None
     last_timestamp = progress['last_video_timestamp'] if progress and progress['last_video_timestamp'] else 0
+    last_buffered = buffered_last_videos(buffered_progress_rows(conn, user_id)[0]).get(course_id)
+    if last_buffered:
+        last_played_path, last_timestamp = last_buffered['path'], last_buffered['position']
     watched_paths = [row['video_path'] for row in watched_rows]
     
-    total_videos = conn.execute('SELECT COUNT(*) as count FROM videos v JOIN modules m ON v.module_id = m.id WHERE m.course_id = ?', (course_id,)).fetchone()['count']
+    total_videos = sum(len(module.videos) for module in structure)
     is_completed = (len(watched_paths) >= total_videos and total_videos > 0)
     
     # Check if AI is enabled
@@ -1197,7 +2789,6 @@ def player(course_id):
         user_row = conn.execute('SELECT rss_token FROM users WHERE id=?', (user_id,)).fetchone()
         rss_token = user_row['rss_token'] if user_row else None
 
-    conn.close()
     return render_template('player.html', course=course, structure=structure, 
                            last_played_path=last_played_path, 
                            last_timestamp=last_timestamp,
@@ -1213,13 +2804,18 @@ def serve_media(filename):
 
 @app.route('/course_file/<int:course_id>/<path:filename>')
 def serve_course_file(course_id, filename):
-    conn = get_db_connection()
+    conn = get_db()
     course = conn.execute('SELECT folder_name FROM courses WHERE id = ?', (course_id,)).fetchone()
-    conn.close()
     if not course:
         abort(404)
+    if 'w' in request.args:
+        return serve_image(os.path.join(COURSES_DIR, course['folder_name']), filename, COURSE_IMAGE_MAX_AGE, public=True)
     return send_from_directory(os.path.join(COURSES_DIR, course['folder_name']), filename)
 
+@app.route('/snapshots/<path:filename>')
+def serve_snapshot(filename):
+    return serve_image(SNAPSHOTS_DIR, filename, SNAPSHOT_IMAGE_MAX_AGE)
+
 # --- Auth Routes ---
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -1228,9 +2824,8 @@ def login():
         username = request.form['username']
         password = request.form['password']
         
-        conn = get_db_connection()
+        conn = get_db()
         user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-        conn.close()
         
         if user and check_password_hash(user['password_hash'], password):
             user_obj = User(user['id'], user['username'], user['name'], user['address'])
@@ -1249,17 +2844,15 @@ def register():
         name = request.form['name']
         address = request.form['address']
         
-        conn = get_db_connection()
+        conn = get_db()
         try:
             hashed_pw = generate_password_hash(password)
             conn.execute('INSERT INTO users (username, password_hash, name, address) VALUES (?, ?, ?, ?)',
                          (username, hashed_pw, name, address))
             conn.commit()
-            conn.close()
             flash('Registration successful! Please login.')
             return redirect(url_for('login'))
         except sqlite3.IntegrityError:
-            conn.close()
             flash('Username already exists.')
             
     return render_template('register.html')
@@ -1278,7 +2871,7 @@ def admin_dashboard():
     if not current_user.is_admin:
         abort(403)
         
-    conn = get_db_connection()
+    conn = get_db()
     users = conn.execute('SELECT * FROM users').fetchall()
     
     users_data = []
@@ -1289,10 +2882,9 @@ def admin_dashboard():
             'username': u['username'],
             'name': u['name'],
             'joined': u['created_at'],
-            'total_time': stats['t'] or 0,
+            'total_time': (stats['t'] or 0) + sum(buffered_user_progress(u['id'])[1].values()),
             'completed': stats['c'] or 0
         })
-    conn.close()
     return render_template('admin.html', users=users_data)
 
 @app.route('/api/admin/reset_password', methods=['POST'])
@@ -1303,11 +2895,10 @@ def admin_reset_password():
     user_id = request.json.get('user_id')
     new_pass = request.json.get('password')
     
-    conn = get_db_connection()
+    conn = get_db()
     hashed = generate_password_hash(new_pass)
     conn.execute('UPDATE users SET password_hash = ? WHERE id = ?', (hashed, user_id))
     conn.commit()
-    conn.close()
     return jsonify({"status":"success"})
 
 @app.route('/api/admin/delete_user', methods=['POST'])
@@ -1319,11 +2910,14 @@ def admin_delete_user():
     if user_id == current_user.id:
         return jsonify({"status":"error", "message":"Cannot delete yourself"}), 400
         
-    conn = get_db_connection()
+    discard_user_progress(user_id)
+    conn = get_db()
     conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
-    # Cascade delete handles the rest
+    # Cascade delete handles the rest (the rollup and interval sets have no user FK since anonymous progress uses 0)
+    conn.execute('DELETE FROM user_course_stats WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM video_watch_intervals WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM user_activity_state WHERE user_id = ?', (user_id,))
     conn.commit()
-    conn.close()
     return jsonify({"status":"success"})
 
 # --- Code Sandbox API ---
@@ -1333,9 +2927,8 @@ def admin_delete_user():
 def get_code():
     video_path = request.args.get('video_path')
     user_id = current_user.id
-    conn = get_db_connection()
+    conn = get_db()
     row = conn.execute('SELECT code, language FROM video_code WHERE user_id=? AND video_path=?', (user_id, video_path)).fetchone()
-    conn.close()
     return jsonify({
         "code": row['code'] if row else "", 
         "language": row['language'] if row else "javascript"
@@ -1346,7 +2939,7 @@ def get_code():
 def save_code():
     data = request.json
     user_id = current_user.id
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('''
         INSERT INTO video_code (user_id, video_path, code, language, updated_at)
         VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
@@ -1356,14 +2949,13 @@ def save_code():
             updated_at = CURRENT_TIMESTAMP
     ''', (user_id, data['video_path'], data['code'], data['language']))
     conn.commit()
-    conn.close()
     return jsonify({"status": "success"})
 
 # --- API Routes ---
 
-def award_xp(user_id, amount):
+def award_xp(conn, user_id, amount):
+    """Adds XP on the caller's connection; the caller commits."""
     if not user_id: return
-    conn = get_db_connection()
     # Ensure user has record
     conn.execute('INSERT OR IGNORE INTO user_xp (user_id, total_xp, level) VALUES (?, 0, 1)', (user_id,))
     conn.execute('UPDATE user_xp SET total_xp = total_xp + ? WHERE user_id = ?', (amount, user_id))
@@ -1372,20 +2964,19 @@ def award_xp(user_id, amount):
     row = conn.execute('SELECT total_xp FROM user_xp WHERE user_id = ?', (user_id,)).fetchone()
     new_level = (row['total_xp'] // 1000) + 1
     conn.execute('UPDATE user_xp SET level = ? WHERE user_id = ?', (new_level, user_id))
-    
-    conn.commit()
-    conn.close()
 
-@app.route('/api/save_progress', methods=['POST'])
-def save_progress():
-    data = request.json
-    user_id = get_current_user_id()
-    
-    timestamp = data.get('timestamp', 0)
-    video_path = data['video_path']
-    course_id = data['course_id']
-    
-    conn = get_db_connection()
+def record_progress(conn, user_id, course_id, video_path, video_title, timestamp, segments):
+    """Applies one progress update on conn: playhead at `timestamp`, `segments` [(start, end)] played.
+
+    The segments are merged into the video's interval set; only newly covered
+    time counts as watched. Returns (is_completed, newly_completed, added_seconds).
+    Achievements, XP and the commit are left to the caller so a batch pays for them once.
+    """
+    video_row = conn.execute('SELECT v.duration, m.course_id FROM videos v JOIN modules m ON v.module_id = m.id WHERE v.path = ? LIMIT 1', (video_path,)).fetchone()
+    duration = video_row['duration'] if video_row else 0
+    if video_row:
+        # Playlists post course_id 0; use the real course so foreign keys hold
+        course_id = video_row['course_id']
     
     conn.execute('''
         INSERT INTO course_progress (user_id, course_id, last_video_path, last_video_title, last_video_timestamp, updated_at)
@@ -1396,17 +2987,14 @@ def save_progress():
             last_video_timestamp = excluded.last_video_timestamp,
             updated_at = CURRENT_TIMESTAMP
         WHERE (user_id IS ? OR (user_id IS NULL AND ? IS NULL))
-    ''', (user_id, course_id, video_path, data['video_title'], timestamp, user_id, user_id))
+    ''', (user_id, course_id, video_path, video_title, timestamp, user_id, user_id))
     
-    video_row = conn.execute('SELECT duration FROM videos WHERE path = ? LIMIT 1', (video_path,)).fetchone()
-    duration = video_row['duration'] if video_row else 0
-    
-    is_completed = False
-    if duration > 0 and (timestamp / duration) >= 0.90:
-        is_completed = True
+    intervals, added = merge_intervals(load_watch_intervals(conn, user_id, video_path), segments, duration)
+    save_watch_intervals(conn, [(user_id, video_path, intervals)])
+    is_completed = is_covered(intervals, duration)
         
     was_completed = False
-    prev_prog = conn.execute('SELECT is_completed FROM video_progress WHERE user_id=? AND video_path=?', (user_id, video_path)).fetchone()
+    prev_prog = conn.execute('SELECT watched_time, is_completed FROM video_progress WHERE user_id=? AND video_path=?', (user_id, video_path)).fetchone()
     if prev_prog and prev_prog['is_completed']:
         was_completed = True
 
@@ -1421,7 +3009,6 @@ def save_progress():
     
     today = datetime.date.today().strftime("%Y-%m-%d")
     completed_inc = 1 if (is_completed and not was_completed) else 0
-    seconds_inc = 5 
     
     conn.execute('''
         INSERT INTO daily_activity (user_id, date, seconds_watched, videos_completed)
@@ -1429,29 +3016,445 @@ def save_progress():
         ON CONFLICT(user_id, date) DO UPDATE SET
             seconds_watched = seconds_watched + excluded.seconds_watched,
             videos_completed = videos_completed + excluded.videos_completed
-    ''', (user_id, today, seconds_inc, completed_inc))
+    ''', (user_id, today, added, completed_inc))
+    record_activity(conn, user_id, today, added)
     
+    completed_delta = 0
     if is_completed:
-        conn.execute('''
+        completed_delta = conn.execute('''
             INSERT OR IGNORE INTO watched_videos (user_id, course_id, video_path) 
             VALUES (?, ?, ?)
-        ''', (user_id, course_id, video_path))
-    
-    # Check Achievements
-    new_badges = check_new_achievements(conn, user_id)
+        ''', (user_id, course_id, video_path)).rowcount
+    
+    # Keep the course rollup in step: a completed video counts its full duration
+    if video_row:
+        old_time = (duration if was_completed else prev_prog['watched_time']) if prev_prog else 0
+        new_time = duration if (is_completed or was_completed) else max(prev_prog['watched_time'] if prev_prog else 0, timestamp)
+        bump_user_course_stats(conn, user_id, course_id, 0 if prev_prog else 1, new_time - old_time, completed_delta)
+    
+    return is_completed, is_completed and not was_completed, added
+
+def progress_xp(seconds_watched, newly_completed):
+    # 2 XP per second watched + 100 per completed video
+    return int(seconds_watched * 2) + 100 * newly_completed
+
+# --- Progress Write-Behind ---
+# Heartbeats that don't complete a video only touch memory; a background thread
+# writes them in bulk. Completions are applied synchronously (they drive
+# watched_videos, the completion XP bonus and achievements) and carry the user's
+# buffered heartbeats into the same transaction. Pages that show progress never
+# write: they overlay the user's unflushed heartbeats on what they read, via
+# buffered_progress_rows().
+
+_progress_buffer = {}  # (user_id, video_path) -> {'course_id', 'title', 'position', 'max_time', 'intervals', 'seq'}
+_activity_buffer = {}  # (user_id, date) -> [newly covered seconds, time of the latest heartbeat]
+_progress_inflight = []  # (progress, activity) batches taken from the buffers and not committed yet
+_pending_badges = {}  # user_id -> achievements unlocked by a background flush, returned with the next heartbeat
+_progress_seq = 0
+_progress_buffer_lock = threading.Lock()
+_progress_flush_lock = threading.Lock()  # One writer of buffered entries at a time
+_progress_flusher = None
+
+def buffer_progress(user_id, course_id, video_path, video_title, position, intervals, added):
+    """Buffers a heartbeat; `intervals` is the video's merged interval set, `added` its newly covered seconds."""
+    global _progress_seq
+    now = datetime.datetime.now()
+    today = now.strftime("%Y-%m-%d")
+    with _progress_buffer_lock:
+        _progress_seq += 1
+        entry = _progress_buffer.get((user_id, video_path))
+        if entry is None:
+            _progress_buffer[(user_id, video_path)] = {'course_id': course_id, 'title': video_title, 'position': position,
+                                                        'max_time': position, 'intervals': intervals, 'seq': _progress_seq}
+        else:
+            entry.update(course_id=course_id, title=video_title, position=position, seq=_progress_seq)
+            entry['max_time'] = max(entry['max_time'], position)
+            entry['intervals'] = merge_intervals(entry['intervals'], intervals)[0]
+        activity = _activity_buffer.setdefault((user_id, today), [0, now])
+        activity[0] += added
+        activity[1] = now
+        start_progress_flusher()
+
+def buffered_intervals(user_id, video_path):
+    """The video's interval set not committed yet, including a flush in progress, or None."""
+    intervals = None
+    with _progress_buffer_lock:
+        for progress, _ in _progress_inflight + [(_progress_buffer, None)]:
+            entry = progress.get((user_id, video_path))
+            if entry:
+                intervals = entry['intervals'] if intervals is None else merge_intervals(intervals, entry['intervals'])[0]
+    return intervals
+
+def discard_user_progress(user_id, video_paths=None):
+    """Drops a user's buffered heartbeats (only those of `video_paths` if given) ahead of deleting their progress.
+
+    Waits for a flush in progress, so nothing already taken from the buffer lands after the caller's delete.
+    """
+    with _progress_flush_lock, _progress_buffer_lock:
+        for key in [key for key in _progress_buffer if key[0] == user_id and (video_paths is None or key[1] in video_paths)]:
+            del _progress_buffer[key]
+        if video_paths is None:
+            for key in [key for key in _activity_buffer if key[0] == user_id]:
+                del _activity_buffer[key]
+            _pending_badges.pop(user_id, None)
+
+def pop_pending_badges(user_id):
+    with _progress_buffer_lock:
+        return _pending_badges.pop(user_id, [])
+
+def _take_buffered(user_filter):
+    """Moves matching entries from the buffers to an in-flight batch, or returns None if there are none."""
+    with _progress_buffer_lock:
+        progress = {key: _progress_buffer.pop(key) for key in [key for key in _progress_buffer if user_filter(key[0])]}
+        activity = {key: _activity_buffer.pop(key) for key in [key for key in _activity_buffer if user_filter(key[0])]}
+        if not progress and not activity:
+            return None
+        batch = (progress, activity)
+        _progress_inflight.append(batch)
+    return batch
+
+def _settle_buffered(batch, committed):
+    # A batch that failed to commit goes back, merged with anything buffered meanwhile
+    progress, activity = batch
+    with _progress_buffer_lock:
+        _progress_inflight[:] = [other for other in _progress_inflight if other is not batch]
+        if committed:
+            return
+        for key, entry in progress.items():
+            newer = _progress_buffer.get(key)
+            if newer:
+                newer['max_time'] = max(newer['max_time'], entry['max_time'])
+                newer['intervals'] = merge_intervals(newer['intervals'], entry['intervals'])[0]
+            else:
+                _progress_buffer[key] = entry
+        for key, (seconds, at) in activity.items():
+            newer = _activity_buffer.setdefault(key, [0, at])
+            newer[0] += seconds
+            newer[1] = max(newer[1], at)
 
-    conn.commit()
-    conn.close()
+def write_buffered_progress(conn, progress, activity):
+    """Writes a batch taken from the buffers on conn; the caller commits.
+
+    Returns {user_id: achievements unlocked}.
+    """
+    # Drop heartbeats of users deleted since they were buffered (they would fail the FKs)
+    user_ids = [uid for uid in {uid for uid, _ in progress} | {uid for uid, _ in activity} if uid is not None]
+    if user_ids:
+        known = {row['id'] for row in conn.execute(f'SELECT id FROM users WHERE id IN ({",".join("?" * len(user_ids))})', user_ids).fetchall()}
+        progress = {key: entry for key, entry in progress.items() if key[0] is None or key[0] in known}
+        activity = {key: value for key, value in activity.items() if key[0] is None or key[0] in known}
+
+    # Resolve each video's real course (playlists post course_id 0); drop paths no longer in the library
+    paths = list({path for _, path in progress})
+    course_of = {}
+    for i in range(0, len(paths), 500):
+        chunk = paths[i:i + 500]
+        for row in conn.execute(f'''
+            SELECT v.path, m.course_id FROM videos v JOIN modules m ON v.module_id = m.id
+            WHERE v.path IN ({','.join('?' * len(chunk))})
+        ''', chunk).fetchall():
+            course_of[row['path']] = row['course_id']
+    progress = {key: entry for key, entry in progress.items() if key[1] in course_of}
+    paths = [path for path in paths if path in course_of]
+
+    last_per_course = {}
+    for (user_id, path), entry in progress.items():
+        course_id = course_of[path]
+        current = last_per_course.get((user_id, course_id))
+        if current is None or entry['seq'] > current[1]['seq']:
+            last_per_course[(user_id, course_id)] = (path, entry)
+
+    conn.executemany('''
+        INSERT INTO course_progress (user_id, course_id, last_video_path, last_video_title, last_video_timestamp, updated_at)
+        VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(user_id, course_id) DO UPDATE SET
+            last_video_path = excluded.last_video_path,
+            last_video_title = excluded.last_video_title,
+            last_video_timestamp = excluded.last_video_timestamp,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE (user_id IS ? OR (user_id IS NULL AND ? IS NULL))
+    ''', [(user_id, course_id, path, entry['title'], entry['position'], user_id, user_id)
+          for (user_id, course_id), (path, entry) in last_per_course.items()])
+    conn.executemany('''
+        INSERT INTO video_progress (user_id, video_path, watched_time, is_completed, updated_at)
+        VALUES (?, ?, ?, 0, CURRENT_TIMESTAMP)
+        ON CONFLICT(user_id, video_path) DO UPDATE SET
+            watched_time = MAX(video_progress.watched_time, excluded.watched_time),
+            updated_at = CURRENT_TIMESTAMP
+    ''', [(user_id, path, entry['max_time']) for (user_id, path), entry in progress.items()])
+
+    # Merge with the stored sets rather than overwrite: a set buffered while an
+    # earlier flush was still committing may have been seeded without it
+    stored = {}
+    for i in range(0, len(paths), 500):
+        chunk = paths[i:i + 500]
+        for row in conn.execute(f'SELECT user_id, video_path, intervals FROM video_watch_intervals WHERE video_path IN ({",".join("?" * len(chunk))})', chunk).fetchall():
+            stored[(row['user_id'], row['video_path'])] = unpack_intervals(row['intervals'])
+    save_watch_intervals(conn, [(user_id, path, merge_intervals(stored.get((user_id or 0, path), []), entry['intervals'])[0])
+                                for (user_id, path), entry in progress.items()])
+    conn.executemany('''
+        INSERT INTO daily_activity (user_id, date, seconds_watched, videos_completed)
+        VALUES (?, ?, ?, 0)
+        ON CONFLICT(user_id, date) DO UPDATE SET
+            seconds_watched = seconds_watched + excluded.seconds_watched
+    ''', [(user_id, date, seconds) for (user_id, date), (seconds, _) in activity.items()])
+    for (user_id, date), (seconds, _) in sorted(activity.items(), key=lambda item: item[0][1]):
+        record_activity(conn, user_id, date, seconds)
+
+    # Achievements are judged at the user's latest buffered heartbeat, not at flush time
+    seconds_per_user, last_heartbeat = {}, {}
+    for (user_id, _), (seconds, at) in activity.items():
+        seconds_per_user[user_id] = seconds_per_user.get(user_id, 0) + seconds
+        last_heartbeat[user_id] = max(last_heartbeat.get(user_id, at), at)
+    for user_id, seconds in seconds_per_user.items():
+        award_xp(conn, user_id, progress_xp(seconds, 0))
+
+    users_per_course = {}
+    for (user_id, path) in progress:
+        if path in course_of:
+            users_per_course.setdefault(course_of[path], set()).add(user_id)
+    for course_id, user_ids in users_per_course.items():
+        refresh_course_rollups(conn, course_id, list(user_ids))
+
+    return {user_id: check_new_achievements(conn, user_id, now=last_heartbeat[user_id]) for user_id in seconds_per_user if user_id}
+
+def _flush_progress(user_filter):
+    with _progress_flush_lock:
+        batch = _take_buffered(user_filter)
+        if batch is None:
+            return
+        conn = get_db_connection()
+        try:
+            badges = write_buffered_progress(conn, *batch)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            _settle_buffered(batch, committed=False)
+            print(f"Progress flush failed, will retry: {e}")
+            return
+        finally:
+            conn.close()
+        _settle_buffered(batch, committed=True)
+        with _progress_buffer_lock:
+            for user_id, unlocked in badges.items():
+                if unlocked:
+                    _pending_badges.setdefault(user_id, []).extend(unlocked)
+        bump_data_version()
+
+def flush_progress_buffer():
+    """Writes every buffered heartbeat; run by the flusher thread and at shutdown."""
+    _flush_progress(lambda user_id: True)
+
+def _progress_flush_loop():
+    while True:
+        time.sleep(PROGRESS_FLUSH_INTERVAL)
+        try:
+            flush_progress_buffer()
+        except Exception as e:
+            print(f"Progress flusher error: {e}")
 
-    # Award XP
+def start_progress_flusher():
+    """Starts the background flusher on first use; called with _progress_buffer_lock held."""
+    global _progress_flusher
+    if _progress_flusher is None or not _progress_flusher.is_alive():
+        _progress_flusher = threading.Thread(target=_progress_flush_loop, daemon=True)
+        _progress_flusher.start()
+
+atexit.register(flush_progress_buffer)
+
+def buffered_user_progress(user_id):
+    """The user's heartbeats not committed yet: ({video_path: entry}, {date: seconds}, seq).
+
+    Entries of a flush in progress are included, so progress never drops out of
+    view while it is written. `seq` grows with every heartbeat and is 0 when
+    nothing is pending.
+    """
+    progress, activity, seq = {}, {}, 0
+    with _progress_buffer_lock:
+        for batch_progress, batch_activity in _progress_inflight + [(_progress_buffer, _activity_buffer)]:
+            for (uid, path), entry in batch_progress.items():
+                if uid != user_id:
+                    continue
+                seq = max(seq, entry['seq'])
+                current = progress.get(path)
+                if current is None or entry['seq'] > current['seq']:
+                    progress[path] = {'course_id': entry['course_id'], 'title': entry['title'], 'position': entry['position'],
+                                      'max_time': max(entry['max_time'], current['max_time'] if current else 0), 'seq': entry['seq']}
+                else:
+                    current['max_time'] = max(current['max_time'], entry['max_time'])
+            for (uid, date), (seconds, _) in batch_activity.items():
+                if uid == user_id:
+                    activity[date] = activity.get(date, 0) + seconds
+    return progress, activity, seq
+
+def buffered_progress_rows(conn, user_id):
+    """The user's unflushed progress, resolved against what it will update: ({video_path: row}, {date: seconds}, seq).
+
+    Each row has the video's title, duration, order_index and course, the stored
+    watched_time (None without a video_progress row) and is_completed, and the
+    buffered position, player title, seq and resulting watched_time. Read once
+    per request, so every overlay on a page sees the same snapshot.
+    """
+    cache = g.setdefault('buffered_progress', {})
+    if user_id in cache:
+        return cache[user_id]
+    progress, activity, seq = buffered_user_progress(user_id)
+    rows = {}
+    paths = list(progress)
+    for i in range(0, len(paths), 500):
+        chunk = paths[i:i + 500]
+        for row in conn.execute(f'''
+            SELECT v.path, v.title as video_title, v.duration, v.order_index,
+                   m.course_id, c.title as course_title, c.thumbnail as course_thumbnail,
+                   vp.watched_time as stored_time, vp.is_completed
+            FROM videos v
+            JOIN modules m ON v.module_id = m.id
+            JOIN courses c ON m.course_id = c.id
+            LEFT JOIN video_progress vp ON vp.video_path = v.path AND vp.user_id IS ?
+            WHERE v.path IN ({','.join('?' * len(chunk))})
+        ''', [user_id] + chunk).fetchall():
+            entry = progress[row['path']]
+            rows[row['path']] = dict(row, is_completed=bool(row['is_completed']), position=entry['position'], title=entry['title'],
+                                     seq=entry['seq'], watched_time=max(row['stored_time'] or 0, entry['max_time']))
+    cache[user_id] = (rows, activity, seq)
+    return cache[user_id]
+
+def buffered_last_videos(rows):
+    """{course_id: row} of the most recently played buffered video in each course."""
+    last = {}
+    for row in rows.values():
+        if row['course_id'] not in last or row['seq'] > last[row['course_id']]['seq']:
+            last[row['course_id']] = row
+    return last
+
+def ingest_progress(conn, user_id, updates):
+    """Takes heartbeats [(course_id, video_path, video_title, position, segments)] for one user.
+
+    `segments` are the [(start, end)] ranges played since the last heartbeat.
+    Updates are buffered unless one of them completes a video; then the user's
+    buffered heartbeats and the whole call are written on `conn`, in order.
+    Updates for paths that aren't in the library are dropped.
+    Returns the fully watched video paths and any achievements to report.
+    """
+    completed = []
+    newly_completing = False
+    known = []
+    merged = []
+    for update in updates:
+        course_id, video_path, video_title, position, segments = update
+        row = conn.execute('''
+            SELECT v.duration, vp.is_completed FROM videos v
+            LEFT JOIN video_progress vp ON vp.video_path = v.path AND vp.user_id IS ?
+            WHERE v.path = ? LIMIT 1
+        ''', (user_id, video_path)).fetchone()
+        if row is None:
+            continue
+        known.append(update)
+        duration = row['duration']
+        intervals = buffered_intervals(user_id, video_path)
+        if intervals is None:
+            intervals = load_watch_intervals(conn, user_id, video_path)
+        intervals, added = merge_intervals(intervals, segments, duration)
+        merged.append((intervals, added))
+        if is_covered(intervals, duration):
+            completed.append(video_path)
+            newly_completing = newly_completing or not row['is_completed']
+    updates = known
+
+    new_badges = []
+    if newly_completing:
+        with _progress_flush_lock:
+            # The user's buffered heartbeats go first, in the same transaction
+            batch = _take_buffered(lambda uid: uid == user_id)
+            try:
+                if batch:
+                    new_badges = write_buffered_progress(conn, *batch).get(user_id, [])
+                total_seconds = 0
+                total_new = 0
+                for course_id, video_path, video_title, position, segments in updates:
+                    _, newly_completed, added = record_progress(conn, user_id, course_id, video_path, video_title, position, segments)
+                    total_seconds += added
+                    total_new += newly_completed
+                new_badges += check_new_achievements(conn, user_id)
+                if user_id:
+                    award_xp(conn, user_id, progress_xp(total_seconds, total_new))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                if batch:
+                    _settle_buffered(batch, committed=False)
+                raise
+            if batch:
+                _settle_buffered(batch, committed=True)
+    else:
+        for (course_id, video_path, video_title, position, segments), (intervals, added) in zip(updates, merged):
+            buffer_progress(user_id, course_id, video_path, video_title, position, intervals, added)
     if user_id:
-        # 1 XP per second watched (approx) + 100 for completion
-        xp_gain = seconds_inc * 2
-        if is_completed and not was_completed:
-            xp_gain += 100
-        award_xp(user_id, xp_gain)
+        new_badges = pop_pending_badges(user_id) + new_badges
+    return completed, new_badges
+
+@app.route('/api/save_progress', methods=['POST'])
+def save_progress():
+    """Single progress ping; the player now batches through /api/progress_batch.
+
+    Without an explicit `start` the ping stands for the 5 seconds before `timestamp`.
+    """
+    data = request.json
+    user_id = get_current_user_id()
+    timestamp = data.get('timestamp', 0)
+    start = data.get('start', timestamp - 5)
+    
+    conn = get_db()
+    completed, new_badges = ingest_progress(conn, user_id, [(data['course_id'], data['video_path'], data['video_title'], timestamp, [(start, timestamp)])])
+
+    return jsonify({"status": "success", "is_completed": bool(completed), "new_achievements": new_badges})
 
-    return jsonify({"status": "success", "is_completed": is_completed, "new_achievements": new_badges})
+@app.route('/api/progress_batch', methods=['POST'])
+def progress_batch():
+    """Applies the watch segments a player accumulated since its last flush.
+
+    Body: {"course_id": ..., "segments": [{"video_path", "video_title", "start", "position"}, ...]}
+    where each segment is a stretch of continuous playback from `start` to the
+    playhead `position`; a seek starts a new segment. Sent periodically, on
+    pause/video change, and via navigator.sendBeacon when the tab is hidden or closed.
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    segments = data.get('segments') or []
+    if not isinstance(segments, list):
+        return jsonify({"status": "error", "message": "segments must be a list"}), 400
+    user_id = get_current_user_id()
+
+    # Collapse to one update per video: the last position and every played range, in first-seen order
+    per_video = {}
+    for seg in segments:
+        if not isinstance(seg, dict) or not seg.get('video_path'):
+            continue
+        try:
+            position = max(0.0, float(seg.get('position', 0)))
+            # Players loaded before segments carried a start only send the seconds played
+            start = float(seg['start']) if 'start' in seg else position - float(seg.get('seconds', 0))
+            start = max(0.0, start, position - PROGRESS_SEGMENT_MAX_SECONDS)
+        except (TypeError, ValueError):
+            continue
+        entry = per_video.setdefault(seg['video_path'], {'title': seg.get('video_title') or '', 'position': position, 'ranges': []})
+        entry['position'] = position
+        if position > start:
+            entry['ranges'].append((start, position))
+        if seg.get('video_title'):
+            entry['title'] = seg['video_title']
+    # The most recently played video is applied last so it ends up as course_progress' last video
+    if segments and isinstance(segments[-1], dict) and segments[-1].get('video_path') in per_video:
+        last = segments[-1]['video_path']
+        per_video[last] = per_video.pop(last)
+
+    if not per_video:
+        return jsonify({"status": "success", "completed": [], "new_achievements": pop_pending_badges(user_id) if user_id else []})
+
+    conn = get_db()
+    completed, new_badges = ingest_progress(conn, user_id, [(data.get('course_id', 0), video_path, entry['title'], entry['position'], entry['ranges'])
+                                                            for video_path, entry in per_video.items()])
+
+    return jsonify({"status": "success", "completed": completed, "new_achievements": new_badges})
 
 
 @app.route('/api/get_note', methods=['GET'])
@@ -1462,9 +3465,8 @@ def get_note():
     if not user_id:
          return jsonify({"content": ""})
 
-    conn = get_db_connection()
+    conn = get_db()
     row = conn.execute('SELECT content FROM video_notes WHERE user_id = ? AND video_path = ?', (user_id, video_path)).fetchone()
-    conn.close()
     
     return jsonify({"content": row['content'] if row else ""})
 
@@ -1475,7 +3477,7 @@ def save_note():
     if not user_id:
         return jsonify({"status": "error", "message": "Login required"}), 401
         
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('''
         INSERT INTO video_notes (user_id, video_path, content, updated_at)
         VALUES (?, ?, ?, CURRENT_TIMESTAMP)
@@ -1484,7 +3486,6 @@ def save_note():
             updated_at = CURRENT_TIMESTAMP
     ''', (user_id, data['video_path'], data['content']))
     conn.commit()
-    conn.close()
     return jsonify({"status": "success"})
 
 @app.route('/api/save_bookmark', methods=['POST'])
@@ -1492,13 +3493,12 @@ def save_note():
 def save_bookmark():
     data = request.json
     user_id = current_user.id
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('''
         INSERT INTO bookmarks (user_id, course_id, video_path, video_title, timestamp, note)
         VALUES (?, ?, ?, ?, ?, ?)
     ''', (user_id, data['course_id'], data['video_path'], data['video_title'], data['timestamp'], data.get('note', '')))
     conn.commit()
-    conn.close()
     return jsonify({"status": "success"})
 
 @app.route('/api/get_bookmarks', methods=['GET'])
@@ -1506,14 +3506,13 @@ def save_bookmark():
 def get_bookmarks():
     course_id = request.args.get('course_id')
     user_id = current_user.id
-    conn = get_db_connection()
+    conn = get_db()
     
     if course_id:
         rows = conn.execute('SELECT * FROM bookmarks WHERE user_id = ? AND course_id = ? ORDER BY timestamp', (user_id, course_id)).fetchall()
     else:
         rows = conn.execute('SELECT * FROM bookmarks WHERE user_id = ? ORDER BY created_at DESC', (user_id,)).fetchall()
     
-    conn.close()
     return jsonify([dict(r) for r in rows])
 
 @app.route('/api/delete_bookmark', methods=['POST'])
@@ -1521,43 +3520,23 @@ def get_bookmarks():
 def delete_bookmark():
     bookmark_id = request.json['id']
     user_id = current_user.id
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('DELETE FROM bookmarks WHERE id = ? AND user_id = ?', (bookmark_id, user_id))
     conn.commit()
-    conn.close()
     return jsonify({"status": "success"})
 
 @app.route('/resources')
 @login_required
 def resources_page():
-    conn = get_db_connection()
-    courses_rows = conn.execute('SELECT id, folder_name FROM courses').fetchall()
-    conn.close()
-    
-    # Map folder_name -> {id, folder_name}
-    course_map = {row['folder_name']: {'id': row['id'], 'folder_name': row['folder_name']} for row in courses_rows}
+    conn = get_db()
+    rows = conn.execute('''
+        SELECT r.name, r.path, r.size, c.id as course_id, c.folder_name as course_name
+        FROM course_resources r
+        JOIN courses c ON r.course_id = c.id
+        ORDER BY c.folder_name, r.path
+    ''').fetchall()
     
-    resources = []
-    for root, dirs, files in os.walk(COURSES_DIR):
-        for f in files:
-            if not f.lower().endswith(('.mp4', '.mkv', '.webm', '.mov', '.ds_store', '.db', '.py', '.sh', '.vtt', '.srt')):
-                full_path = os.path.join(root, f)
-                rel_path = os.path.relpath(full_path, COURSES_DIR)
-                parts = rel_path.split(os.sep)
-                course_folder_name = parts[0] if len(parts) > 0 else "Unknown"
-                
-                course = course_map.get(course_folder_name)
-                
-                if course:
-                    course_folder_path = os.path.join(COURSES_DIR, course['folder_name'])
-                    rel_path_in_course = os.path.relpath(full_path, course_folder_path)
-                    resources.append({
-                        'name': f,
-                        'path': rel_path_in_course,
-                        'course_name': course_folder_name,
-                        'course_id': course['id'],
-                        'size': os.path.getsize(full_path)
-                    })
+    resources = [dict(r) for r in rows if not r['name'].lower().endswith(('.db', '.py', '.sh'))]
     return render_template('resources.html', resources=resources)
 
 @app.route('/api/save_quiz_result', methods=['POST'])
@@ -1572,14 +3551,13 @@ def save_quiz_result():
     if correct is None or total is None:
         return jsonify({"status": "error", "message": "Missing data"}), 400
         
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('INSERT INTO quiz_stats (user_id, course_id, correct_answers, total_questions) VALUES (?, ?, ?, ?)',
                  (user_id, course_id, correct, total))
-    conn.commit()
-    conn.close()
     
     # Award XP: 50 per correct answer
-    award_xp(user_id, correct * 50)
+    award_xp(conn, user_id, correct * 50)
+    conn.commit()
     
     return jsonify({"status": "success"})
 
@@ -1594,7 +3572,7 @@ def save_mastery():
     if not video_path or score is None:
         return jsonify({"status": "error", "message": "Missing data"}), 400
         
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('''
         INSERT INTO video_mastery (user_id, video_path, score, updated_at)
         VALUES (?, ?, ?, CURRENT_TIMESTAMP)
@@ -1603,7 +3581,6 @@ def save_mastery():
             updated_at = CURRENT_TIMESTAMP
     ''', (user_id, video_path, score))
     conn.commit()
-    conn.close()
     return jsonify({"status": "success"})
 
 @app.route('/api/save_goal', methods=['POST'])
@@ -1613,11 +3590,10 @@ def save_goal():
     user_id = current_user.id
     goal = data.get('daily_goal', 30)
     
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('INSERT OR IGNORE INTO user_xp (user_id, daily_goal_mins) VALUES (?, ?)', (user_id, goal))
     conn.execute('UPDATE user_xp SET daily_goal_mins = ? WHERE user_id = ?', (goal, user_id))
     conn.commit()
-    conn.close()
     return jsonify({"status": "success"})
 
 @app.route('/api/update_profile_pic', methods=['POST'])
@@ -1637,10 +3613,9 @@ def update_profile_pic():
         
         img_url = "/" + filepath.replace("\\", "/")
         
-        conn = get_db_connection()
+        conn = get_db()
         conn.execute('UPDATE users SET profile_pic = ? WHERE id = ?', (img_url, current_user.id))
         conn.commit()
-        conn.close()
         
         return jsonify({"status": "success", "image_url": img_url})
     except Exception as e:
@@ -1673,13 +3648,12 @@ def save_snapshot():
             
         img_url = "/" + filepath.replace("\\", "/")
         
-        conn = get_db_connection()
+        conn = get_db()
         conn.execute('INSERT INTO video_snapshots (user_id, video_path, image_path, timestamp) VALUES (?, ?, ?, ?)',
                      (user_id, video_path, img_url, timestamp))
         conn.commit()
-        conn.close()
         
-        return jsonify({"status": "success", "image_url": img_url})
+        return jsonify({"status": "success", "image_url": img_url, "thumbnail_url": resized(img_url, 960)})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
@@ -1689,13 +3663,17 @@ def save_snapshot():
 @login_required
 def analytics_page():
     user_id = current_user.id
-    conn = get_db_connection()
+    conn = get_db()
+    buffered, buffered_activity, _ = buffered_progress_rows(conn, user_id)
     
     total_time = conn.execute('SELECT SUM(watched_time) FROM video_progress WHERE user_id=?', (user_id,)).fetchone()[0] or 0
+    total_time += sum(row['watched_time'] - (row['stored_time'] or 0) for row in buffered.values())
     total_completed = conn.execute('SELECT COUNT(*) FROM video_progress WHERE user_id=? AND is_completed=1', (user_id,)).fetchone()[0] or 0
     
     activity_rows = conn.execute('SELECT date, seconds_watched, videos_completed FROM daily_activity WHERE user_id=?', (user_id,)).fetchall()
     activity_data = {row['date']: {'seconds': row['seconds_watched'], 'count': row['videos_completed'], 'ai_count': 0} for row in activity_rows}
+    for date, seconds in buffered_activity.items():
+        activity_data.setdefault(date, {'seconds': 0, 'count': 0, 'ai_count': 0})['seconds'] += seconds
     
     # Add AI activity to heatmap data
     try:
@@ -1755,6 +3733,11 @@ def analytics_page():
 
     # XP & Level Analytics
     xp_row = conn.execute('SELECT * FROM user_xp WHERE user_id=?', (user_id,)).fetchone()
+    buffered_xp = progress_xp(sum(buffered_activity.values()), 0)
+    if buffered_xp:
+        # What the next flush will award (see award_xp)
+        total = (xp_row['total_xp'] if xp_row else 0) + buffered_xp
+        xp_row = {'total_xp': total, 'level': total // 1000 + 1, 'daily_goal_mins': xp_row['daily_goal_mins'] if xp_row else 30}
     if not xp_row:
         user_xp_data = {'total_xp': 0, 'level': 1, 'daily_goal_mins': 30, 'next_level_xp': 1000, 'current_level_base': 0, 'pct': 0}
     else:
@@ -1773,7 +3756,6 @@ def analytics_page():
             'pct': pct
         }
         
-    conn.close()
     return render_template('analytics.html', 
                            total_time=total_time, 
                            total_completed=total_completed, 
@@ -1799,17 +3781,16 @@ def create_playlist():
     if not title:
         return jsonify({"status": "error", "message": "Title required"}), 400
     
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('INSERT INTO playlists (user_id, title) VALUES (?, ?)', (user_id, title))
     conn.commit()
-    conn.close()
     return jsonify({"status": "success"})
 
 @app.route('/api/get_playlists', methods=['GET'])
 @login_required
 def get_playlists():
     user_id = current_user.id
-    conn = get_db_connection()
+    conn = get_db()
     rows = conn.execute('SELECT * FROM playlists WHERE user_id = ? ORDER BY created_at DESC', (user_id,)).fetchall()
     playlists = [dict(r) for r in rows]
     
@@ -1818,7 +3799,6 @@ def get_playlists():
         count = conn.execute('SELECT COUNT(*) as c FROM playlist_items WHERE playlist_id = ?', (pl['id'],)).fetchone()['c']
         pl['item_count'] = count
         
-    conn.close()
     return jsonify(playlists)
 
 @app.route('/api/add_to_playlist', methods=['POST'])
@@ -1830,7 +3810,7 @@ def add_to_playlist():
     video_title = data.get('video_title')
     course_id = data.get('course_id')
     
-    conn = get_db_connection()
+    conn = get_db()
     # Get current max order
     max_order = conn.execute('SELECT MAX(order_index) as m FROM playlist_items WHERE playlist_id = ?', (playlist_id,)).fetchone()['m']
     new_order = (max_order if max_order is not None else -1) + 1
@@ -1840,23 +3820,21 @@ def add_to_playlist():
         VALUES (?, ?, ?, ?, ?)
     ''', (playlist_id, video_path, video_title, course_id, new_order))
     conn.commit()
-    conn.close()
     return jsonify({"status": "success"})
 
 @app.route('/api/remove_from_playlist', methods=['POST'])
 @login_required
 def remove_from_playlist():
     item_id = request.json.get('item_id')
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('DELETE FROM playlist_items WHERE id = ?', (item_id,))
     conn.commit()
-    conn.close()
     return jsonify({"status": "success"})
 
 @app.route('/playlist/<int:playlist_id>')
 @login_required
 def playlist_player(playlist_id):
-    conn = get_db_connection()
+    conn = get_db()
     user_id = current_user.id
     
     playlist = conn.execute('SELECT * FROM playlists WHERE id = ? AND user_id = ?', (playlist_id, user_id)).fetchone()
@@ -1865,15 +3843,30 @@ def playlist_player(playlist_id):
         
     items = conn.execute('SELECT * FROM playlist_items WHERE playlist_id = ? ORDER BY order_index', (playlist_id,)).fetchall()
     
+    # Video info from the cached trees of the courses involved, progress in one query
+    video_info = {}
+    for course_id in {item['course_id'] for item in items}:
+        for module in get_course_structure(conn, course_id):
+            for v in module.videos:
+                video_info[v.path] = (v.duration, v.item_type)
+    missing = [item['video_path'] for item in items if item['video_path'] not in video_info]
+    if missing:
+        placeholders = ','.join('?' * len(missing))
+        for v in conn.execute(f'SELECT path, duration, item_type FROM videos WHERE path IN ({placeholders})', missing).fetchall():
+            video_info[v['path']] = (v['duration'], v['item_type'])
+    paths = [item['video_path'] for item in items]
+    progress = {}
+    if paths:
+        placeholders = ','.join('?' * len(paths))
+        for r in conn.execute(f'SELECT video_path, watched_time, is_completed FROM video_progress WHERE user_id = ? AND video_path IN ({placeholders})', [user_id] + paths).fetchall():
+            progress[r['video_path']] = r
+    progress.update(buffered_progress_rows(conn, user_id)[0])
+    
     # Transform items to match player structure (simple flat list masquerading as module)
     video_list = []
     for item in items:
-        # Get duration and progress
-        v_info = conn.execute('SELECT duration, item_type FROM videos WHERE path = ?', (item['video_path'],)).fetchone()
-        duration = v_info['duration'] if v_info else 0
-        item_type = v_info['item_type'] if v_info and 'item_type' in v_info.keys() else 'video'
-        
-        prog = conn.execute('SELECT watched_time, is_completed FROM video_progress WHERE user_id = ? AND video_path = ?', (user_id, item['video_path'])).fetchone()
+        duration, item_type = video_info.get(item['video_path'], (0, 'video'))
+        prog = progress.get(item['video_path'])
         
         video_list.append({
             'title': item['video_title'],
@@ -1887,7 +3880,6 @@ def playlist_player(playlist_id):
         
     structure = [{'title': playlist['title'], 'videos': video_list, 'resources': []}]
     
-    conn.close()
     
     # Reuse player template with slight adjustment (we might need a flag `is_playlist`)
     return render_template('player.html', course={'title': playlist['title'], 'id': 0}, structure=structure, 
@@ -1899,7 +3891,7 @@ def playlist_player(playlist_id):
 @login_required
 def backup_data():
     user_id = current_user.id
-    conn = get_db_connection()
+    conn = get_db()
     
     data = {
         'version': 1,
@@ -1912,8 +3904,26 @@ def backup_data():
         'playlist_items': [dict(r) for r in conn.execute('SELECT pi.* FROM playlist_items pi JOIN playlists p ON pi.playlist_id = p.id WHERE p.user_id=?', (user_id,)).fetchall()],
         'activity': [dict(r) for r in conn.execute('SELECT * FROM daily_activity WHERE user_id=?', (user_id,)).fetchall()]
     }
+
+    # Include heartbeats the flusher hasn't written yet
+    buffered, buffered_activity, _ = buffered_progress_rows(conn, user_id)
+    stamp = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    progress = {p['video_path']: p for p in data['progress']}
+    for path, row in buffered.items():
+        progress.setdefault(path, {'user_id': user_id, 'video_path': path, 'is_completed': 0})
+        progress[path].update(watched_time=row['watched_time'], updated_at=stamp)
+    data['progress'] = list(progress.values())
+    course_progress = {p['course_id']: p for p in data['course_progress']}
+    for course_id, row in buffered_last_videos(buffered).items():
+        course_progress.setdefault(course_id, {'user_id': user_id, 'course_id': course_id})
+        course_progress[course_id].update(last_video_path=row['path'], last_video_title=row['title'],
+                                          last_video_timestamp=row['position'], updated_at=stamp)
+    data['course_progress'] = list(course_progress.values())
+    activity = {a['date']: a for a in data['activity']}
+    for date, seconds in buffered_activity.items():
+        activity.setdefault(date, {'user_id': user_id, 'date': date, 'seconds_watched': 0, 'videos_completed': 0})['seconds_watched'] += seconds
+    data['activity'] = list(activity.values())
     
-    conn.close()
     
     return jsonify(data)
 
@@ -1929,7 +3939,7 @@ def restore_data():
     try:
         data = json.load(file)
         user_id = current_user.id
-        conn = get_db_connection()
+        conn = get_db()
         
         # Restore Progress
         for p in data.get('progress', []):
@@ -1969,8 +3979,14 @@ def restore_data():
                     videos_completed = MAX(daily_activity.videos_completed, excluded.videos_completed)
             ''', (user_id, a['date'], a['seconds_watched'], a['videos_completed']))
 
+        # Restored videos without watched intervals get them derived from their progress
+        seed_watch_intervals(conn)
+        rebuild_activity_state(conn, [user_id])
+        check_new_achievements(conn, user_id, backfill=True)
+        for c in conn.execute('SELECT id FROM courses').fetchall():
+            refresh_course_rollups(conn, c['id'], [user_id])
+
         conn.commit()
-        conn.close()
         return jsonify({"status": "success", "message": "Restore complete (partial/merge)"})
         
     except Exception as e:
@@ -1985,13 +4001,12 @@ def add_flashcard():
     user_id = current_user.id
     today = datetime.date.today().strftime("%Y-%m-%d")
     
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('''
         INSERT INTO flashcards (user_id, course_id, video_path, front, back, next_review_date)
         VALUES (?, ?, ?, ?, ?, ?)
     ''', (user_id, data['course_id'], data['video_path'], data['front'], data['back'], today))
     conn.commit()
-    conn.close()
     return jsonify({"status": "success"})
         
 @app.route('/api/review_flashcard', methods=['POST'])
@@ -2001,11 +4016,10 @@ def review_flashcard():
     card_id = request.json.get('id')
     quality = request.json.get('quality') # 0=forgot, 3=hard, 4=good, 5=easy
     
-    conn = get_db_connection()
+    conn = get_db()
     card = conn.execute('SELECT * FROM flashcards WHERE id = ?', (card_id,)).fetchone()
     
     if not card:
-        conn.close()
         return jsonify({"status": "error"}), 404
         
     interval = card['interval']
@@ -2030,7 +4044,6 @@ def review_flashcard():
         WHERE id = ?
     ''', (next_date, interval, ease, card_id))
     conn.commit()
-    conn.close()
     
     return jsonify({"status": "success"})
 
@@ -2040,7 +4053,7 @@ def study_page():
     user_id = current_user.id
     today = datetime.date.today().strftime("%Y-%m-%d")
     
-    conn = get_db_connection()
+    conn = get_db()
     # Get due cards
     cards = conn.execute('''
         SELECT * FROM flashcards 
@@ -2050,7 +4063,6 @@ def study_page():
     
     due_count = len(cards)
     cards_list = [dict(c) for c in cards]
-    conn.close()
     
     return render_template('study.html', cards=cards_list, due_count=due_count)
 
@@ -2066,7 +4078,7 @@ def get_calendar_events():
     start = request.args.get('start') # YYYY-MM-DD
     end = request.args.get('end')     # YYYY-MM-DD
     
-    conn = get_db_connection()
+    conn = get_db()
     
     # Get Flashcard counts
     # Group by next_review_date
@@ -2085,7 +4097,6 @@ def get_calendar_events():
             'color': '#5022c3' # Primary color
         })
         
-    conn.close()
     return jsonify(events)
 
 @app.route('/quiz/<path:quiz_file>')
@@ -2099,63 +4110,57 @@ def serve_quiz(quiz_file):
 
 @app.route('/api/toggle_favorite', methods=['POST'])
 def toggle_favorite():
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('UPDATE courses SET is_favorite = NOT is_favorite WHERE id = ?', (request.json['course_id'],))
     conn.commit()
-    conn.close()
     return jsonify({"status": "success"})
 
 @app.route('/api/get_course_videos/<int:course_id>')
 @login_required
 def get_course_videos_api(course_id):
-    conn = get_db_connection()
+    conn = get_db()
     user_id = current_user.id
     
-    modules = conn.execute('SELECT * FROM modules WHERE course_id = ? ORDER BY order_index', (course_id,)).fetchall()
-    
-    vp_map = {}
-    vp_rows = conn.execute('SELECT video_path, watched_time, is_completed FROM video_progress WHERE user_id = ?', (user_id,)).fetchall()
-    for r in vp_rows:
-        vp_map[r['video_path']] = {'watched_time': r['watched_time'], 'is_completed': r['is_completed']}
+    modules = load_course_tree(conn, course_id, user_id)
         
     # Check AI Assets
     ai_map = {}
-    ai_rows = conn.execute('SELECT video_path, content_type FROM ai_generated_content WHERE user_id = ? AND content_type IN ("summarize", "quiz")', (user_id,)).fetchall()
+    ai_rows = conn.execute('''
+        SELECT ai.video_path, ai.content_type
+        FROM ai_generated_content ai
+        JOIN videos v ON ai.video_path = v.path
+        JOIN modules m ON v.module_id = m.id
+        WHERE ai.user_id = ? AND m.course_id = ? AND ai.content_type IN ('summarize', 'quiz')
+    ''', (user_id, course_id)).fetchall()
     for r in ai_rows:
         if r['video_path'] not in ai_map: ai_map[r['video_path']] = set()
         ai_map[r['video_path']].add(r['content_type'])
     
+    # One listing per folder instead of two stats per video
+    dir_entries = {}
     structure = []
     for module in modules:
-        videos = conn.execute('SELECT * FROM videos WHERE module_id = ? ORDER BY order_index', (module['id'],)).fetchall()
-        mod_dict = dict(module)
-        mod_dict['videos'] = []
-        for v in videos:
-            v_dict = dict(v)
-            prog = vp_map.get(v['path'], {'watched_time': 0, 'is_completed': False})
-            v_dict['watched_time'] = prog['watched_time']
-            v_dict['is_completed'] = prog['is_completed']
-            # Include source info
-            if 'source_id' in v.keys():
-                v_dict['source_id'] = v['source_id']
-                
-            # Check assets
+        mod_dict = module.to_dict()
+        del mod_dict['resources']
+        for v_dict in mod_dict['videos']:
             # 1. Transcript
-            full_path = os.path.join(COURSES_DIR, v['path'])
-            base_path = os.path.splitext(full_path)[0]
-            v_dict['has_transcript'] = os.path.exists(base_path + ".vtt") or os.path.exists(base_path + ".srt")
+            folder, filename = os.path.split(os.path.join(COURSES_DIR, v_dict['path']))
+            if folder not in dir_entries:
+                try:
+                    dir_entries[folder] = set(os.listdir(folder))
+                except OSError:
+                    dir_entries[folder] = set()
+            stem = os.path.splitext(filename)[0]
+            v_dict['has_transcript'] = stem + ".vtt" in dir_entries[folder] or stem + ".srt" in dir_entries[folder]
             
             # 2. Quiz & Summary
-            v_dict['has_summary'] = 'summarize' in ai_map.get(v['path'], set())
-            v_dict['has_quiz'] = 'quiz' in ai_map.get(v['path'], set())
+            v_dict['has_summary'] = 'summarize' in ai_map.get(v_dict['path'], set())
+            v_dict['has_quiz'] = 'quiz' in ai_map.get(v_dict['path'], set())
             
             # Legacy quiz check (file)
-            if v['item_type'] == 'quiz': v_dict['has_quiz'] = True
-            
-            mod_dict['videos'].append(v_dict)
+            if v_dict['item_type'] == 'quiz': v_dict['has_quiz'] = True
         structure.append(mod_dict)
         
-    conn.close()
     return jsonify({"structure": structure})
 
 @app.route('/api/reset_progress', methods=['POST'])
@@ -2164,7 +4169,16 @@ def reset_progress():
     course_id = data.get('course_id')
     video_path = data.get('video_path')
     user_id = get_current_user_id()
-    conn = get_db_connection()
+    conn = get_db()
+    
+    # Pending heartbeats are dropped first, or the flusher would bring the progress back
+    if course_id == 'all':
+        discard_user_progress(user_id)
+    elif video_path:
+        discard_user_progress(user_id, {video_path})
+    elif course_id:
+        discard_user_progress(user_id, {row['path'] for row in conn.execute(
+            'SELECT v.path FROM videos v JOIN modules m ON v.module_id = m.id WHERE m.course_id = ?', (course_id,)).fetchall()})
     
     if course_id == 'all':
         if user_id:
@@ -2172,6 +4186,7 @@ def reset_progress():
             conn.execute('DELETE FROM watched_videos WHERE user_id = ?', (user_id,))
             conn.execute('DELETE FROM video_progress WHERE user_id = ?', (user_id,))
             conn.execute('DELETE FROM daily_activity WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM user_activity_state WHERE user_id = ?', (user_id,))
             conn.execute('DELETE FROM user_xp WHERE user_id = ?', (user_id,))
             conn.execute('DELETE FROM user_achievements WHERE user_id = ?', (user_id,))
             conn.execute('DELETE FROM quiz_stats WHERE user_id = ?', (user_id,))
@@ -2184,6 +4199,8 @@ def reset_progress():
             conn.execute('DELETE FROM course_progress WHERE user_id IS NULL')
             conn.execute('DELETE FROM watched_videos WHERE user_id IS NULL')
             conn.execute('DELETE FROM video_progress WHERE user_id IS NULL')
+        conn.execute('DELETE FROM user_course_stats WHERE user_id = ?', (user_id or 0,))
+        conn.execute('DELETE FROM video_watch_intervals WHERE user_id = ?', (user_id or 0,))
             
     elif video_path:
         if user_id:
@@ -2201,6 +4218,10 @@ def reset_progress():
                 UPDATE course_progress SET last_video_path = NULL, last_video_title = NULL, last_video_timestamp = 0
                 WHERE user_id IS NULL AND last_video_path = ?
             ''', (video_path,))
+        conn.execute('DELETE FROM video_watch_intervals WHERE user_id = ? AND video_path = ?', (user_id or 0, video_path))
+        row = conn.execute('SELECT m.course_id FROM videos v JOIN modules m ON v.module_id = m.id WHERE v.path = ?', (video_path,)).fetchone()
+        if row:
+            refresh_course_rollups(conn, row['course_id'], [user_id])
     
     elif course_id:
         if user_id:
@@ -2225,9 +4246,17 @@ def reset_progress():
                 )
             ''', (course_id,))
             conn.execute('DELETE FROM watched_videos WHERE course_id = ? AND user_id IS NULL', (course_id,))
+        conn.execute('DELETE FROM user_course_stats WHERE user_id = ? AND course_id = ?', (user_id or 0, course_id))
+        conn.execute('''
+            DELETE FROM video_watch_intervals
+            WHERE user_id = ? AND video_path IN (
+                SELECT v.path FROM videos v
+                JOIN modules m ON v.module_id = m.id
+                WHERE m.course_id = ?
+            )
+        ''', (user_id or 0, course_id))
 
     conn.commit()
-    conn.close()
     return jsonify({"status": "success"})
 
 @app.route('/api/update_course_description', methods=['POST'])
@@ -2239,10 +4268,9 @@ def update_course_description():
     
     if not course_id:
         return jsonify({"status": "error", "message": "Missing id"}), 400
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('UPDATE courses SET description = ?, alternate_title = ? WHERE id = ?', (description, alternate_title, course_id))
     conn.commit()
-    conn.close()
     return jsonify({"status": "success"})
 
 @app.route('/api/save_settings', methods=['POST'])
@@ -2256,7 +4284,7 @@ def save_settings():
     if not key:
         return jsonify({"status": "error", "message": "Key required"}), 400
         
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('''
         INSERT INTO user_settings (user_id, key, value, updated_at)
         VALUES (?, ?, ?, CURRENT_TIMESTAMP)
@@ -2265,10 +4293,10 @@ def save_settings():
             updated_at = excluded.updated_at
     ''', (user_id, key, value))
     conn.commit()
-    conn.close()
     return jsonify({"status": "success"})
 
 def call_ai_service(provider, api_key, model_name, local_url, system_instruction, user_prompt, user_id=None, action="unknown"):
+    """Returns the model's reply. Usage is logged to ai_logs on the request connection; the caller commits."""
     response_text = ""
     
     if provider == 'gemini':
@@ -2306,11 +4334,9 @@ def call_ai_service(provider, api_key, model_name, local_url, system_instruction
     # Log Usage
     if user_id:
         try:
-            conn = get_db_connection()
+            conn = get_db()
             conn.execute('INSERT INTO ai_logs (user_id, provider, model, action) VALUES (?, ?, ?, ?)', 
                          (user_id, provider, model_name, action))
-            conn.commit()
-            conn.close()
         except:
             pass
             
@@ -2330,26 +4356,17 @@ def get_embedding(text, api_key):
         print(f"Embedding error: {e}")
         return None
 
-def cosine_similarity(v1, v2):
-    if not v1 or not v2: return 0
-    dot_product = sum(a*b for a,b in zip(v1, v2))
-    magnitude1 = math.sqrt(sum(a*a for a in v1))
-    magnitude2 = math.sqrt(sum(b*b for b in v2))
-    if magnitude1 == 0 or magnitude2 == 0: return 0
-    return dot_product / (magnitude1 * magnitude2)
-
 @app.route('/api/generate_embeddings', methods=['POST'])
 @login_required
 def generate_embeddings():
     user_id = current_user.id
-    conn = get_db_connection()
+    conn = get_db()
     
     # Get API Key
     key_row = conn.execute("SELECT value FROM user_settings WHERE user_id=? AND key='gemini_api_key'", (user_id,)).fetchone()
     api_key = key_row['value'] if key_row else None
     
     if not api_key:
-        conn.close()
         return jsonify({"status": "error", "message": "Gemini API Key required for embeddings"}), 400
         
     # Get all videos
@@ -2372,23 +4389,21 @@ def generate_embeddings():
         # Generate
         emb = get_embedding(text, api_key)
         if emb:
-            conn.execute('INSERT INTO video_embeddings (video_path, embedding) VALUES (?, ?)', 
-                         (v['path'], json.dumps(emb)))
+            conn.execute('INSERT INTO video_embeddings (video_path, vector) VALUES (?, ?)', 
+                         (v['path'], pack_embedding(emb)))
             count += 1
             # Rate limit a bit just in case
             time.sleep(0.1)
             
     conn.commit()
-    conn.close()
     return jsonify({"status": "success", "generated": count})
 
 # --- Tagging API ---
 
 @app.route('/api/tags', methods=['GET'])
 def get_tags():
-    conn = get_db_connection()
+    conn = get_db()
     tags = conn.execute('SELECT * FROM tags ORDER BY name').fetchall()
-    conn.close()
     return jsonify([dict(t) for t in tags])
 
 @app.route('/api/tags', methods=['POST'])
@@ -2399,15 +4414,13 @@ def create_tag():
     if not name:
         return jsonify({"status": "error", "message": "Name required"}), 400
     
-    conn = get_db_connection()
+    conn = get_db()
     try:
         conn.execute('INSERT INTO tags (name, color) VALUES (?, ?)', (name, color))
         conn.commit()
         tag_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
-        conn.close()
         return jsonify({"status": "success", "tag": {"id": tag_id, "name": name, "color": color}})
     except sqlite3.IntegrityError:
-        conn.close()
         return jsonify({"status": "error", "message": "Tag already exists"}), 400
 
 @app.route('/api/tag_item', methods=['POST'])
@@ -2417,13 +4430,12 @@ def tag_item():
     item_type = request.json.get('item_type') # 'course', 'video'
     item_id = request.json.get('item_id') # course_id or video_path
     
-    conn = get_db_connection()
+    conn = get_db()
     try:
         conn.execute('INSERT INTO item_tags (tag_id, item_type, item_id) VALUES (?, ?, ?)', (tag_id, item_type, str(item_id)))
         conn.commit()
     except sqlite3.IntegrityError:
         pass # Already tagged
-    conn.close()
     return jsonify({"status": "success"})
 
 @app.route('/api/untag_item', methods=['POST'])
@@ -2433,10 +4445,9 @@ def untag_item():
     item_type = request.json.get('item_type')
     item_id = request.json.get('item_id')
     
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('DELETE FROM item_tags WHERE tag_id=? AND item_type=? AND item_id=?', (tag_id, item_type, str(item_id)))
     conn.commit()
-    conn.close()
     return jsonify({"status": "success"})
 
 @app.route('/api/get_item_tags', methods=['GET'])
@@ -2444,13 +4455,12 @@ def get_item_tags():
     item_type = request.args.get('item_type')
     item_id = request.args.get('item_id')
     
-    conn = get_db_connection()
+    conn = get_db()
     rows = conn.execute('''
         SELECT t.* FROM tags t
         JOIN item_tags it ON t.id = it.tag_id
         WHERE it.item_type = ? AND it.item_id = ?
     ''', (item_type, str(item_id))).fetchall()
-    conn.close()
     return jsonify([dict(r) for r in rows])
 
 # --- RSS Feed API ---
@@ -2461,10 +4471,9 @@ def ai_chat():
         
     user_id = current_user.id
     
-    conn = get_db_connection()
+    conn = get_db()
     settings_rows = conn.execute("SELECT key, value FROM user_settings WHERE user_id=? AND key IN ('gemini_api_key', 'ai_features_enabled', 'ai_provider', 'local_ai_url', 'gemini_model', 'local_model')", (user_id,)).fetchall()
     settings = {row['key']: row['value'] for row in settings_rows}
-    conn.close()
     
     if settings.get('ai_features_enabled', 'true') != 'true':
          return jsonify({"status": "error", "message": "AI features are disabled in settings."}), 403
@@ -2477,6 +4486,7 @@ def ai_chat():
     
     try:
         response_text = call_ai_service(provider, api_key, model_name, local_url, "You are a helpful assistant.", prompt, user_id, "chat_simple")
+        conn.commit()
         return jsonify({"status": "success", "response": response_text})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -2488,9 +4498,8 @@ def get_models():
          return jsonify({"status": "error", "message": "Google GenAI library not installed"}), 500
 
     user_id = current_user.id
-    conn = get_db_connection()
+    conn = get_db()
     row = conn.execute("SELECT value FROM user_settings WHERE user_id=? AND key='gemini_api_key'", (user_id,)).fetchone()
-    conn.close()
     
     if not row or not row['value']:
         # Return a basic default list if no key is saved yet, so the UI isn't empty
@@ -2540,14 +4549,7 @@ def convert_to_vtt(content):
                 start_sec = float(item.get('start', item.get('start_time', 0)))
                 end_sec = float(item.get('end', item.get('end_time', start_sec + 2)))
                 
-                def format_vtt_ts(s):
-                    hrs = int(s // 3600)
-                    mins = int((s % 3600) // 60)
-                    secs = int(s % 60)
-                    mils = int((s - int(s)) * 1000)
-                    return f"{hrs:02d}:{mins:02d}:{secs:02d}.{mils:03d}"
-                
-                ts = f"{format_vtt_ts(start_sec)} --> {format_vtt_ts(end_sec)}"
+                ts = f"{format_vtt_timestamp(start_sec)} --> {format_vtt_timestamp(end_sec)}"
                 vtt.append(f"{ts}\n{item.get('text', '')}\n")
             return "\n".join(vtt)
         except:
@@ -2564,21 +4566,22 @@ def get_or_generate_transcript(video_path, user_id):
     base_path = os.path.splitext(full_path)[0]
     
     # 1. Try to find existing
-    transcript_text = ""
-    for ext in ['.vtt', '.srt']:
-        if os.path.exists(base_path + ext):
-            with open(base_path + ext, 'r', encoding='utf-8', errors='ignore') as f:
-                transcript_text = f.read()
-            break
-            
-    if transcript_text:
+    transcript = get_transcript_cues(video_path)
+    if transcript is not None and len(transcript):
+        return transcript.to_text()
+    subtitle_path = subtitle_file_for(video_path)
+    if subtitle_path is not None:
+        # A file we can't parse into cues is still the transcript; never generate over it
+        with open(subtitle_path, 'r', encoding='utf-8', errors='ignore') as f:
+            transcript_text = f.read()
+        if not transcript_text.strip():
+            raise Exception("Transcript file is empty.")
         return transcript_text
 
     # 2. If not found, attempt generation
-    conn = get_db_connection()
+    conn = get_db()
     settings_rows = conn.execute("SELECT key, value FROM user_settings WHERE user_id=? AND key IN ('gemini_api_key', 'ai_features_enabled', 'ai_provider', 'local_whisper_url', 'gemini_model', 'local_model')", (user_id,)).fetchall()
     settings = {row['key']: row['value'] for row in settings_rows}
-    conn.close()
     
     if settings.get('ai_features_enabled', 'true') != 'true':
          raise Exception("No transcript found and AI features are disabled.")
@@ -2623,8 +4626,9 @@ def get_or_generate_transcript(video_path, user_id):
         response = client.models.generate_content(model=model_name, contents=[file_ref, prompt])
         vtt_content = convert_to_vtt(response.text)
         
-        with open(base_path + ".vtt", 'w', encoding='utf-8') as f: f.write(vtt_content)
-        return vtt_content
+        write_transcript(video_path, vtt_content)
+        transcript = get_transcript_cues(video_path)
+        return transcript.to_text() if transcript is not None and len(transcript) else vtt_content
         
     elif provider == 'local':
         if not local_whisper_url: raise Exception("Local Whisper URL not configured.")
@@ -2638,10 +4642,11 @@ def get_or_generate_transcript(video_path, user_id):
             resp = requests.post(local_whisper_url, files=files, data={'response_format': 'vtt'}, timeout=300)
             resp.raise_for_status()
             content = convert_to_vtt(resp.text)
-            with open(base_path + ".vtt", 'w', encoding='utf-8') as f: f.write(content)
+            write_transcript(video_path, content)
         
         if os.path.exists(audio_path): os.remove(audio_path)
-        return content
+        transcript = get_transcript_cues(video_path)
+        return transcript.to_text() if transcript is not None and len(transcript) else content
     
     raise Exception("Transcript not found and generation failed.")
 
@@ -2659,10 +4664,9 @@ def ai_chat_context():
     prompt = data.get('prompt', '')
     
     # 1. Get Settings
-    conn = get_db_connection()
+    conn = get_db()
     settings_rows = conn.execute("SELECT key, value FROM user_settings WHERE user_id=? AND key IN ('gemini_api_key', 'gemini_model', 'local_model', 'ai_features_enabled', 'ai_provider', 'local_ai_url')", (user_id,)).fetchall()
     settings = {row['key']: row['value'] for row in settings_rows}
-    conn.close()
     
     if settings.get('ai_features_enabled', 'true') != 'true':
          return jsonify({"status": "error", "message": "AI features are disabled in settings."}), 403
@@ -2767,11 +4771,9 @@ def ai_chat_context():
         
         # Save to History (except for chapters which are handled in their own table)
         if context_type not in ['chapters']:
-            conn = get_db_connection()
             conn.execute('INSERT INTO ai_generated_content (user_id, video_path, content_type, content, prompt) VALUES (?, ?, ?, ?, ?)',
                          (user_id, video_path, context_type, ai_text, prompt))
-            conn.commit()
-            conn.close()
+        conn.commit()  # With the usage log
 
         # Post-process for specific actions
         if context_type == 'flashcards':
@@ -2781,7 +4783,7 @@ def ai_chat_context():
                 cards = json.loads(clean_text)
                 
                 # Save to DB
-                conn = get_db_connection()
+                conn = get_db()
                 count = 0
                 today = datetime.date.today().strftime("%Y-%m-%d")
                 
@@ -2803,7 +4805,6 @@ def ai_chat_context():
                         ''', (user_id, course_id, video_path, card['front'], card['back'], today))
                         count += 1
                     conn.commit()
-                conn.close()
                 return jsonify({"status": "success", "flashcards_count": count})
                 
             except json.JSONDecodeError:
@@ -2819,14 +4820,13 @@ def ai_chat_context():
             clean_text = ai_text.replace('```json', '').replace('```', '').strip()
             try:
                 chapters = json.loads(clean_text)
-                conn = get_db_connection()
+                conn = get_db()
                 # Clear old
                 conn.execute('DELETE FROM video_chapters WHERE video_path = ?', (video_path,))
                 for ch in chapters:
                     conn.execute('INSERT INTO video_chapters (video_path, timestamp, title) VALUES (?, ?, ?)',
                                  (video_path, ch['timestamp'], ch['title']))
                 conn.commit()
-                conn.close()
                 return jsonify({"status": "success", "response": "Chapters generated"})
             except:
                 return jsonify({"status": "error", "message": "Failed to parse chapters JSON"})
@@ -2844,16 +4844,15 @@ def get_ai_history():
     if not video_path:
         return jsonify({"status": "error", "message": "Missing video_path"}), 400
         
-    conn = get_db_connection()
+    conn = get_db()
     rows = conn.execute('SELECT * FROM ai_generated_content WHERE user_id=? AND video_path=? ORDER BY created_at ASC', (user_id, video_path)).fetchall()
-    conn.close()
     return jsonify([dict(r) for r in rows])
 
 @app.route('/api/get_all_ai_history', methods=['GET'])
 @login_required
 def get_all_ai_history():
     user_id = current_user.id
-    conn = get_db_connection()
+    conn = get_db()
     rows = conn.execute('''
         SELECT h.*, v.title as video_title, c.title as course_title 
         FROM ai_generated_content h
@@ -2863,7 +4862,6 @@ def get_all_ai_history():
         WHERE h.user_id=? 
         ORDER BY h.created_at DESC
     ''', (user_id,)).fetchall()
-    conn.close()
     return jsonify([dict(r) for r in rows])
 
 @app.route('/api/delete_ai_history', methods=['POST'])
@@ -2871,10 +4869,9 @@ def get_all_ai_history():
 def delete_ai_history():
     user_id = current_user.id
     history_id = request.json.get('id')
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('DELETE FROM ai_generated_content WHERE id=? AND user_id=?', (history_id, user_id))
     conn.commit()
-    conn.close()
     return jsonify({"status": "success"})
 
 @app.route('/api/delete_ai_history_for_video', methods=['POST'])
@@ -2882,10 +4879,9 @@ def delete_ai_history():
 def delete_ai_history_for_video():
     user_id = current_user.id
     video_path = request.json.get('video_path')
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('DELETE FROM ai_generated_content WHERE video_path=? AND user_id=?', (video_path, user_id))
     conn.commit()
-    conn.close()
     return jsonify({"status": "success"})
 
 @app.route('/api/ai_course_chat', methods=['POST'])
@@ -2899,12 +4895,11 @@ def ai_course_chat():
     course_id = data.get('course_id')
     prompt = data.get('prompt')
     
-    conn = get_db_connection()
+    conn = get_db()
     settings_rows = conn.execute("SELECT key, value FROM user_settings WHERE user_id=? AND key IN ('gemini_api_key', 'gemini_model', 'ai_features_enabled', 'ai_provider', 'local_ai_url')", (user_id,)).fetchall()
     settings = {row['key']: row['value'] for row in settings_rows}
     
     if settings.get('ai_features_enabled', 'true') != 'true':
-         conn.close()
          return jsonify({"status": "error", "message": "AI features are disabled."}), 403
     
     api_key = settings.get('gemini_api_key')
@@ -2914,26 +4909,18 @@ def ai_course_chat():
 
     # Get Course Context
     course = conn.execute('SELECT title FROM courses WHERE id=?', (course_id,)).fetchone()
-    modules = conn.execute('SELECT id, title FROM modules WHERE course_id=? ORDER BY order_index', (course_id,)).fetchall()
+    modules = get_course_structure(conn, course_id)
     
     context_text = f"Course Title: {course['title']}\nCurriculum:\n"
     for mod in modules:
-        context_text += f"\nModule: {mod['title']}\n"
-        videos = conn.execute('SELECT title, path FROM videos WHERE module_id=? ORDER BY order_index', (mod['id'],)).fetchall()
-        for v in videos:
-            context_text += f"- {v['title']}\n"
+        context_text += f"\nModule: {mod.title}\n"
+        for v in mod.videos:
+            context_text += f"- {v.title}\n"
             # Try to get a tiny snippet of transcript for keywords
-            base_path = os.path.splitext(os.path.join(COURSES_DIR, v['path']))[0]
-            for ext in ['.vtt', '.srt']:
-                if os.path.exists(base_path + ext):
-                    try:
-                        with open(base_path + ext, 'r', encoding='utf-8', errors='ignore') as f:
-                            snippet = f.read()[:500] # Just first 500 chars for keywords
-                            context_text += f"  (Content Keywords: {snippet.replace('WEBVTT','').strip()[:200]}...)\n"
-                    except: pass
-                    break
+            transcript = get_transcript_cues(v.path)
+            if transcript is not None and len(transcript):
+                context_text += f"  (Content Keywords: {transcript.text[:200]}...)\n"
     
-    conn.close()
 
     system_instruction = f"""
     You are a course mentor. You have the curriculum and content snippets for the entire course.
@@ -2946,6 +4933,7 @@ def ai_course_chat():
 
     try:
         response_text = call_ai_service(provider, api_key, model_name, local_url, system_instruction, prompt, user_id, "global_course_chat")
+        conn.commit()
         return jsonify({"status": "success", "response": response_text})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -2959,12 +4947,11 @@ def generate_course_bible():
     user_id = current_user.id
     course_id = request.json.get('course_id')
     
-    conn = get_db_connection()
+    conn = get_db()
     settings_rows = conn.execute("SELECT key, value FROM user_settings WHERE user_id=? AND key IN ('gemini_api_key', 'gemini_model', 'ai_features_enabled', 'ai_provider', 'local_ai_url')", (user_id,)).fetchall()
     settings = {row['key']: row['value'] for row in settings_rows}
     
     if settings.get('ai_features_enabled', 'true') != 'true':
-         conn.close()
          return jsonify({"status": "error", "message": "AI features are disabled."}), 403
     
     api_key = settings.get('gemini_api_key')
@@ -2981,7 +4968,6 @@ def generate_course_bible():
         JOIN modules m ON v.module_id = m.id
         WHERE n.user_id = ? AND m.course_id = ?
     ''', (user_id, course_id)).fetchall()
-    conn.close()
 
     if not notes_rows:
         return jsonify({"status": "error", "message": "No notes found for this course. Write some notes first!"}), 400
@@ -3006,6 +4992,7 @@ def generate_course_bible():
 
     try:
         response_text = call_ai_service(provider, api_key, model_name, local_url, system_instruction, final_prompt, user_id, "course_bible")
+        conn.commit()
         return jsonify({"status": "success", "bible": response_text})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -3026,12 +5013,11 @@ def ai_plan_course():
     hours = data.get('hours_per_week', 5)
     
     # 1. Get Settings
-    conn = get_db_connection()
+    conn = get_db()
     settings_rows = conn.execute("SELECT key, value FROM user_settings WHERE user_id=? AND key IN ('gemini_api_key', 'gemini_model', 'local_model', 'ai_features_enabled', 'ai_provider', 'local_ai_url')", (user_id,)).fetchall()
     settings = {row['key']: row['value'] for row in settings_rows}
     
     if settings.get('ai_features_enabled', 'true') != 'true':
-         conn.close()
          return jsonify({"status": "error", "message": "AI features are disabled in settings."}), 403
     
     api_key = settings.get('gemini_api_key')
@@ -3041,20 +5027,18 @@ def ai_plan_course():
     
     # ... (course structure logic) ...
     course = conn.execute('SELECT title FROM courses WHERE id=?', (course_id,)).fetchone()
-    modules = conn.execute('SELECT id, title FROM modules WHERE course_id=? ORDER BY order_index', (course_id,)).fetchall()
+    modules = get_course_structure(conn, course_id)
     
     syllabus_text = f"Course: {course['title']}\n"
     total_seconds = 0
     
     for mod in modules:
-        syllabus_text += f"\nModule: {mod['title']}\n"
-        videos = conn.execute('SELECT title, duration FROM videos WHERE module_id=? ORDER BY order_index', (mod['id'],)).fetchall()
-        for v in videos:
-            dur = int(v['duration'])
+        syllabus_text += f"\nModule: {mod.title}\n"
+        for v in mod.videos:
+            dur = int(v.duration)
             total_seconds += dur
-            syllabus_text += f"- {v['title']} ({dur // 60} mins)\n"
+            syllabus_text += f"- {v.title} ({dur // 60} mins)\n"
     
-    conn.close()
 
     # 3. Construct Prompt
     system_instruction = "You are an expert curriculum designer."
@@ -3077,6 +5061,7 @@ def ai_plan_course():
     # 4. Call AI Service
     try:
         plan_text = call_ai_service(provider, api_key, model_name, local_url, system_instruction, final_prompt, user_id, "course_plan")
+        conn.commit()
         return jsonify({"status": "success", "plan": plan_text})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -3089,10 +5074,9 @@ def generate_transcript():
     video_path = data.get('video_path')
     
     # 1. Get Settings
-    conn = get_db_connection()
+    conn = get_db()
     settings_rows = conn.execute("SELECT key, value FROM user_settings WHERE user_id=? AND key IN ('gemini_api_key', 'ai_features_enabled', 'ai_provider', 'local_whisper_url', 'gemini_model', 'local_model')", (user_id,)).fetchall()
     settings = {row['key']: row['value'] for row in settings_rows}
-    conn.close()
     
     if settings.get('ai_features_enabled', 'true') != 'true':
          return jsonify({"status": "error", "message": "AI features are disabled."}), 403
@@ -3108,7 +5092,6 @@ def generate_transcript():
         return jsonify({"status": "error", "message": "File not found."}), 404
         
     base_path = os.path.splitext(full_path)[0]
-    vtt_path = base_path + ".vtt"
 
     # 3. Process based on Provider
     try:
@@ -3160,17 +5143,14 @@ def generate_transcript():
             )
             
             vtt_content = convert_to_vtt(response.text)
-                
-            with open(vtt_path, 'w', encoding='utf-8') as f:
-                f.write(vtt_content)
+            write_transcript(video_path, vtt_content)
             
             # Log Usage
             try:
-                conn = get_db_connection()
+                conn = get_db()
                 conn.execute('INSERT INTO ai_logs (user_id, provider, model, action) VALUES (?, ?, ?, ?)', 
                              (user_id, 'gemini', model_name, 'transcribe_video'))
                 conn.commit()
-                conn.close()
             except: pass
 
             return jsonify({"status": "success", "message": "Transcript generated with Gemini!"})
@@ -3201,9 +5181,7 @@ def generate_transcript():
                 resp.raise_for_status()
                 
                 content = convert_to_vtt(resp.text)
-                
-                with open(vtt_path, 'w', encoding='utf-8') as f:
-                    f.write(content)
+                write_transcript(video_path, content)
             
             # Cleanup wav
             if os.path.exists(audio_path):
@@ -3211,11 +5189,10 @@ def generate_transcript():
                 
             # Log Usage
             try:
-                conn = get_db_connection()
+                conn = get_db()
                 conn.execute('INSERT INTO ai_logs (user_id, provider, model, action) VALUES (?, ?, ?, ?)', 
                              (user_id, 'local', 'whisper', 'transcribe_video'))
                 conn.commit()
-                conn.close()
             except: pass
 
             return jsonify({"status": "success", "message": "Transcript generated locally!"})
@@ -3226,19 +5203,18 @@ def generate_transcript():
 @app.route('/certificate/<int:course_id>')
 @login_required
 def download_certificate(course_id):
-    conn = get_db_connection()
+    conn = get_db()
     user_id = current_user.id
     
     course = conn.execute('SELECT * FROM courses WHERE id = ?', (course_id,)).fetchone()
     if not course:
         abort(404)
         
-    stats = get_course_stats(conn, course_id, user_id)
+    stats = get_all_course_stats(conn, user_id, course_id).get(course_id, EMPTY_COURSE_STATS)
     total_videos = stats['total_videos']
     watched_count = stats['watched_count']
     total_duration = stats['total_duration']
     
-    conn.close()
     
     if watched_count < total_videos and total_videos > 0:
         if request.args.get('preview') != 'true':
@@ -3328,10 +5304,9 @@ def download_certificate(course_id):
 def generate_rss_token():
     user_id = current_user.id
     token = uuid.uuid4().hex
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('UPDATE users SET rss_token = ? WHERE id = ?', (token, user_id))
     conn.commit()
-    conn.close()
     return jsonify({"status": "success", "token": token})
 
 @app.route('/api/scrape_metadata', methods=['POST'])
@@ -3358,7 +5333,7 @@ def scrape_metadata():
         desc = og_tags.get('description')
         image = og_tags.get('image')
         
-        conn = get_db_connection()
+        conn = get_db()
         
         updates = []
         params = []
@@ -3391,12 +5366,13 @@ def scrape_metadata():
                         save_path = os.path.join(COURSES_DIR, course['folder_name'], f"cover.{ext}")
                         with open(save_path, 'wb') as f:
                             f.write(img_resp.content)
+                        conn.execute('UPDATE courses SET thumbnail = ? WHERE id = ?',
+                                     (resolve_course_thumbnail(os.path.dirname(save_path)), course_id))
                         saved_image = True
             except:
                 pass
                 
         conn.commit()
-        conn.close()
         
         return jsonify({
             "status": "success", 
@@ -3414,7 +5390,7 @@ def import_youtube():
     url = request.json.get('url')
     if not url: return jsonify({"status":"error"}), 400
     
-    conn = get_db_connection()
+    conn = get_db()
     try:
         ydl_opts = {
             'extract_flat': True, 
@@ -3430,7 +5406,6 @@ def import_youtube():
             # Check existing
             exists = conn.execute('SELECT id FROM courses WHERE folder_name = ?', ("YT_" + safe_title,)).fetchone()
             if exists:
-                conn.close()
                 return jsonify({"status": "error", "message": "Course already exists"}), 400
                 
             # Create Course
@@ -3453,11 +5428,13 @@ def import_youtube():
                     INSERT INTO videos (module_id, title, filename, path, order_index, duration, item_type, source_id)
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)
                 ''', (module_id, v_title, "youtube_video", "yt:" + v_id, idx, v_dur, 'video', v_id))
+            
+            refresh_course_rollups(conn, course_id)
                 
         conn.commit()
+        invalidate_course_structure(course_id)
         return jsonify({"status": "success"})
     except Exception as e:
-        conn.close()
         return jsonify({"status": "error", "message": str(e)}), 500
 
 # --- TTS API ---
@@ -3483,7 +5460,7 @@ def export_anki():
     user_id = current_user.id
     course_id = request.args.get('course_id')
     
-    conn = get_db_connection()
+    conn = get_db()
     if course_id:
         cards = conn.execute('SELECT * FROM flashcards WHERE user_id=? AND course_id=?', (user_id, course_id)).fetchall()
         course = conn.execute('SELECT title FROM courses WHERE id=?', (course_id,)).fetchone()
@@ -3491,7 +5468,6 @@ def export_anki():
     else:
         cards = conn.execute('SELECT * FROM flashcards WHERE user_id=?', (user_id,)).fetchall()
         deck_name = "SkillForge All Cards"
-    conn.close()
     
     if not cards:
         return "No cards to export", 400
@@ -3525,7 +5501,7 @@ def export_anki():
 @login_required
 def get_comments():
     video_path = request.args.get('video_path')
-    conn = get_db_connection()
+    conn = get_db()
     rows = conn.execute('''
         SELECT c.*, u.name as user_name, u.profile_pic 
         FROM comments c 
@@ -3533,18 +5509,16 @@ def get_comments():
         WHERE c.video_path = ? 
         ORDER BY c.timestamp ASC
     ''', (video_path,)).fetchall()
-    conn.close()
     return jsonify([dict(r) for r in rows])
 
 @app.route('/api/comments', methods=['POST'])
 @login_required
 def post_comment():
     data = request.json
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('INSERT INTO comments (user_id, video_path, timestamp, text, parent_id) VALUES (?, ?, ?, ?, ?)',
                  (current_user.id, data['video_path'], data['timestamp'], data['text'], data.get('parent_id')))
     conn.commit()
-    conn.close()
     return jsonify({"status":"success"})
 
 # --- Graph Data API ---
@@ -3556,58 +5530,59 @@ def graph_page():
 @app.route('/api/graph_data')
 @login_required
 def get_graph_data():
-    conn = get_db_connection()
+    conn = get_db()
+    paths, matrix = get_embedding_matrix(conn)
+    row_of = {path: i for i, path in enumerate(paths)}
     # Nodes
     videos = conn.execute('''
-        SELECT v.path, v.title, c.title as course_title, m.title as module_title, e.embedding
+        SELECT v.path, v.title, c.title as course_title, m.title as module_title
         FROM videos v
         JOIN modules m ON v.module_id = m.id
         JOIN courses c ON m.course_id = c.id
-        JOIN video_embeddings e ON v.path = e.video_path
     ''').fetchall()
     
     nodes = []
-    links = []
-    video_list = []
-    
+    rows = []
     for v in videos:
-        try:
-            emb = json.loads(v['embedding'])
+        if v['path'] in row_of:
             nodes.append({
                 "id": v['path'],
                 "name": v['title'],
                 "group": v['course_title'],
                 "module": v['module_title']
             })
-            video_list.append({'id': v['path'], 'emb': emb})
-        except: pass
+            rows.append(row_of[v['path']])
         
-    # Generate Links based on similarity
+    # Generate Links based on similarity (vectors are unit length, so dot product = cosine)
     # Limit to top connections to avoid spaghetti
-    for i in range(len(video_list)):
-        for j in range(i+1, len(video_list)):
-            score = cosine_similarity(video_list[i]['emb'], video_list[j]['emb'])
-            if score > 0.75: # Threshold
-                links.append({"source": video_list[i]['id'], "target": video_list[j]['id'], "value": score})
+    links = []
+    if rows and np is not None:
+        sub = matrix[rows]
+        sims = sub @ sub.T
+        for i, j in zip(*np.nonzero(np.triu(sims > 0.75, 1))):
+            links.append({"source": nodes[i]['id'], "target": nodes[j]['id'], "value": float(sims[i, j])})
+    else:
+        for i in range(len(rows)):
+            for j in range(i+1, len(rows)):
+                score = sum(a * b for a, b in zip(matrix[rows[i]], matrix[rows[j]]))
+                if score > 0.75: # Threshold
+                    links.append({"source": nodes[i]['id'], "target": nodes[j]['id'], "value": score})
                 
-    conn.close()
     return jsonify({"nodes": nodes, "links": links})
 
 @app.route('/feed/<token>/<int:course_id>/feed.xml')
 def course_rss_feed(token, course_id):
-    conn = get_db_connection()
+    conn = get_db()
     user = conn.execute('SELECT * FROM users WHERE rss_token = ?', (token,)).fetchone()
     
     if not user:
-        conn.close()
         return "Unauthorized", 401
     
     course = conn.execute('SELECT * FROM courses WHERE id = ?', (course_id,)).fetchone()
     if not course:
-        conn.close()
         return "Course not found", 404
         
-    modules = conn.execute('SELECT * FROM modules WHERE course_id = ? ORDER BY order_index', (course_id,)).fetchall()
+    modules = get_course_structure(conn, course_id)
     
     # Build RSS
     base_url = request.url_root.rstrip('/')
@@ -3621,29 +5596,23 @@ def course_rss_feed(token, course_id):
     xml.append(f'<link>{base_url}/course/{course_id}</link>')
     
     # Add Image
-    course_folder = os.path.join(COURSES_DIR, course['folder_name'])
-    thumb_url = None
-    for ext in ['jpg', 'png', 'jpeg', 'webp']:
-        if os.path.exists(os.path.join(course_folder, f"cover.{ext}")):
-                thumb_url = f"{base_url}/course_file/{course['id']}/cover.{ext}"
-                break
+    thumb_url = course_thumbnail_url(course['id'], course['thumbnail'], base_url)
     if thumb_url:
         xml.append(f'<image><url>{thumb_url}</url><title>{course["title"]}</title><link>{base_url}</link></image>')
         xml.append(f'<itunes:image href="{thumb_url}"/>')
     
     for module in modules:
-        videos = conn.execute('SELECT * FROM videos WHERE module_id = ? ORDER BY order_index', (module['id'],)).fetchall()
-        for video in videos:
-            if video['item_type'] != 'video': continue
+        for video in module.videos:
+            if video.item_type != 'video': continue
             
-            title = f"{module['title']} - {video['title']}"
-            file_url = f"{base_url}/media/{video['path']}"
-            guid = f"{course_id}-{video['id']}"
+            title = f"{module.title} - {video.title}"
+            file_url = f"{base_url}/media/{video.path}"
+            guid = f"{course_id}-{video.id}"
             
             # Estimate file size if possible (optional)
             file_size = 0
             try:
-                full_path = os.path.join(COURSES_DIR, video['path'])
+                full_path = os.path.join(COURSES_DIR, video.path)
                 file_size = os.path.getsize(full_path)
             except: pass
             
@@ -3657,12 +5626,33 @@ def course_rss_feed(token, course_id):
     xml.append('</channel>')
     xml.append('</rss>')
     
-    conn.close()
     return Response("\n".join(xml), mimetype='application/rss+xml')
 
+@app.cli.command('rebuild-achievements')
+def rebuild_achievements_command():
+    """Rebuilds every user's activity state from daily_activity and awards achievements it now earns.
+
+    Run after importing or editing activity outside the app: flask --app app rebuild-achievements
+    """
+    flush_progress_buffer()
+    conn = get_db_connection()
+    try:
+        rebuild_activity_state(conn)
+        unlocked = 0
+        for row in conn.execute('SELECT id FROM users').fetchall():
+            unlocked += len(check_new_achievements(conn, row['id'], backfill=True))
+        conn.commit()
+    finally:
+        conn.close()
+    print(f"Rebuilt activity state; {unlocked} achievement(s) unlocked.")
+
 # Ensure DB is initialized on startup
 with app.app_context():
     init_db()
+    report_sqlite_profile()
 
 if __name__ == '__main__':
+    # debug=True runs under the reloader; only the serving child process runs the watcher
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_library_watcher()
     app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
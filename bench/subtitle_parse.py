@@ -0,0 +1,145 @@
+"""Benchmarks the streaming subtitle parser against the old split('\\n\\n') parser.
+
+Generates SRT and VTT files the length of a long lecture (one cue every two
+seconds) and a 10x version, checks both parsers agree, and reports the best
+of several runs plus peak memory:
+
+    python bench/subtitle_parse.py [--runs 5]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Importing app opens its database; point it at a scratch file
+os.environ.setdefault('SKILLFORGE_DB_FILE', os.path.join(tempfile.mkdtemp(prefix='skillforge-bench-'), 'courses.db'))
+
+from app import format_vtt_timestamp, iter_subtitle_cues, parse_timestamp  # noqa: E402
+
+CUE_COUNTS = (7200, 72000)  # A 4 hour lecture, and ten of them
+
+
+def old_parse_subtitle_cues(content):
+    """The parser iter_subtitle_cues replaced: reads the whole file and splits it into blocks."""
+    content = content.replace('\r\n', '\n').replace('\r', '\n').strip()
+
+    json_str = ""
+    if content.startswith('[') or content.startswith('{'):
+        json_str = content
+    elif 'WEBVTT' in content and '[' in content:
+        json_str = content.split('[', 1)[1]
+        json_str = '[' + json_str.rsplit(']', 1)[0] + ']'
+
+    cues = None
+    if json_str:
+        try:
+            data = json.loads(json_str)
+        except ValueError:
+            last_brace = json_str.rfind('}')
+            try:
+                data = json.loads(json_str[:last_brace + 1] + ']') if last_brace != -1 else []
+            except ValueError:
+                data = []
+        if data:
+            cues = []
+            for item in data:
+                try:
+                    cue = (float(item.get('start', item.get('start_time', 0))), None, item.get('text', ''))
+                except (AttributeError, TypeError, ValueError):
+                    continue
+                try:
+                    cue = (cue[0], float(item.get('end', item.get('end_time'))), cue[2])
+                except (TypeError, ValueError):
+                    pass
+                cues.append(cue)
+
+    if cues is None:
+        cues = []
+        for block in content.split('\n\n'):
+            lines = block.split('\n')
+            if len(lines) >= 2:
+                timestamp_line = lines[1] if lines[0].isdigit() else lines[0]
+                if '-->' in timestamp_line:
+                    start_str, end_str = timestamp_line.split('-->', 1)
+                    try:
+                        end = parse_timestamp(end_str.split()[0])
+                    except (ValueError, IndexError):
+                        end = None
+                    text = " ".join(lines[lines.index(timestamp_line) + 1:])
+                    cues.append((parse_timestamp(start_str), end, text))
+
+    for i, (start, end, text) in enumerate(cues):
+        if end is None:
+            cues[i] = (start, cues[i + 1][0] if i + 1 < len(cues) else start, text)
+    return cues
+
+
+def write_subtitles(path, count, srt):
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur']
+    with open(path, 'w', newline='') as f:
+        if not srt:
+            f.write('WEBVTT\r\n\r\n')
+        for i in range(count):
+            timing = f'{format_vtt_timestamp(i * 2)} --> {format_vtt_timestamp(i * 2 + 1.9)}'
+            if srt:
+                f.write(f'{i + 1}\r\n')
+                timing = timing.replace('.', ',')
+            f.write(f"{timing}\r\n{' '.join(random.choices(words, k=7))}\r\nsecond line\r\n\r\n")
+
+
+def old_parse(path):
+    with open(path, encoding='utf-8', errors='ignore') as f:
+        return old_parse_subtitle_cues(f.read())
+
+
+def new_parse(path):
+    with open(path, encoding='utf-8', errors='ignore') as f:
+        return list(iter_subtitle_cues(f))
+
+
+def new_stream(path):
+    # What the transcript store and search indexer do: consume cues as they arrive
+    with open(path, encoding='utf-8', errors='ignore') as f:
+        return sum(1 for _ in iter_subtitle_cues(f))
+
+
+def measure(fn, path, runs):
+    best = float('inf')
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn(path)
+        best = min(best, time.perf_counter() - started)
+    tracemalloc.start()
+    fn(path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='Timed runs per parser (best is reported)')
+    args = parser.parse_args()
+
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as workdir:
+        for count in CUE_COUNTS:
+            for srt in (True, False):
+                path = os.path.join(workdir, f'bench_{count}.{"srt" if srt else "vtt"}')
+                write_subtitles(path, count, srt)
+                if old_parse(path) != new_parse(path):
+                    sys.exit(f'{path}: parsers disagree')
+                results = []
+                for fn in (old_parse, new_parse, new_stream):
+                    elapsed, peak = measure(fn, path, args.runs)
+                    results.append(f'{fn.__name__} {elapsed * 1000:.0f} ms, peak {peak / 1e6:.1f} MB')
+                print(f'{count} cues {"SRT" if srt else "VTT"} ({os.path.getsize(path) / 1e6:.1f} MB): ' + ' | '.join(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# app.py opens (and migrates) its database at import time; keep test runs away from courses.db
+os.environ.setdefault('SKILLFORGE_DB_FILE', os.path.join(tempfile.mkdtemp(prefix='skillforge-tests-'), 'courses.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,98 @@
+import os
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    """An empty courses/ folder; courses scanned from it are removed afterwards."""
+    monkeypatch.setattr(app, 'COURSES_DIR', str(tmp_path))
+    monkeypatch.setattr(app, 'probe_media_duration', lambda path: 60.0)
+    yield tmp_path
+    conn = app.get_db_connection()
+    for name in os.listdir(tmp_path):
+        row = conn.execute('SELECT id FROM courses WHERE folder_name = ?', (name,)).fetchone()
+        if row:
+            app.remove_course(conn, row['id'])
+    conn.commit()
+    conn.close()
+
+
+def make_course(root, name):
+    module = root / name / '01 Basics'
+    module.mkdir(parents=True)
+    (module / '01 intro.mp4').write_bytes(b'')
+    (module / 'slides.pdf').write_bytes(b'%PDF')
+
+
+def course_rows(name):
+    conn = app.get_db_connection()
+    row = conn.execute('SELECT id FROM courses WHERE folder_name = ?', (name,)).fetchone()
+    counts = None
+    if row:
+        counts = tuple(conn.execute(sql, (row['id'],)).fetchone()[0] for sql in (
+            'SELECT COUNT(*) FROM modules WHERE course_id = ?',
+            'SELECT COUNT(*) FROM videos v JOIN modules m ON v.module_id = m.id WHERE m.course_id = ?',
+            'SELECT COUNT(*) FROM course_resources WHERE course_id = ?',
+            'SELECT COUNT(*) FROM library_dirs WHERE course_id = ?',
+        ))
+    conn.close()
+    return counts
+
+
+def test_deleted_course_folder_is_removed_by_the_watcher_rescan(library):
+    make_course(library, 'scan_keep')
+    make_course(library, 'scan_gone')
+    app.scan_courses()
+    assert course_rows('scan_gone') == (1, 1, 1, 2)
+
+    for root, dirs, files in os.walk(library / 'scan_gone', topdown=False):
+        for name in files:
+            os.remove(os.path.join(root, name))
+        os.rmdir(root)
+    app.scan_courses(['scan_gone'])
+
+    assert course_rows('scan_gone') is None
+    assert course_rows('scan_keep') == (1, 1, 1, 2)
+    conn = app.get_db_connection()
+    assert conn.execute("SELECT COUNT(*) FROM videos WHERE path LIKE 'scan_gone/%'").fetchone()[0] == 0
+    assert conn.execute("SELECT COUNT(*) FROM library_dirs WHERE path LIKE 'scan_gone%'").fetchone()[0] == 0
+    conn.close()
+
+
+def test_full_scan_removes_missing_courses_but_not_on_an_empty_library(library):
+    make_course(library, 'scan_a')
+    make_course(library, 'scan_b')
+    app.scan_courses()
+    (library / 'scan_b').rename(library.parent / 'scan_b_moved')
+
+    app.scan_courses()
+    assert course_rows('scan_b') is None
+    assert course_rows('scan_a') is not None
+
+    # An empty library (e.g. an unmounted drive) keeps the catalogue
+    (library / 'scan_a').rename(library.parent / 'scan_a_moved')
+    app.scan_courses()
+    assert course_rows('scan_a') is not None
+    (library.parent / 'scan_a_moved').rename(library / 'scan_a')
+
+
+def test_modules_follow_the_folder_order_after_a_rescan(library):
+    for folder in ('10 Deploying', '2 Testing', '01 Basics'):
+        (library / 'scan_order' / folder).mkdir(parents=True)
+        (library / 'scan_order' / folder / 'a.mp4').write_bytes(b'')
+    app.scan_courses()
+
+    (library / 'scan_order' / '3 Debugging').mkdir()
+    (library / 'scan_order' / '3 Debugging' / 'a.mp4').write_bytes(b'')
+    app.scan_courses(['scan_order'])
+
+    conn = app.get_db_connection()
+    titles = [row['title'] for row in conn.execute('''
+        SELECT m.title FROM modules m JOIN courses c ON m.course_id = c.id
+        WHERE c.folder_name = 'scan_order' ORDER BY m.order_index
+    ''')]
+    conn.close()
+    assert titles == ['01 Basics', '2 Testing', '3 Debugging', '10 Deploying']
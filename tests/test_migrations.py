@@ -0,0 +1,31 @@
+import sqlite3
+
+from app import MIGRATIONS, run_migrations, sql_statements
+
+
+def test_sql_statements_ignores_semicolons_in_literals_comments_and_triggers():
+    script = '''
+        CREATE TABLE t (a TEXT DEFAULT 'x;y'); -- note; not a statement
+        CREATE TRIGGER t_ai AFTER INSERT ON t BEGIN
+            UPDATE t SET a = 'z'; SELECT 1;
+        END;
+        CREATE INDEX idx_t_a ON t (a)
+    '''
+    statements = sql_statements(script)
+    assert len(statements) == 3
+    assert statements[0] == "CREATE TABLE t (a TEXT DEFAULT 'x;y');"
+    assert statements[1].endswith('END;')
+    assert all(sqlite3.complete_statement(statement) for statement in statements)
+
+
+def test_migrations_run_once_on_a_fresh_database():
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    run_migrations(conn)
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+    tables = {row['name'] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {'courses', 'modules', 'videos', 'users', 'video_progress', 'search_index'} <= tables
+    # A current database is left alone
+    run_migrations(conn)
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+    conn.close()
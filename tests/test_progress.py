@@ -0,0 +1,71 @@
+import pytest
+
+import app
+
+
+@pytest.fixture
+def video():
+    """A course with one 100 s video; removed again afterwards."""
+    conn = app.get_db_connection()
+    course_id = conn.execute("INSERT INTO courses (title, folder_name) VALUES ('Progress', 'progress_course')").lastrowid
+    module_id = conn.execute("INSERT INTO modules (course_id, title, order_index) VALUES (?, 'Basics', 0)", (course_id,)).lastrowid
+    conn.execute("INSERT INTO videos (module_id, title, filename, path, order_index, duration) VALUES (?, 'Intro', 'intro.mp4', 'progress_course/intro.mp4', 0, 100)",
+                 (module_id,))
+    conn.commit()
+    yield course_id, 'progress_course/intro.mp4'
+    app.flush_progress_buffer()
+    conn.execute('DELETE FROM courses WHERE id = ?', (course_id,))
+    conn.execute("DELETE FROM video_progress WHERE video_path LIKE 'progress_course/%'")
+    conn.execute("DELETE FROM video_watch_intervals WHERE video_path LIKE 'progress_course/%'")
+    conn.commit()
+    conn.close()
+
+
+def stored_progress(video_path):
+    conn = app.get_db_connection()
+    row = conn.execute('SELECT watched_time FROM video_progress WHERE user_id IS NULL AND video_path = ?', (video_path,)).fetchone()
+    conn.close()
+    return row['watched_time'] if row else None
+
+
+def test_unknown_video_paths_are_not_buffered(video):
+    course_id, video_path = video
+    response = app.app.test_client().post('/api/progress_batch', json={'course_id': 999, 'segments': [
+        {'video_path': 'nope/x.mp4', 'video_title': 'x', 'start': 0, 'position': 20},
+        {'video_path': video_path, 'video_title': 'Intro', 'start': 0, 'position': 30},
+    ]})
+    assert response.status_code == 200
+    assert app.buffered_intervals(None, 'nope/x.mp4') is None
+    app.flush_progress_buffer()
+    assert stored_progress(video_path) == 30
+    assert stored_progress('nope/x.mp4') is None
+
+
+def test_flush_drops_entries_for_videos_no_longer_in_the_library(video):
+    course_id, video_path = video
+    client = app.app.test_client()
+    client.post('/api/progress_batch', json={'course_id': course_id, 'segments': [
+        {'video_path': video_path, 'video_title': 'Intro', 'start': 0, 'position': 40},
+    ]})
+    # As if the video had been removed by a rescan after this heartbeat was buffered
+    with app._progress_buffer_lock:
+        app._progress_buffer[(None, 'gone/y.mp4')] = {'course_id': 999, 'title': 'y', 'position': 10, 'max_time': 10,
+                                                      'intervals': [(0.0, 10.0)], 'seq': 0}
+    app.flush_progress_buffer()
+    assert stored_progress(video_path) == 40
+    assert app.buffered_user_progress(None)[0] == {}
+
+
+def test_heartbeat_during_a_flush_does_not_recount_in_flight_time(video):
+    course_id, video_path = video
+    client = app.app.test_client()
+    post = lambda position: client.post('/api/progress_batch', json={'course_id': course_id, 'segments': [
+        {'video_path': video_path, 'video_title': 'Intro', 'start': 0, 'position': position},
+    ]})
+    post(30)
+    # A flush has taken the batch but not committed it yet
+    batch = app._take_buffered(lambda user_id: user_id is None)
+    post(40)
+    assert app.buffered_intervals(None, video_path) == [(0.0, 40.0)]
+    assert sum(app.buffered_user_progress(None)[1].values()) == 40
+    app._settle_buffered(batch, committed=False)
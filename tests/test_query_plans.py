@@ -0,0 +1,98 @@
+import re
+import sqlite3
+
+import pytest
+
+from app import run_migrations
+
+# The per-request queries the migrations index for, with placeholders bound to 1
+HOT_QUERIES = {
+    'continue_watching': '''
+        SELECT v.title as video_title, v.path as video_path, v.duration, v.order_index,
+               c.title as course_title, c.id as course_id, c.thumbnail as course_thumbnail,
+               vp.watched_time, vp.updated_at
+        FROM video_progress vp
+        JOIN videos v ON vp.video_path = v.path
+        JOIN modules m ON v.module_id = m.id
+        JOIN courses c ON m.course_id = c.id
+        WHERE vp.user_id = ? AND vp.is_completed = 0 AND vp.watched_time > 0
+        ORDER BY vp.updated_at DESC
+        LIMIT ?
+    ''',
+    'course_stats': '''
+        SELECT c.id, c.total_videos, c.total_duration, s.watched_count, s.watched_time, s.completed_count
+        FROM courses c
+        LEFT JOIN user_course_stats s ON s.course_id = c.id AND s.user_id = ?
+        WHERE c.id = ?
+    ''',
+    'course_tree_progress': '''
+        SELECT vp.video_path, vp.watched_time, vp.is_completed
+        FROM video_progress vp
+        JOIN videos v ON vp.video_path = v.path
+        JOIN modules m ON v.module_id = m.id
+        WHERE m.course_id = ? AND vp.user_id = ?
+    ''',
+    'course_tree_mastery': '''
+        SELECT vm.video_path, vm.score
+        FROM video_mastery vm
+        JOIN videos v ON vm.video_path = v.path
+        JOIN modules m ON v.module_id = m.id
+        WHERE m.course_id = ? AND vm.user_id = ?
+    ''',
+    'course_rollups': '''
+        SELECT COALESCE(vp.user_id, 0) as uid, COUNT(DISTINCT vp.video_path) as count,
+               SUM(CASE WHEN vp.is_completed THEN v.duration ELSE vp.watched_time END) as time
+        FROM video_progress vp
+        JOIN videos v ON vp.video_path = v.path
+        JOIN modules m ON v.module_id = m.id
+        WHERE m.course_id = ?
+        GROUP BY uid
+    ''',
+    'player_resume': 'SELECT * FROM course_progress WHERE course_id = ? AND user_id = ?',
+    'save_progress': 'SELECT watched_time, is_completed FROM video_progress WHERE user_id=? AND video_path=?',
+    'video_lookup': 'SELECT v.duration, m.course_id FROM videos v JOIN modules m ON v.module_id = m.id WHERE v.path = ? LIMIT 1',
+    'watch_intervals': 'SELECT intervals FROM video_watch_intervals WHERE user_id = ? AND video_path = ?',
+    'bookmarks': 'SELECT * FROM bookmarks WHERE user_id = ? AND course_id = ? ORDER BY timestamp',
+    'study_due_cards': 'SELECT * FROM flashcards WHERE user_id = ? AND next_review_date <= ? ORDER BY next_review_date',
+    'calendar_cards': '''
+        SELECT next_review_date, COUNT(*) as c
+        FROM flashcards
+        WHERE user_id = ? AND next_review_date BETWEEN ? AND ?
+        GROUP BY next_review_date
+    ''',
+    'comments': '''
+        SELECT c.*, u.name as user_name, u.profile_pic
+        FROM comments c
+        JOIN users u ON c.user_id = u.id
+        WHERE c.video_path = ?
+        ORDER BY c.timestamp ASC
+    ''',
+    'ai_history': 'SELECT * FROM ai_generated_content WHERE user_id=? AND video_path=? ORDER BY created_at ASC',
+    'ai_assets': '''
+        SELECT ai.video_path, ai.content_type
+        FROM ai_generated_content ai
+        JOIN videos v ON ai.video_path = v.path
+        JOIN modules m ON v.module_id = m.id
+        WHERE ai.user_id = ? AND m.course_id = ? AND ai.content_type IN ('summarize', 'quiz')
+    ''',
+    'ai_daily_usage': 'SELECT date(timestamp) as d, COUNT(*) as c FROM ai_logs WHERE user_id=? GROUP BY date(timestamp)',
+    'daily_activity': 'SELECT date, seconds_watched, videos_completed FROM daily_activity WHERE user_id=?',
+}
+
+FULL_SCAN = re.compile(r'\bSCAN (\w+)(?! USING)')
+
+
+@pytest.fixture(scope='module')
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    run_migrations(conn)
+    yield conn
+    conn.close()
+
+
+@pytest.mark.parametrize('name', sorted(HOT_QUERIES))
+def test_hot_query_uses_indexes(conn, name):
+    sql = HOT_QUERIES[name]
+    plan = [row['detail'] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, [1] * sql.count('?')).fetchall()]
+    assert not [detail for detail in plan if FULL_SCAN.search(detail)], plan
@@ -0,0 +1,33 @@
+import pytest
+
+import app
+
+
+@pytest.fixture
+def conn():
+    conn = app.get_db_connection()
+    course_id = conn.execute("INSERT INTO courses (title, folder_name) VALUES ('Search', 'search_course')").lastrowid
+    module_id = conn.execute("INSERT INTO modules (course_id, title, order_index) VALUES (?, 'Basics', 0)", (course_id,)).lastrowid
+    conn.execute("INSERT INTO videos (module_id, title, filename, path, order_index) VALUES (?, 'Intro', 'intro.mp4', 'search_course/intro.mp4', 0)",
+                 (module_id,))
+    conn.commit()
+    yield conn
+    conn.execute("DELETE FROM video_notes WHERE video_path = 'search_course/intro.mp4'")
+    conn.execute('DELETE FROM courses WHERE id = ?', (course_id,))
+    conn.commit()
+    conn.close()
+
+
+def test_anonymous_notes_are_found_by_anonymous_search(conn):
+    conn.execute("INSERT INTO video_notes (user_id, video_path, content) VALUES (NULL, 'search_course/intro.mp4', 'zanzibar anonymous note')")
+    conn.commit()
+    hits, facets, _ = app.search_library(conn, 'zanzibar', None, types=('note',))
+    assert [hit['type'] for hit in hits] == ['note']
+    assert facets['types'] == {'note': 1}
+
+
+def test_personal_records_stay_private(conn):
+    conn.execute("INSERT INTO video_notes (user_id, video_path, content) VALUES (NULL, 'search_course/intro.mp4', 'quokka private note')")
+    conn.commit()
+    hits, _, _ = app.search_library(conn, 'quokka', 4242, types=('note',))
+    assert hits == []
@@ -0,0 +1,87 @@
+import io
+
+from app import iter_subtitle_cues
+
+
+def parse(text):
+    # newline='' keeps CRLF endings, as a subtitle file opened in binary-safe mode would
+    return list(iter_subtitle_cues(io.StringIO(text, newline='')))
+
+
+def test_srt():
+    text = (
+        '1\n00:00:01,000 --> 00:00:03,500\nhello\nline two\n\n'
+        '2\n00:00:05,000 --> 00:00:07,000\nbye\n'
+    )
+    assert parse(text) == [(1.0, 3.5, 'hello line two'), (5.0, 7.0, 'bye')]
+
+
+def test_srt_crlf():
+    text = '1\r\n00:00:01,000 --> 00:00:02,000\r\nhello\r\n\r\n2\r\n00:00:03,000 --> 00:00:04,000\r\nworld\r\n'
+    assert parse(text) == [(1.0, 2.0, 'hello'), (3.0, 4.0, 'world')]
+
+
+def test_vtt_header_and_cue_settings():
+    text = (
+        'WEBVTT\nKind: captions\nLanguage: en\n\n'
+        '00:01.000 --> 00:02.000 align:start position:0%\nhi [Music]\n\n'
+        '00:00:03.000 --> 00:00:04.000\nthere\n'
+    )
+    assert parse(text) == [(1.0, 2.0, 'hi [Music]'), (3.0, 4.0, 'there')]
+
+
+def test_vtt_note_style_and_cue_ids():
+    text = (
+        'WEBVTT\n\n'
+        'NOTE a comment\nspanning --> lines\n\n'
+        'STYLE\n::cue { color: red }\n\n'
+        'REGION\nid:fred\n\n'
+        'intro\n00:00:01.000 --> 00:00:02.000\nwith id\n\n'
+        '00:00:03.000 --> 00:00:04.000\nwithout\n'
+    )
+    assert parse(text) == [(1.0, 2.0, 'with id'), (3.0, 4.0, 'without')]
+
+
+def test_vtt_crlf_and_bom():
+    text = '﻿WEBVTT\r\n\r\n00:00:01.000 --> 00:00:02.000\r\nhello\r\n\r\n00:00:02.500 --> 00:00:03.000\r\nagain\r\n'
+    assert parse(text) == [(1.0, 2.0, 'hello'), (2.5, 3.0, 'again')]
+
+
+def test_missing_end_time_runs_to_next_cue():
+    text = '00:00:01.000 -->\nfirst\n\n00:00:04.000 -->\nlast\n'
+    assert parse(text) == [(1.0, 4.0, 'first'), (4.0, 4.0, 'last')]
+
+
+def test_json_list():
+    text = '[{"start": 1, "end": 2, "text": "a"}, {"start_time": "3", "text": "b"}, {"text": "c", "start": 5}]'
+    assert parse(text) == [(1.0, 2.0, 'a'), (3.0, 5.0, 'b'), (5.0, 5.0, 'c')]
+
+
+def test_json_pretty_printed():
+    text = '[\n  {\n    "start": 1,\n    "end": 2,\n    "text": "a"\n  },\n\n  {\n    "start": 3,\n    "end": 4,\n    "text": "b"\n  }\n]\n'
+    assert parse(text) == [(1.0, 2.0, 'a'), (3.0, 4.0, 'b')]
+
+
+def test_json_after_webvtt_header():
+    text = 'WEBVTT\n\n[\n  {"start": 1, "text": "a"},\n  {"start": 4, "end": 6, "text": "b"}\n]\n'
+    assert parse(text) == [(1.0, 4.0, 'a'), (4.0, 6.0, 'b')]
+
+
+def test_json_directly_after_webvtt_line():
+    text = 'WEBVTT\n[{"start": 1, "end": 2, "text": "a"}, {"start": 3, "end": 4, "text": "b"}]\n'
+    assert parse(text) == [(1.0, 2.0, 'a'), (3.0, 4.0, 'b')]
+
+
+def test_json_after_webvtt_header_lines():
+    text = 'WEBVTT\nKind: captions\n[{"start": 1, "end": 2, "text": "a"}]'
+    assert parse(text) == [(1.0, 2.0, 'a')]
+
+
+def test_truncated_json_keeps_complete_entries():
+    text = '[{"start": 1, "end": 2, "text": "a"}, {"start": 3, "end": 4, "text": "b"}, {"start": 5, "te'
+    assert parse(text) == [(1.0, 2.0, 'a'), (3.0, 4.0, 'b')]
+
+
+def test_unparsable_blocks_are_skipped():
+    text = 'hello\nworld\n--> not a cue\n\n00:00:01.000 --> 00:00:02.000\nok\n'
+    assert parse(text) == [(1.0, 2.0, 'ok')]